@@ -1,11 +1,19 @@
 from flask import Flask
 
-from app.extensions import db, limiter, migrate, flask_uuid
+from app.extensions import db, limiter, migrate, flask_uuid, token_cache, address_cache, \
+                           primary_pins
+from app.cache import build_backend
 from app.config import Config
+from app.services import authy_client
+from app.metrics import request_metrics
+from app.querylog import query_log
+from app.tracing import tracer
+from app.profiler import request_profiler
+from app.logs import log_pipeline
 from app.errors import handle_429_request, handle_wrong_method, handle_not_found
+from jwt.algorithms import has_crypto
 
 import logging
-from logging.handlers import RotatingFileHandler
 
 def create_app(config_class=Config):
 
@@ -16,20 +24,48 @@ def create_app(config_class=Config):
     # register extensions
     db.init_app(app)
     limiter.init_app(app)
-    migrate.init_app(app)
+    migrate.init_app(app, db)
     flask_uuid.init_app(app)
-    
+    token_cache.configure(maxsize=app.config['AUTH_CACHE_SIZE'],
+                          ttl=app.config['AUTH_CACHE_TTL'])
+    authy_client.init_app(app)
+    address_cache.configure(build_backend(app.config['ADDRESS_CACHE_BACKEND'],
+                                          app.config['ADDRESS_CACHE_URL'],
+                                          app.config['ADDRESS_CACHE_SIZE'],
+                                          app.config['ADDRESS_CACHE_TTL']))
+    # pins only need storing when there are replicas to be pinned away from
+    if app.config['DB_REPLICA_URIS']:
+        pin_backend = app.config['ADDRESS_CACHE_BACKEND']
+        primary_pins.configure(build_backend(pin_backend if pin_backend != 'none' else 'local',
+                                             app.config['ADDRESS_CACHE_URL'],
+                                             app.config['ADDRESS_CACHE_SIZE'],
+                                             app.config['DB_READ_YOUR_WRITES'],
+                                             prefix='primary:'))
+    else:
+        primary_pins.configure(None)
+
+    request_metrics.init_app(app)
+    query_log.init_app(app)
+    tracer.init_app(app)
+    request_profiler.init_app(app)
+
     from app.main import bp as main_bp
     app.register_blueprint(main_bp)
 
+    from app.countries import country_cache
+    country_cache.init_app(app)
+
+    # register cli commands
+    from app.commands import explain_queries
+    app.cli.add_command(explain_queries)
+
     # register custom errors
     app.register_error_handler(429, handle_429_request)
     app.register_error_handler(405, handle_wrong_method)
     app.register_error_handler(404, handle_not_found)
 
-    # logging stuff
-    formatter = logging.Formatter("[%(asctime)s] [%(pathname)s:%(lineno)d] %(levelname)s - %(message)s")
-    handler = RotatingFileHandler(app.config['LOG_FILENAME'], maxBytes=10000000, backupCount=5)
+    # logging stuff - records are written by a background thread, see
+    # app/logs.py
     log_level = app.config['LOG_LEVEL']
 
     if log_level == 'DEBUG': # pragma: no cover
@@ -43,8 +79,13 @@ def create_app(config_class=Config):
     else: # pragma: no cover
         app.logger.setLevel(logging.CRITICAL) # pragma: no cover
 
-    handler.setFormatter(formatter)
-    app.logger.addHandler(handler)
+    log_pipeline.configure(app)
+
+    # pyjwt can only check RS/ES signatures with cryptography installed -
+    # without it every token falls back to authy
+    if app.config['JWT_PUBLIC_KEY'] and not has_crypto: # pragma: no cover
+        app.logger.warning("JWT_PUBLIC_KEY is set but cryptography is not installed - "
+                           "tokens can't be verified locally")
 
     return app
 
@@ -1,31 +1,117 @@
 import os.path
 import json
-from jsonschema import validate, draft7_format_checker
+import threading
+from jsonschema import Draft7Validator, draft7_format_checker
+from jsonschema.exceptions import best_match
 from jsonschema.exceptions import ValidationError as JsonValidationError
+from app.metrics import phase
+
+# -----------------------------------------------------------------------------
+# schemas are loaded from disk and compiled into validators once per process.
+# per country address schemas follow the naming convention
+# schemas/address_<iso_code>.json and are picked up lazily the first time an
+# address for that country is validated - countries without their own schema
+# fall back to the default address schema
+# -----------------------------------------------------------------------------
+
+SCHEMA_DIR = os.path.join(os.path.dirname(__file__), 'schemas')
+
+COUNTRY_SCHEMA = 'countries.json'
+DEFAULT_ADDRESS_SCHEMA = 'address_default.json'
+
+class SchemaRegistry(object):
+
+    def __init__(self, schema_dir=SCHEMA_DIR):
+        self.schema_dir = schema_dir
+        self._validators = {}
+        self._compiled = {}
+        self._address_schemas = {}
+        self._lock = threading.Lock()
+
+    def register_address_schema(self, country_code, filename):
+        # explicitly map a country code to a schema file - the file is not
+        # read until the first address for that country is validated
+        with self._lock:
+            self._address_schemas[country_code] = filename
+            self._validators.pop(('address', country_code), None)
+
+    def unregister_address_schema(self, country_code):
+        # back to looking the schema file up by country code
+        with self._lock:
+            self._address_schemas.pop(country_code, None)
+            self._validators.pop(('address', country_code), None)
+
+    def country_validator(self):
+        return self._get(('country', None), lambda: COUNTRY_SCHEMA)
+
+    def address_validator(self, country_code):
+        return self._get(('address', country_code),
+                         lambda: self._address_schema_file(country_code))
+
+    def clear(self):
+        with self._lock:
+            self._validators = {}
+            self._compiled = {}
+
+    def _get(self, key, filename_func):
+        # fast path - no locking once a validator has been compiled
+        validator = self._validators.get(key)
+        if validator is not None:
+            return validator
+
+        with self._lock:
+            validator = self._validators.get(key)
+            if validator is None:
+                validator = self._compile(filename_func())
+                self._validators[key] = validator
+        return validator
+
+    def _address_schema_file(self, country_code):
+        filename = self._address_schemas.get(country_code)
+        if filename:
+            return filename
+
+        if country_code and country_code.isalpha():
+            filename = 'address_'+country_code.lower()+'.json'
+            if os.path.isfile(os.path.join(self.schema_dir, filename)):
+                return filename
+
+        return DEFAULT_ADDRESS_SCHEMA
+
+    def _compile(self, filename):
+        # countries sharing a schema file share the compiled validator too
+        validator = self._compiled.get(filename)
+        if validator is None:
+            schema = _load_json_schema(os.path.join(self.schema_dir, filename))
+            Draft7Validator.check_schema(schema)
+            validator = Draft7Validator(schema, format_checker=draft7_format_checker)
+            self._compiled[filename] = validator
+        return validator
+
+
+schema_registry = SchemaRegistry()
+
+# -----------------------------------------------------------------------------
 
 def assert_valid_schema(data, schema_type):
     # checks whether the given data matches the schema
 
-    #TODO: validate on a particular country's address schema based on input iso_code
-    #TODO: get these from redis or similar - only get from disk first time
+    with phase('validation'):
+        if schema_type == 'country':
+            validator = schema_registry.country_validator()
 
-    if schema_type == 'country':
-        schema = _load_json_schema('schemas/countries.json')
+        if schema_type == 'address':
+            country_code = data.pop('iso_code', None)
+            validator = schema_registry.address_validator(country_code)
 
-    if schema_type == 'address':
-        country_code = data.pop('iso_code', None)
+        # same error selection as jsonschema.validate
+        error = best_match(validator.iter_errors(data))
 
-        if country_code == 'GBR':
-            schema = _load_json_schema('schemas/address_gbr.json')
-        else:
-            schema = _load_json_schema('schemas/address_default.json')
+    if error is not None:
+        raise error
 
-    return validate(data, schema, format_checker=draft7_format_checker)
 
-
-def _load_json_schema(filename):
+def _load_json_schema(filepath):
     # loads the given schema file
-    filepath = os.path.join(os.path.dirname(__file__), filename)
-
     with open(filepath) as schema_file:
         return json.loads(schema_file.read())
@@ -0,0 +1,446 @@
+# app/cache.py
+from collections import OrderedDict
+import fnmatch
+import math
+import threading
+import time
+import uuid
+
+# -----------------------------------------------------------------------------
+# small in-process caches - everything here is per worker process and safe to
+# use from threaded workers
+# -----------------------------------------------------------------------------
+
+# returned by get when a key is not cached - lets us cache None as a value
+MISSING = object()
+
+class TTLCache(object):
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self._lock = threading.Lock()
+        self.configure(maxsize, ttl)
+
+    def configure(self, maxsize=None, ttl=None):
+        # (re)size the cache - also empties it and resets the counters
+        with self._lock:
+            if maxsize is not None:
+                self.maxsize = int(maxsize)
+            if ttl is not None:
+                self.ttl = float(ttl)
+            self._data = OrderedDict()
+            self.hits = 0
+            self.misses = 0
+            self.evictions = 0
+
+    def get(self, key, default=MISSING):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires = entry
+            if expires <= now:
+                del self._data[key]
+                self.misses += 1
+                return default
+            # least recently used entries are at the front
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            ttl = self.ttl
+        if self.maxsize <= 0 or ttl <= 0:
+            return
+        expires = time.monotonic() + ttl
+        with self._lock:
+            self._data[key] = (value, expires)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            return self._data.pop(key, None) is not None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return { 'hits': self.hits,
+                     'misses': self.misses,
+                     'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+                     'evictions': self.evictions,
+                     'size': len(self._data),
+                     'maxsize': self.maxsize }
+
+    def __len__(self):
+        return len(self._data)
+
+# -----------------------------------------------------------------------------
+# single flight - concurrent callers asking for the same key share one call
+# of the underlying function instead of all making it at the same time
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.calls = 0
+        self.shared = 0
+
+    def do(self, key, func):
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self.calls += 1
+            else:
+                self.shared += 1
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            call.result = func()
+        except Exception as err:
+            call.error = err
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+        return call.result
+
+    def stats(self):
+        with self._lock:
+            return { 'calls': self.calls,
+                     'shared': self.shared,
+                     'in_flight': len(self._calls) }
+
+# -----------------------------------------------------------------------------
+# storage backends for caches of serialized responses. values are bytes.
+#   LocalBackend  - in-process lru with a ttl - each worker has its own copy
+#   SharedBackend - anything with redis style get/mget/set/delete so all
+#                   workers see the same entries and invalidations
+# both also keep the key versions used by ResponseCache - get_versioned
+# fetches an entry and its key's version in one round trip
+# LocalSharedClient is a stand-in for a redis client for development and
+# tests - entries are shared by everything in the one process. it also has
+# the counter commands and pipelines used by app/ratelimit.py
+
+# prefix of the keys shared backends keep versions under
+VERSION_PREFIX = 'version:'
+
+class LocalBackend(object):
+
+    def __init__(self, maxsize, ttl):
+        self.ttl = ttl
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+        # versions are kept apart from the lru - evicting one before the
+        # entries built under it would let an old entry be served again.
+        # they are dropped once expired instead
+        self._versions = {}
+        self._versions_lock = threading.Lock()
+        self._prune_at = 1024
+
+    def get(self, key):
+        value = self._cache.get(key)
+        return None if value is MISSING else value
+
+    def set(self, key, value, ttl=None):
+        self._cache.set(key, value, ttl)
+
+    def delete(self, key):
+        self._cache.delete(key)
+
+    def get_version(self, key):
+        now = time.monotonic()
+        entry = self._versions.get(key)
+        if entry is None or entry[1] <= now:
+            return None
+        return entry[0]
+
+    def set_version(self, key, version, ttl):
+        now = time.monotonic()
+        with self._versions_lock:
+            self._versions[key] = (version, now + ttl)
+            if len(self._versions) >= self._prune_at:
+                self._versions = dict((name, entry) for name, entry in self._versions.items()
+                                      if entry[1] > now)
+                self._prune_at = max(1024, len(self._versions) * 2)
+
+    def get_versioned(self, key):
+        return self.get(key), self.get_version(key)
+
+    def __len__(self):
+        return len(self._cache)
+
+
+class SharedBackend(object):
+
+    def __init__(self, client, ttl, prefix='address:'):
+        self.client = client
+        self.ttl = int(ttl)
+        self.prefix = prefix
+
+    def get(self, key):
+        return self.client.get(self.prefix+key)
+
+    def set(self, key, value, ttl=None):
+        self.client.set(self.prefix+key, value, ex=int(ttl or self.ttl))
+
+    def delete(self, key):
+        self.client.delete(self.prefix+key)
+
+    def get_version(self, key):
+        return self.client.get(self.prefix+VERSION_PREFIX+key)
+
+    def set_version(self, key, version, ttl):
+        self.client.set(self.prefix+VERSION_PREFIX+key, version, ex=int(ttl))
+
+    def get_versioned(self, key):
+        value, version = self.client.mget([self.prefix+key, self.prefix+VERSION_PREFIX+key])
+        return value, version
+
+
+class LocalSharedClient(object):
+
+    _store = {}
+    _lock = threading.Lock()
+
+    def get(self, name):
+        with self._lock:
+            entry = self._live(name)
+            return entry[0] if entry is not None else None
+
+    def mget(self, names):
+        with self._lock:
+            entries = [self._live(name) for name in names]
+        return [entry[0] if entry is not None else None for entry in entries]
+
+    def set(self, name, value, ex=None, nx=False):
+        expires = time.monotonic() + ex if ex else None
+        with self._lock:
+            if nx and self._live(name) is not None:
+                return None
+            self._store[name] = (value, expires)
+        return True
+
+    def delete(self, *names):
+        with self._lock:
+            return len([self._store.pop(name) for name in names if name in self._store])
+
+    def incrby(self, name, amount=1):
+        with self._lock:
+            entry = self._live(name)
+            value, expires = entry if entry is not None else (0, None)
+            value = int(value) + amount
+            self._store[name] = (value, expires)
+            return value
+
+    def expire(self, name, time_seconds):
+        with self._lock:
+            entry = self._live(name)
+            if entry is None:
+                return False
+            self._store[name] = (entry[0], time.monotonic() + time_seconds)
+            return True
+
+    def ttl(self, name):
+        # like redis - -2 if there is no such key, -1 if it never expires
+        with self._lock:
+            entry = self._live(name)
+            if entry is None:
+                return -2
+            if entry[1] is None:
+                return -1
+            return int(math.ceil(entry[1] - time.monotonic()))
+
+    def scan_iter(self, match='*'):
+        with self._lock:
+            names = [name for name in self._store if fnmatch.fnmatchcase(name, match)]
+        return iter(names)
+
+    def ping(self):
+        return True
+
+    def pipeline(self, transaction=True):
+        return _LocalPipeline(self)
+
+    def flushdb(self):
+        with self._lock:
+            self._store.clear()
+
+    def _live(self, name):
+        # the entry for name unless it has expired - call with the lock held
+        entry = self._store.get(name)
+        if entry is not None and entry[1] is not None and entry[1] <= time.monotonic():
+            del self._store[name]
+            return None
+        return entry
+
+
+class _LocalPipeline(object):
+
+    # queues commands and runs them all on execute, like a redis pipeline
+
+    def __init__(self, client):
+        self.client = client
+        self.commands = []
+
+    def __getattr__(self, name):
+        command = getattr(self.client, name)
+        def queue(*args, **kwargs):
+            self.commands.append((command, args, kwargs))
+            return self
+        return queue
+
+    def execute(self):
+        commands, self.commands = self.commands, []
+        return [command(*args, **kwargs) for command, args, kwargs in commands]
+
+
+def build_backend(kind, url, maxsize, ttl, prefix='address:'):
+    # returns None when caching is switched off
+    if kind == 'local':
+        return LocalBackend(maxsize, ttl)
+
+    if kind == 'shared':
+        if url and url.startswith(('redis://', 'rediss://', 'unix://')):
+            import redis
+            return SharedBackend(redis.Redis.from_url(url), ttl, prefix)
+        return SharedBackend(LocalSharedClient(), ttl, prefix)
+
+    return None
+
+# -----------------------------------------------------------------------------
+# read through cache of serialized responses. each entry is stored with the
+# time it was built so we can report how stale the responses we serve are.
+#
+# every key also has a version that invalidate changes. callers take the
+# version() before reading the data they are about to cache and pass it to
+# set - the entry is stored with it and get ignores entries whose version is
+# no longer current. so a slow read that finishes after a concurrent write
+# has invalidated the key can't put the old data back
+
+# version of a key that has never been invalidated
+BASE_VERSION = b'0'
+
+def _new_version():
+    return uuid.uuid4().hex.encode('ascii')
+
+
+class ResponseCache(object):
+
+    def __init__(self):
+        self.backend = None
+        self._lock = threading.Lock()
+        self._reset_stats()
+
+    def configure(self, backend):
+        self.backend = backend
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.errors = 0
+        self.max_staleness = 0.0
+        self.total_staleness = 0.0
+
+    def get(self, key):
+        if self.backend is None:
+            return None
+        try:
+            value, current = self.backend.get_versioned(key)
+        except Exception:
+            # a broken cache should never take a request down with it
+            self._count('errors')
+            return None
+
+        if value is None:
+            self._count('misses')
+            return None
+
+        version, built_at, body = value.split(b'\n', 2)
+        if version != (current or BASE_VERSION):
+            # built from data read before the last invalidate
+            self._count('misses')
+            return None
+
+        staleness = max(time.time() - float(built_at), 0.0)
+        with self._lock:
+            self.hits += 1
+            self.total_staleness += staleness
+            self.max_staleness = max(self.max_staleness, staleness)
+        return body
+
+    def version(self, key):
+        if self.backend is None:
+            return BASE_VERSION
+        try:
+            return self.backend.get_version(key) or BASE_VERSION
+        except Exception:
+            # one that will never be current, so nothing built now is served
+            self._count('errors')
+            return _new_version()
+
+    def set(self, key, body, version=None):
+        if self.backend is None:
+            return
+        if version is None:
+            version = self.version(key)
+        try:
+            self.backend.set(key, version + b'\n' + repr(time.time()).encode('ascii') + b'\n' + body)
+        except Exception:
+            self._count('errors')
+
+    def invalidate(self, key):
+        if self.backend is None:
+            return
+        try:
+            # versions outlive the entries built under them so an old entry
+            # can never become current again
+            self.backend.set_version(key, _new_version(), self.backend.ttl * 2)
+            self.backend.delete(key)
+            self._count('invalidations')
+        except Exception:
+            self._count('errors')
+
+    def _count(self, name):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + 1)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return { 'backend': type(self.backend).__name__ if self.backend else None,
+                     'hits': self.hits,
+                     'misses': self.misses,
+                     'hit_ratio': float(self.hits) / lookups if lookups else 0.0,
+                     'invalidations': self.invalidations,
+                     'errors': self.errors,
+                     'max_staleness': self.max_staleness,
+                     'avg_staleness': self.total_staleness / self.hits if self.hits else 0.0 }
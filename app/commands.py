@@ -0,0 +1,126 @@
+# app/commands.py
+from app import db
+from app.models import Country, Address
+from app.queries import USER_ADDRESSES, ONE_ADDRESS, MANY_ADDRESSES, \
+                        ADMIN_ADDRESSES_AFTER, ADMIN_ADDRESSES_PAGE, COUNT_ADDRESSES, \
+                        COUNTRIES, delete_address_query, export_addresses_query
+from flask.cli import with_appcontext
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.expression import Executable, ClauseElement
+import click
+import datetime
+import uuid
+
+# -----------------------------------------------------------------------------
+# flask explain-queries [--seed N] [--strict]
+#
+# prints the postgres plan for the query behind each route so a missing or
+# unused index shows up before it gets to production. --seed adds N made up
+# addresses first - everything happens in one transaction that is rolled
+# back at the end so only use this against a dev or test database. --strict
+# exits non zero if a query that should use an index scans the address table
+# -----------------------------------------------------------------------------
+
+@click.command('explain-queries')
+@click.option('--seed', default=0, help='made up addresses to add before explaining')
+@click.option('--strict', is_flag=True, help='fail if an indexed query scans the address table')
+@with_appcontext
+def explain_queries(seed, strict):
+
+    try:
+        if seed > 0:
+            _seed_addresses(seed)
+            db.session.execute('ANALYZE address')
+
+        sample = db.session.query(Address.id, Address.address_id,
+                                  Address.public_id, Address.created)\
+                           .order_by(Address.id.desc())\
+                           .first()
+        if sample is None:
+            raise click.ClickException('no addresses to explain against - try --seed')
+
+        scans = []
+        for route, statement, params, uses_index in _route_queries(sample):
+            click.echo('-- '+route)
+            for line in _explain(statement, params):
+                click.echo('   '+line)
+                if uses_index and 'Seq Scan on address' in line:
+                    scans.append(route)
+            click.echo('')
+
+    finally:
+        db.session.rollback()
+
+    if scans:
+        click.echo('address table scanned by: '+', '.join(sorted(set(scans))))
+        if strict:
+            raise SystemExit(1)
+
+
+def _route_queries(sample):
+    # (route, statement, params, should this be an index lookup)
+    per_page = 20
+    delete_query = delete_address_query(sample.address_id, sample.public_id)
+    return [
+        ('GET /address', USER_ADDRESSES, { 'public_id': sample.public_id }, True),
+        ('GET /address/<uuid>', ONE_ADDRESS, { 'address_id': sample.address_id }, True),
+        ('GET /address/multi', MANY_ADDRESSES, { 'address_ids': [sample.address_id] }, True),
+        ('DELETE /address/<uuid>',
+         Address.__table__.delete().where(delete_query.whereclause), {}, True),
+        ('GET /address/admin/address?cursor=', ADMIN_ADDRESSES_AFTER,
+         { 'after_id': sample.id // 2, 'limit': per_page + 1 }, True),
+        ('GET /address/admin/address?page=', ADMIN_ADDRESSES_PAGE,
+         { 'offset': per_page * 10, 'limit': per_page }, False),
+        ('GET /address/admin/address?count=exact', COUNT_ADDRESSES, {}, False),
+        ('GET /address/admin/export?created=',
+         export_addresses_query(sample.created).statement, {}, True),
+        ('GET /address/countries', COUNTRIES, {}, False),
+    ]
+
+
+# EXPLAIN wrapped round a statement so it is executed the same way the routes
+# execute it - including expanding bind parameters such as the multi get ids
+
+class _Explain(Executable, ClauseElement):
+
+    # the compiler looks for this when the wrapped statement is a delete
+    _returning = None
+
+    def __init__(self, statement):
+        self.statement = statement
+
+@compiles(_Explain)
+def _compile_explain(element, compiler, **kw):
+    return 'EXPLAIN '+compiler.process(element.statement, **kw)
+
+
+def _explain(statement, params):
+    result = db.session.connection().execute(_Explain(statement), params)
+    return [row[0] for row in result]
+
+
+def _seed_addresses(total):
+
+    country = Country.query.first()
+    if country is None:
+        country = Country(name = 'Explainland', iso_code = 'XPL')
+        db.session.add(country)
+        db.session.flush()
+
+    # roughly five addresses per user spread over the last year
+    now = datetime.datetime.utcnow()
+    public_ids = [str(uuid.uuid4()) for _ in range(max(total // 5, 1))]
+    rows = []
+    for number in range(total):
+        rows.append({ 'address_id': str(uuid.uuid4()),
+                      'public_id': public_ids[number % len(public_ids)],
+                      'house_number': str(number),
+                      'address_line_1': 'Seed Street',
+                      'post_zip_code': 'SE1 1ED',
+                      'country_id': country.id,
+                      'created': now - datetime.timedelta(minutes=total - number) })
+        if len(rows) == 1000:
+            db.session.execute(Address.__table__.insert().values(rows))
+            rows = []
+    if rows:
+        db.session.execute(Address.__table__.insert().values(rows))
@@ -9,12 +9,117 @@ class Config(object):
     SECRET_KEY = os.getenv('SECRET_KEY')
     SQLALCHEMY_DATABASE_URI = os.getenv('SQLALCHEMY_DATABASE_URI')
     SQLALCHEMY_TRACK_MODIFICATIONS = False
+    # connection pool per worker - timeouts in seconds except the statement
+    # timeout which is in milliseconds (0 is no timeout). DB_PGBOUNCER=True
+    # leaves pooling to pgbouncer in transaction mode - see app/database.py
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', 5))
+    DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', 5))
+    DB_POOL_TIMEOUT = float(os.getenv('DB_POOL_TIMEOUT', 10))
+    DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', 1800))
+    DB_POOL_PRE_PING = os.getenv('DB_POOL_PRE_PING', 'True') == 'True'
+    DB_STATEMENT_TIMEOUT = int(os.getenv('DB_STATEMENT_TIMEOUT', 0))
+    DB_PGBOUNCER = os.getenv('DB_PGBOUNCER', 'False') == 'True'
+    # comma separated read replica uris - GET requests read from these.
+    # users read from the primary for DB_READ_YOUR_WRITES seconds after a
+    # change - pins are kept in the ADDRESS_CACHE_BACKEND (local if none)
+    DB_REPLICA_URIS = [uri for uri in os.getenv('DB_REPLICA_URIS', '').split(',') if uri]
+    DB_READ_YOUR_WRITES = int(os.getenv('DB_READ_YOUR_WRITES', 10))
     CHECK_ACCESS_URL = os.getenv('CHECK_ACCESS_URL')
     ADDRESS_LIMIT_PER_PAGE = os.getenv('ADDRESS_LIMIT_PER_PAGE')
+    # exact, estimated or counter - see app/counts.py
+    ADDRESS_COUNT_STRATEGY = os.getenv('ADDRESS_COUNT_STRATEGY', 'exact')
+    # most addresses allowed in one POST /address/batch
+    ADDRESS_BATCH_LIMIT = int(os.getenv('ADDRESS_BATCH_LIMIT', 100))
+    # most addresses that can be fetched by one /address/multi call
+    ADDRESS_MULTI_GET_LIMIT = int(os.getenv('ADDRESS_MULTI_GET_LIMIT', 50))
+    # rows fetched per round trip by the admin export
+    EXPORT_BATCH_SIZE = int(os.getenv('EXPORT_BATCH_SIZE', 1000))
+    # per user cache of address lists - none, local or shared. local is per
+    # worker so other workers only see a change once their copy expires -
+    # use shared when running more than one worker
+    ADDRESS_CACHE_BACKEND = os.getenv('ADDRESS_CACHE_BACKEND', 'none')
+    ADDRESS_CACHE_URL = os.getenv('ADDRESS_CACHE_URL')
+    ADDRESS_CACHE_TTL = int(os.getenv('ADDRESS_CACHE_TTL', 300))
+    ADDRESS_CACHE_SIZE = int(os.getenv('ADDRESS_CACHE_SIZE', 10000))
+    # seconds the countries payload is kept in memory and cached by clients
+    COUNTRIES_CACHE_TTL = int(os.getenv('COUNTRIES_CACHE_TTL', 3600))
+    COUNTRIES_MAX_AGE = int(os.getenv('COUNTRIES_MAX_AGE', 3600))
+    # where rate limit counters are kept - memory:// is per worker, so use
+    # sqlite:////path/file.db or shared+redis://host:6379/0 with more than
+    # one worker. shared counters are synced every RATELIMIT_SYNC_INTERVAL
+    # seconds, and on every hit once a worker's count reaches
+    # RATELIMIT_SYNC_FRACTION of the limit. with N workers up to about
+    # limit * (1 + N * fraction) hits get through - see app/ratelimit.py
+    RATELIMIT_STORAGE_URL = os.getenv('RATELIMIT_STORAGE_URL', 'memory://')
+    RATELIMIT_STORAGE_OPTIONS = { 'sync_interval': float(os.getenv('RATELIMIT_SYNC_INTERVAL', 0.1)),
+                                  'sync_fraction': float(os.getenv('RATELIMIT_SYNC_FRACTION', 0.5)) }
+    # per route latency and phase metrics - see app/metrics.py. set
+    # METRICS_DIR to add up metrics from all the gunicorn workers
+    METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'True') == 'True'
+    METRICS_DIR = os.getenv('METRICS_DIR')
+    METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', 5))
+    # statements slower than this (0 turns it off) go to the slow query log,
+    # and the same statement run this many times in one request is logged as
+    # a likely n+1 - see app/querylog.py
+    SQL_SLOW_QUERY_MS = float(os.getenv('SQL_SLOW_QUERY_MS', 500))
+    SQL_SLOW_LOG_FILENAME = os.getenv('SQL_SLOW_LOG_FILENAME')
+    SQL_N_PLUS_ONE_THRESHOLD = int(os.getenv('SQL_N_PLUS_ONE_THRESHOLD', 5))
+    # share of requests traced (0 to 1) and where their spans are exported -
+    # none, jsonl (to TRACE_FILENAME) or package.module:factory. see
+    # app/tracing.py
+    TRACE_SAMPLE_RATE = float(os.getenv('TRACE_SAMPLE_RATE', 0))
+    TRACE_EXPORTER = os.getenv('TRACE_EXPORTER', 'jsonl')
+    TRACE_FILENAME = os.getenv('TRACE_FILENAME', 'log/traces.jsonl')
+    TRACE_BATCH_SIZE = int(os.getenv('TRACE_BATCH_SIZE', 100))
+    TRACE_FLUSH_INTERVAL = float(os.getenv('TRACE_FLUSH_INTERVAL', 2))
+    TRACE_QUEUE_SIZE = int(os.getenv('TRACE_QUEUE_SIZE', 10000))
+    # honour X-Trace-Sampled: 1 and X-Parent-Span-Id from callers - only
+    # when every caller is a trusted upstream
+    TRACE_TRUST_HEADERS = os.getenv('TRACE_TRUST_HEADERS', 'False') == 'True'
+    # admins can profile one request by sending PROFILE_HEADER - cprofile or
+    # pyinstrument. at most PROFILE_MAX_PER_WINDOW profiles are saved to
+    # PROFILE_DIR every PROFILE_WINDOW seconds and only the newest
+    # PROFILE_MAX_FILES are kept - see app/profiler.py
+    PROFILE_ENABLED = os.getenv('PROFILE_ENABLED', 'True') == 'True'
+    PROFILE_HEADER = os.getenv('PROFILE_HEADER', 'X-Profile')
+    PROFILER = os.getenv('PROFILER', 'cprofile')
+    PROFILE_DIR = os.getenv('PROFILE_DIR', 'log/profiles')
+    PROFILE_MAX_PER_WINDOW = int(os.getenv('PROFILE_MAX_PER_WINDOW', 5))
+    PROFILE_WINDOW = float(os.getenv('PROFILE_WINDOW', 60))
+    PROFILE_MAX_FILES = int(os.getenv('PROFILE_MAX_FILES', 100))
     LOG_FILENAME = os.getenv('LOG_FILENAME')
     LOG_LEVEL = os.getenv('LOG_LEVEL')
+    # text or json, records queued before they are dropped and the share of
+    # records kept per level e.g. DEBUG=0.1,INFO=0.5 - see app/logs.py
+    LOG_FORMAT = os.getenv('LOG_FORMAT', 'text')
+    LOG_QUEUE_SIZE = int(os.getenv('LOG_QUEUE_SIZE', 10000))
+    LOG_SAMPLE_RATES = os.getenv('LOG_SAMPLE_RATES', '')
+    # encode api responses with orjson when it is installed
+    JSON_FAST_ENCODER = os.getenv('JSON_FAST_ENCODER', 'True') == 'True'
+    # authy answers are cached per token and access level - seconds
+    AUTH_CACHE_TTL = int(os.getenv('AUTH_CACHE_TTL', 60))
+    AUTH_CACHE_NEGATIVE_TTL = int(os.getenv('AUTH_CACHE_NEGATIVE_TTL', 5))
+    AUTH_CACHE_SIZE = int(os.getenv('AUTH_CACHE_SIZE', 10000))
+    # connection pool, timeouts (seconds) and circuit breaker for authy
+    AUTHY_POOL_SIZE = int(os.getenv('AUTHY_POOL_SIZE', 10))
+    AUTHY_CONNECT_TIMEOUT = float(os.getenv('AUTHY_CONNECT_TIMEOUT', 1.0))
+    AUTHY_READ_TIMEOUT = float(os.getenv('AUTHY_READ_TIMEOUT', 3.0))
+    AUTHY_MAX_RETRIES = int(os.getenv('AUTHY_MAX_RETRIES', 2))
+    AUTHY_RETRY_BACKOFF = float(os.getenv('AUTHY_RETRY_BACKOFF', 0.1))
+    AUTHY_BREAKER_THRESHOLD = int(os.getenv('AUTHY_BREAKER_THRESHOLD', 5))
+    AUTHY_BREAKER_RESET = float(os.getenv('AUTHY_BREAKER_RESET', 30))
+    # 'remote' always asks authy, 'local' verifies jwts here first and only
+    # asks authy about tokens it can't verify
+    AUTH_VERIFY_MODE = os.getenv('AUTH_VERIFY_MODE', 'remote')
+    JWT_SECRET_KEY = os.getenv('JWT_SECRET_KEY')
+    JWT_PUBLIC_KEY = os.getenv('JWT_PUBLIC_KEY')
+    JWT_ALGORITHMS = os.getenv('JWT_ALGORITHMS', 'HS256').split(',')
+    JWT_PUBLIC_ID_CLAIM = os.getenv('JWT_PUBLIC_ID_CLAIM', 'public_id')
+    JWT_ACCESS_LEVEL_CLAIM = os.getenv('JWT_ACCESS_LEVEL_CLAIM', 'access_level')
 
 class TestConfig(Config):
     SQLALCHEMY_DATABASE_URI = os.getenv('SQLALCHEMY_TESTDB_URI')
     ADDRESS_LIMIT_PER_PAGE = "2"
     LOG_LEVEL = "DEBUG"
+    ADDRESS_CACHE_BACKEND = 'local'
+    TRACE_EXPORTER = 'memory'
@@ -0,0 +1,106 @@
+# app/countries.py
+from app.models import Country
+from app.queries import run, COUNTRIES
+from app.serializers import country_serializer, dumps
+from sqlalchemy import event
+from sqlalchemy.orm import Session, object_session
+from types import MappingProxyType
+import hashlib
+import threading
+import time
+
+# -----------------------------------------------------------------------------
+# country data hardly ever changes so it is loaded once per process - the
+# /address/countries payload is served from memory with an etag and creates
+# check and resolve iso codes against an immutable iso_code -> (id, name)
+# index instead of the database. any commit that adds, changes or removes
+# countries in this process drops both - the ttl picks up reloads done by
+# other processes such as the load_countries scripts. an empty countries table
+# (a fresh deploy before the countries are loaded) is only held for
+# EMPTY_RETRY seconds so the service notices the load straight away
+# -----------------------------------------------------------------------------
+
+EMPTY_RETRY = 5.0
+
+class CountryCache(object):
+
+    def __init__(self):
+        self.ttl = 3600
+        self.empty_retry = EMPTY_RETRY
+        self._payload = None
+        self._index = None
+        self._expires_at = 0
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.ttl = int(app.config['COUNTRIES_CACHE_TTL'])
+        self.invalidate()
+
+    def invalidate(self):
+        with self._lock:
+            self._payload = None
+            self._index = None
+
+    def payload(self):
+        # returns the serialized json body and its etag
+        return self._load()[0]
+
+    def index(self):
+        # returns a read only mapping of iso_code to (id, name)
+        return self._load()[1]
+
+    def lookup(self, iso_code):
+        # returns (id, name) for a known iso code or None
+        if not isinstance(iso_code, str):
+            return None
+        return self.index().get(iso_code)
+
+    def _load(self):
+        payload, index = self._payload, self._index
+        if payload is not None and index is not None and time.monotonic() < self._expires_at:
+            return payload, index
+
+        with self._lock:
+            if self._payload is None or self._index is None or \
+               time.monotonic() >= self._expires_at:
+                results = run(COUNTRIES).fetchall()
+                self._payload = self._build_payload(results)
+                self._index = MappingProxyType(dict((country.iso_code, (country.id, country.name))
+                                                    for country in results))
+                self._expires_at = time.monotonic() + \
+                                   (self.ttl if results else min(self.ttl, self.empty_retry))
+            return self._payload, self._index
+
+    def _build_payload(self, results):
+        body = dumps({ 'countries': country_serializer.many(results) })
+        return body, hashlib.sha1(body).hexdigest()
+
+
+country_cache = CountryCache()
+
+# -----------------------------------------------------------------------------
+# note country changes against the session and only invalidate once they are
+# committed so no other request can rebuild the cache from half-done work
+
+def _country_changed(mapper, connection, target):
+    session = object_session(target)
+    if session is not None:
+        session.info['countries_changed'] = True
+
+for _event_name in ('after_insert', 'after_update', 'after_delete'):
+    event.listen(Country, _event_name, _country_changed)
+
+@event.listens_for(Session, 'after_bulk_update')
+@event.listens_for(Session, 'after_bulk_delete')
+def _countries_bulk_changed(update_context):
+    if update_context.mapper.class_ is Country:
+        update_context.session.info['countries_changed'] = True
+
+@event.listens_for(Session, 'after_commit')
+def _countries_committed(session):
+    if session.info.pop('countries_changed', False):
+        country_cache.invalidate()
+
+@event.listens_for(Session, 'after_rollback')
+def _countries_rolled_back(session):
+    session.info.pop('countries_changed', None)
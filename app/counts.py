@@ -0,0 +1,65 @@
+# app/counts.py
+from app import db
+from app.models import Address, RecordCount
+from app.queries import run, COUNT_ADDRESSES
+from sqlalchemy import select, text
+from sqlalchemy.dialects.postgresql import insert
+
+# -----------------------------------------------------------------------------
+# ways of getting the total number of addresses for the admin listing.
+#   exact     - count(*) - always right but a full scan in postgres
+#   estimated - the planner's row estimate from pg_class - nearly free but
+#               only as fresh as the last analyze
+#   counter   - a running total kept in record_count by create and delete
+# -----------------------------------------------------------------------------
+
+COUNT_STRATEGIES = ('exact', 'estimated', 'counter')
+
+ADDRESS_TABLE = Address.__tablename__
+
+def count_addresses(strategy):
+    # returns the total and the strategy that actually produced it
+
+    if strategy == 'estimated':
+        estimate = db.session.execute(text("SELECT reltuples::bigint FROM pg_class "
+                                           "WHERE oid = to_regclass(:table_name)"),
+                                      { 'table_name': ADDRESS_TABLE }).scalar()
+        # tables that have never been analyzed have no estimate
+        if estimate is not None and estimate >= 0:
+            return int(estimate), 'estimated'
+
+    if strategy == 'counter':
+        total = db.session.query(RecordCount.total)\
+                          .filter(RecordCount.table_name == ADDRESS_TABLE)\
+                          .scalar()
+        if total is None:
+            total = _seed_address_counter()
+        return int(total), 'counter'
+
+    return run(COUNT_ADDRESSES).scalar(), 'exact'
+
+
+def adjust_address_count(delta):
+    # runs in the caller's transaction so the total commits or rolls back
+    # with the rows it counts. does nothing until the counter is first seeded
+    counts = RecordCount.__table__
+    db.session.execute(counts.update()\
+                             .where(counts.c.table_name == ADDRESS_TABLE)\
+                             .values(total=counts.c.total + delta))
+
+
+def _seed_address_counter():
+    # creates and deletes only adjust a counter that exists, so none may
+    # commit between the count and the insert or its change is lost for
+    # good. SHARE mode waits for those in flight and holds new ones off until
+    # the seed commits. done on its own primary connection - a GET's session
+    # may be reading from a replica
+    counts = RecordCount.__table__
+    with db.engine.begin() as connection:
+        connection.execute(text('LOCK TABLE '+ADDRESS_TABLE+' IN SHARE MODE'))
+        total = connection.execute(COUNT_ADDRESSES).scalar()
+        connection.execute(insert(counts).values(table_name=ADDRESS_TABLE, total=total)\
+                                         .on_conflict_do_nothing())
+        total = connection.execute(select([counts.c.total])\
+                                   .where(counts.c.table_name == ADDRESS_TABLE)).scalar()
+    return total
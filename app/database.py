@@ -0,0 +1,236 @@
+# app/database.py
+from flask import g, request, has_request_context
+from flask_sqlalchemy import SQLAlchemy, SignallingSession
+from sqlalchemy import event, orm
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import QueuePool, NullPool
+from sqlalchemy.sql.expression import UpdateBase
+import logging
+import random
+import threading
+import time
+
+# -----------------------------------------------------------------------------
+# engine and connection pool set up from the DB_* config settings.
+#
+# normally each worker keeps its own small pool of connections, checked with a
+# ping before use and replaced after DB_POOL_RECYCLE seconds. statement_timeout
+# is sent as a connection option so it covers every statement.
+#
+# with DB_PGBOUNCER=True pgbouncer (transaction pooling) owns the connections -
+# nothing is pooled here and statement_timeout is set with SET LOCAL at the
+# start of each transaction, as session settings would leak to other clients
+#
+# DB_REPLICA_URIS adds read replicas as extra binds. GET requests read from a
+# replica picked at random unless the user has written in the last
+# DB_READ_YOUR_WRITES seconds - then they read from the primary so they see
+# their own changes. everything else, and any write, goes to the primary
+# -----------------------------------------------------------------------------
+
+logger = logging.getLogger('app.database')
+
+class _TimedPool(object):
+
+    # counts checkouts, connections in use and how long checkouts wait
+
+    def __init__(self, *args, **kwargs):
+        super(_TimedPool, self).__init__(*args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self._checkouts = 0
+        self._in_use = 0
+        self._timeouts = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super(_TimedPool, self)._do_get()
+        except PoolTimeoutError:
+            with self._stats_lock:
+                self._timeouts += 1
+            raise
+        waited = time.perf_counter() - started
+        with self._stats_lock:
+            self._checkouts += 1
+            self._in_use += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return connection
+
+    def _do_return_conn(self, connection):
+        with self._stats_lock:
+            self._in_use = max(self._in_use - 1, 0)
+        super(_TimedPool, self)._do_return_conn(connection)
+
+    def stats(self):
+        with self._stats_lock:
+            checkouts = self._checkouts
+            output = { 'pool': type(self).__name__,
+                       'in_use': self._in_use,
+                       'checkouts': checkouts,
+                       'timeouts': self._timeouts,
+                       'wait_total': round(self._wait_total, 6),
+                       'wait_avg': round(self._wait_total / checkouts, 6) if checkouts else 0.0,
+                       'wait_max': round(self._wait_max, 6) }
+        return output
+
+
+class TimedQueuePool(_TimedPool, QueuePool):
+
+    def stats(self):
+        output = super(TimedQueuePool, self).stats()
+        output['size'] = self.size()
+        output['checked_in'] = self.checkedin()
+        output['checked_out'] = self.checkedout()
+        output['overflow'] = self.overflow()
+        return output
+
+
+class TimedNullPool(_TimedPool, NullPool):
+    pass
+
+
+def pool_stats(engine):
+    stats = getattr(engine.pool, 'stats', None)
+    if stats is None:
+        return { 'pool': type(engine.pool).__name__ }
+    return stats()
+
+# -----------------------------------------------------------------------------
+
+REPLICA_BIND_PREFIX = 'replica_'
+
+# per request choice of engine for reads - kept in the wsgi environ
+READ_BIND_KEY = 'poptape.read_bind'
+
+class PrimaryPins(object):
+
+    # users who should read from the primary for now. uses the same kind of
+    # backend as the address cache - with more than one worker it needs to be
+    # shared so a pin set by one worker is seen by the others
+
+    def __init__(self):
+        self.backend = None
+        self.errors = 0
+
+    def configure(self, backend):
+        self.backend = backend
+        self.errors = 0
+
+    def pin(self, public_id):
+        if self.backend is None or not public_id:
+            return
+        try:
+            self.backend.set(public_id, b'1')
+        except Exception:
+            # the change is already committed - don't fail the request over
+            # it, the user may just see a stale replica for a moment
+            self.errors += 1
+            logger.warning("could not pin [%s] to the primary", public_id, exc_info=True)
+
+    def is_pinned(self, public_id):
+        if self.backend is None or not public_id:
+            return False
+        try:
+            return self.backend.get(public_id) is not None
+        except Exception:
+            # can't tell - the primary is always safe to read from
+            self.errors += 1
+            return True
+
+
+class RoutingSession(SignallingSession):
+
+    def __init__(self, db, **options):
+        self.db = db
+        super(RoutingSession, self).__init__(db, **options)
+
+    def get_bind(self, mapper=None, clause=None):
+        # flushes and insert, update or delete statements always go to the
+        # primary - even from a GET request
+        if not self._flushing and not isinstance(clause, UpdateBase):
+            bind_key = _read_bind(self.db, self.app)
+            if bind_key is not None:
+                return self.db.get_engine(self.app, bind=bind_key)
+        return super(RoutingSession, self).get_bind(mapper, clause)
+
+
+def _read_bind(db, app):
+    # returns the replica bind to read from or None for the primary
+    if not has_request_context() or request.method not in ('GET', 'HEAD'):
+        return None
+
+    environ = request.environ
+    if READ_BIND_KEY not in environ:
+        replicas = db.replica_binds(app)
+        if not replicas or db.primary_pins.is_pinned(g.get('public_id')):
+            environ[READ_BIND_KEY] = None
+        else:
+            environ[READ_BIND_KEY] = random.choice(replicas)
+    return environ[READ_BIND_KEY]
+
+# -----------------------------------------------------------------------------
+
+class Database(SQLAlchemy):
+
+    def __init__(self, *args, **kwargs):
+        self.primary_pins = PrimaryPins()
+        super(Database, self).__init__(*args, **kwargs)
+
+    def init_app(self, app):
+        binds = dict(app.config.get('SQLALCHEMY_BINDS') or {})
+        for number, uri in enumerate(app.config.get('DB_REPLICA_URIS') or []):
+            binds[REPLICA_BIND_PREFIX+str(number)] = uri
+        app.config['SQLALCHEMY_BINDS'] = binds or None
+        super(Database, self).init_app(app)
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def replica_binds(self, app):
+        return sorted(bind_key for bind_key in app.config['SQLALCHEMY_BINDS'] or {}
+                      if bind_key.startswith(REPLICA_BIND_PREFIX))
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super(Database, self).apply_driver_hacks(app, sa_url, options)
+        config = app.config
+        statement_timeout = int(config['DB_STATEMENT_TIMEOUT'])
+
+        if config['DB_PGBOUNCER']:
+            options['poolclass'] = TimedNullPool
+            for option in ('pool_size', 'max_overflow', 'pool_timeout', 'pool_recycle'):
+                options.pop(option, None)
+            if statement_timeout > 0:
+                options['local_statement_timeout'] = statement_timeout
+            return
+
+        options['poolclass'] = TimedQueuePool
+        options['pool_size'] = int(config['DB_POOL_SIZE'])
+        options['max_overflow'] = int(config['DB_MAX_OVERFLOW'])
+        options['pool_timeout'] = float(config['DB_POOL_TIMEOUT'])
+        options['pool_recycle'] = int(config['DB_POOL_RECYCLE'])
+        options['pool_pre_ping'] = bool(config['DB_POOL_PRE_PING'])
+        if statement_timeout > 0:
+            connect_args = options.setdefault('connect_args', {})
+            connect_args['options'] = '-c statement_timeout='+str(statement_timeout)
+
+    def create_engine(self, sa_url, engine_opts):
+        statement_timeout = engine_opts.pop('local_statement_timeout', None)
+        engine = super(Database, self).create_engine(sa_url, engine_opts)
+        if statement_timeout:
+            event.listen(engine, 'begin', _set_local_statement_timeout(statement_timeout))
+        return engine
+
+
+def _set_local_statement_timeout(statement_timeout):
+    sql = 'SET LOCAL statement_timeout = '+str(int(statement_timeout))
+
+    # runs on the raw connection so it is not seen as a statement of its own
+    def begin(connection):
+        cursor = connection.connection.cursor()
+        try:
+            cursor.execute(sql)
+        finally:
+            cursor.close()
+    return begin
@@ -1,9 +1,13 @@
 # app/decorators.py
-from app.services import call_requests
+from app.services import call_requests, ServiceUnavailable
+from app.extensions import token_cache, auth_flight
+from app.cache import MISSING
+from app.metrics import phase
 from functools import wraps
-import os
+import hashlib
+import jwt
 from dotenv import load_dotenv
-from flask import jsonify
+from flask import jsonify, g
 from flask import current_app as appy
 
 load_dotenv()
@@ -22,22 +26,117 @@ def require_access_level(access_level,request): # pragma: no cover
             if not token:
                 return jsonify({ 'message': 'Naughty one!'}), 401
 
-            headers = { 'Content-Type': 'application/json', 'x-access-token': token }
-            url = os.getenv('CHECK_ACCESS_URL')+'/authy/checkaccess/'+str(access_level)
-            #appy.logger.info("URL IS [%s]", url)
-            r = call_requests(url, headers)
-            #appy.logger.info("RET STAT CODE IS [%s]", r.status_code)
+            try:
+                with phase('auth'):
+                    pub_id = check_access(token, access_level)
+            except AccessDenied as denied:
+                return jsonify({ 'message': denied.message }), denied.status_code
 
-            if r.status_code != 200:
-                return jsonify({ 'message': 'Ooh you are naughty!'}), 401
+            # lets the database session send this user's reads to the primary
+            # just after they have made a change - see app/database.py
+            g.public_id = pub_id
+            return f(pub_id, request, *args, **kwargs)
 
-            returned_json = r.json()
+        return decorated
+    return actual_decorator
+
+# -----------------------------------------------------------------------------
 
-            if 'public_id' in returned_json:
-                pub_id = returned_json['public_id']
-                return f(pub_id, request, *args, **kwargs)
+class AccessDenied(Exception):
 
-            return jsonify({ 'message': 'No public_id returned'}), 401
+    def __init__(self, message, status_code=401):
+        super(AccessDenied, self).__init__(message)
+        self.message = message
+        self.status_code = status_code
 
-        return decorated
-    return actual_decorator 
+# -----------------------------------------------------------------------------
+# asks authy whether the token has the given access level and returns the
+# public_id for it. answers are cached by a hash of the token and level so
+# a client making several calls in a row only pays for one round trip -
+# rejected tokens are remembered for a much shorter time. if authy can't be
+# reached we answer with a 502 straight away. concurrent checks for the same
+# token and level in a worker wait on one in-flight call and share its answer
+
+def check_access(token, access_level):
+
+    if appy.config['AUTH_VERIFY_MODE'] == 'local':
+        pub_id = _verify_locally(token, access_level)
+        if pub_id is not None:
+            return pub_id
+
+    cache_key = _token_cache_key(token, access_level)
+    pub_id = token_cache.get(cache_key)
+    if pub_id is None:
+        raise AccessDenied('Ooh you are naughty!')
+    if pub_id is not MISSING:
+        return pub_id
+
+    return auth_flight.do(cache_key, lambda: _ask_authy(token, access_level, cache_key))
+
+
+def _ask_authy(token, access_level, cache_key):
+
+    headers = { 'Content-Type': 'application/json', 'x-access-token': token }
+    url = appy.config['CHECK_ACCESS_URL']+'/authy/checkaccess/'+str(access_level)
+    #appy.logger.info("URL IS [%s]", url)
+    try:
+        r = call_requests(url, headers)
+    except ServiceUnavailable as err:
+        appy.logger.error("authy unavailable [%s]", err)
+        raise AccessDenied('oopsy, sorry we couldn\'t complete your request', 502)
+    #appy.logger.info("RET STAT CODE IS [%s]", r.status_code)
+
+    if r.status_code != 200:
+        if r.status_code == 401:
+            token_cache.set(cache_key, None, ttl=appy.config['AUTH_CACHE_NEGATIVE_TTL'])
+        raise AccessDenied('Ooh you are naughty!')
+
+    returned_json = r.json()
+
+    if 'public_id' in returned_json:
+        pub_id = returned_json['public_id']
+        token_cache.set(cache_key, pub_id)
+        return pub_id
+
+    raise AccessDenied('No public_id returned')
+
+
+# -----------------------------------------------------------------------------
+# checks the jwt signature, expiry and access level claim ourselves using the
+# configured shared secret or public key. returns None for any token we can't
+# vouch for so the caller can fall back to asking authy. lower access levels
+# are more privileged - admins are 5 and ordinary users 10
+
+def _verify_locally(token, access_level):
+
+    key = appy.config['JWT_PUBLIC_KEY'] or appy.config['JWT_SECRET_KEY']
+    if not key:
+        return None
+
+    try:
+        claims = jwt.decode(token, key, algorithms=appy.config['JWT_ALGORITHMS'])
+    except (jwt.ExpiredSignatureError, jwt.ImmatureSignatureError):
+        raise AccessDenied('Ooh you are naughty!')
+    except jwt.PyJWTError:
+        # bad tokens, and keys that don't suit the algorithm (InvalidKeyError)
+        return None
+
+    pub_id = claims.get(appy.config['JWT_PUBLIC_ID_CLAIM'])
+    token_level = claims.get(appy.config['JWT_ACCESS_LEVEL_CLAIM'])
+    if 'exp' not in claims or not pub_id or token_level is None:
+        return None
+
+    try:
+        token_level = int(token_level)
+    except (TypeError, ValueError):
+        return None
+
+    if token_level > int(access_level):
+        raise AccessDenied('Ooh you are naughty!')
+
+    return pub_id
+
+
+def _token_cache_key(token, access_level):
+    # never keep raw tokens in memory longer than we have to
+    return hashlib.sha256((str(access_level)+':'+token).encode('utf-8')).hexdigest()
@@ -1,16 +1,24 @@
 # app/extensions.py
-from flask_sqlalchemy import SQLAlchemy
 from flask_limiter import Limiter
 from flask_migrate import Migrate
 from flask_uuid import FlaskUUID
 from flask_limiter.util import get_remote_address
+from app.cache import TTLCache, SingleFlight, ResponseCache
+from app.database import Database
+# registers the shared rate limit storages with limits
+import app.ratelimit
 
 # -----------------------------------------------------------------------------
-# set up SQL alchemy
-db = SQLAlchemy()
+# set up SQL alchemy - engine and pool options come from config, see
+# app/database.py
+db = Database()
+
+# users reading from the primary after a change - see app/database.py
+primary_pins = db.primary_pins
 
 # -----------------------------------------------------------------------------
-# set up rate limiting
+# set up rate limiting - counters are kept in RATELIMIT_STORAGE_URL, see
+# app/ratelimit.py for the shared storages
 limiter = Limiter(key_func=get_remote_address,
                   default_limits=["50 per minute", "5 per second"])
 
@@ -21,3 +29,15 @@ migrate = Migrate()
 # -----------------------------------------------------------------------------
 # set up flask uuid regex in url finder
 flask_uuid = FlaskUUID()
+
+# -----------------------------------------------------------------------------
+# set up cache of authy answers - sized from config in create_app
+token_cache = TTLCache()
+
+# -----------------------------------------------------------------------------
+# set up coalescing of concurrent identical authy calls
+auth_flight = SingleFlight()
+
+# -----------------------------------------------------------------------------
+# set up per user cache of address lists - backend chosen in create_app
+address_cache = ResponseCache()
@@ -0,0 +1,188 @@
+# app/logs.py
+from flask import g, has_request_context
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+import atexit
+import datetime
+import json
+import logging
+import os
+import queue
+import random
+import threading
+
+# -----------------------------------------------------------------------------
+# log records are put on an in-memory queue by the request thread and written
+# to disk by a background listener, so a log call never waits on the disk or
+# on rotation. if the queue fills up (the disk can't keep up) records are
+# dropped and counted rather than blocking requests.
+#
+#   LOG_FORMAT=json      one json object per line instead of the text format
+#   LOG_SAMPLE_RATES     e.g. DEBUG=0.1,INFO=0.5 - share of records kept at
+#                        each level, anything not listed is always kept
+#
+# every record logged during a request carries its request id - the same id
+# returned in the X-Trace-Id header (see app/tracing.py)
+# -----------------------------------------------------------------------------
+
+TEXT_FORMAT = "[%(asctime)s] [%(request_id)s] [%(pathname)s:%(lineno)d] %(levelname)s - %(message)s"
+
+class JsonFormatter(logging.Formatter):
+
+    def format(self, record):
+        output = { 'time': datetime.datetime.utcfromtimestamp(record.created).isoformat()+'Z',
+                   'level': record.levelname,
+                   'logger': record.name,
+                   'message': record.getMessage(),
+                   'request_id': getattr(record, 'request_id', None),
+                   'source': record.pathname+':'+str(record.lineno) }
+        if record.exc_info:
+            output['exception'] = self.formatException(record.exc_info)
+        return json.dumps(output)
+
+
+class RequestIdFilter(logging.Filter):
+
+    # runs on the request thread - the listener thread has no request
+
+    def filter(self, record):
+        request_id = None
+        if has_request_context():
+            trace = g.get('trace')
+            if trace is not None:
+                request_id = trace.trace_id
+        record.request_id = request_id or '-'
+        return True
+
+
+class SamplingFilter(logging.Filter):
+
+    def __init__(self, rates):
+        super(SamplingFilter, self).__init__()
+        self.rates = rates
+
+    def filter(self, record):
+        rate = self.rates.get(record.levelno)
+        return rate is None or random.random() < rate
+
+
+def parse_sample_rates(text):
+    # 'DEBUG=0.1,INFO=0.5' -> { 10: 0.1, 20: 0.5 }
+    rates = {}
+    for item in (text or '').split(','):
+        if '=' not in item:
+            continue
+        level, rate = item.split('=', 1)
+        levelno = logging.getLevelName(level.strip().upper())
+        if isinstance(levelno, int):
+            rates[levelno] = float(rate)
+    return rates
+
+
+class DroppingQueueHandler(QueueHandler):
+
+    def __init__(self, log_queue, pipeline):
+        super(DroppingQueueHandler, self).__init__(log_queue)
+        self.pipeline = pipeline
+        self.dropped = 0
+
+    def prepare(self, record):
+        # the record is only read in this process so it can go on the queue
+        # as it is - just fix the message now in case its args change later
+        record.msg = record.getMessage()
+        record.args = None
+        return record
+
+    def enqueue(self, record):
+        self.pipeline.ensure_listener()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class LogPipeline(object):
+
+    def __init__(self):
+        self.handler = None
+        self.listener = None
+        self._targets = []
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def configure(self, app):
+        config = app.config
+        self.stop()
+
+        if config['LOG_FORMAT'] == 'json':
+            formatter = JsonFormatter()
+        else:
+            formatter = logging.Formatter(TEXT_FORMAT)
+
+        targets = []
+        file_handler = RotatingFileHandler(config['LOG_FILENAME'], maxBytes=10000000, backupCount=5)
+        file_handler.setFormatter(formatter)
+        targets.append(file_handler)
+
+        # slow sql gets a file of its own as well as going in the main log
+        slow_filename = config['SQL_SLOW_LOG_FILENAME']
+        if slow_filename:
+            slow_handler = RotatingFileHandler(slow_filename, maxBytes=10000000, backupCount=5)
+            slow_handler.setFormatter(formatter)
+            slow_handler.addFilter(logging.Filter('app.sql.slow'))
+            targets.append(slow_handler)
+
+        log_queue = queue.Queue(maxsize=int(config['LOG_QUEUE_SIZE']))
+        handler = DroppingQueueHandler(log_queue, self)
+        handler.addFilter(SamplingFilter(parse_sample_rates(config['LOG_SAMPLE_RATES'])))
+        handler.addFilter(RequestIdFilter())
+
+        # app.logger is flask.app, so the app.* loggers (app.sql, app.tracing
+        # and so on) need the handler and LOG_LEVEL as well. both loggers are
+        # shared by every app made in this process - replace the handler from
+        # any earlier configure rather than adding another
+        package_logger = logging.getLogger('app')
+        package_logger.setLevel(app.logger.level)
+        for logger in (app.logger, package_logger):
+            if self.handler is not None:
+                logger.removeHandler(self.handler)
+            logger.addHandler(handler)
+        self.handler = handler
+        self._targets = targets
+        self.ensure_listener()
+
+    def ensure_listener(self):
+        # (re)starts the listener - also after a fork, which doesn't copy threads
+        if self.listener is not None and self._pid == os.getpid():
+            return
+        with self._lock:
+            if self.handler is None or (self.listener is not None and self._pid == os.getpid()):
+                return
+            self._pid = os.getpid()
+            self.listener = QueueListener(self.handler.queue, *self._targets,
+                                          respect_handler_level=True)
+            self.listener.start()
+
+    def flush(self):
+        # waits for everything queued so far to be written
+        self._stop_listener()
+        self.ensure_listener()
+
+    def stop(self):
+        self._stop_listener()
+        for target in self._targets:
+            target.close()
+
+    def _stop_listener(self):
+        with self._lock:
+            if self.listener is not None and self._pid == os.getpid():
+                self.listener.stop()
+            self.listener = None
+
+    @property
+    def dropped(self):
+        return self.handler.dropped if self.handler is not None else 0
+
+
+log_pipeline = LogPipeline()
+
+atexit.register(log_pipeline.stop)
@@ -2,4 +2,15 @@ from flask import Blueprint
 
 bp = Blueprint('main', __name__)
 
+# registered before the views so every request to the blueprint is timed.
+# the profiler goes first so its profile covers the other hooks too
+from app.profiler import request_profiler
+from app.metrics import request_metrics
+from app.querylog import query_log
+from app.tracing import tracer
+request_profiler.init_blueprint(bp)
+request_metrics.init_blueprint(bp)
+query_log.init_blueprint(bp)
+tracer.init_blueprint(bp)
+
 from app.main import views
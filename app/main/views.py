@@ -1,14 +1,28 @@
 # app/main/views.py
 from app import limiter, db, flask_uuid
-from flask import jsonify, request, abort
+from app.extensions import address_cache, token_cache, auth_flight, primary_pins
+from flask import jsonify, request, abort, stream_with_context
 from flask import current_app as app
 from app.main import bp
 from app.models import Country, Address
 from app.decorators import require_access_level
 from app.assertions import assert_valid_schema
-from sqlalchemy.exc import SQLAlchemyError
+from app.countries import country_cache
+from app.database import pool_stats
+from app.metrics import request_metrics
+from app.counts import count_addresses, adjust_address_count, COUNT_STRATEGIES
+from app.serializers import address_serializer, one_address_serializer, dumps, json_response
+from app.queries import run, USER_ADDRESSES, ONE_ADDRESS, MANY_ADDRESSES, \
+                        ADMIN_ADDRESSES_AFTER, ADMIN_ADDRESSES_PAGE, INSERT_ADDRESS, \
+                        delete_address_query, export_addresses_query
+from sqlalchemy.exc import SQLAlchemyError, DBAPIError
 from jsonschema.exceptions import ValidationError as JsonValidationError
 import uuid
+import base64
+import csv
+import io
+import datetime
+from dateutil.parser import isoparse
 
 # reject any non-json requests
 @bp.before_request
@@ -26,27 +40,25 @@ def system_running():
     return jsonify({ 'message': 'System running...' }), 200
 
 # -----------------------------------------------------------------------------
-# returns a list of addresses for the authenticated user
+# returns a list of addresses for the authenticated user. a user's addresses
+# only change through the create and delete routes so the serialized list is
+# cached per public_id and dropped by those routes
 
 @bp.route('/address', methods=['GET'])
 @limiter.limit("20/hour")
 @require_access_level(10, request)
 def get_all_addresses_for_user(public_id, request):
 
+    cached = address_cache.get(public_id)
+    if cached is not None:
+        return app.response_class(cached, status=200, mimetype='application/json')
+
+    # taken before the read so a create or delete that lands while we read
+    # stops this list being cached - see app/cache.py
+    version = address_cache.version(public_id)
     addresses = []
     try:
-        addresses = db.session.query(Address.address_id,
-                                     Address.house_name,
-                                     Address.house_number,
-                                     Address.address_line_1,
-                                     Address.address_line_2,
-                                     Address.address_line_3,
-                                     Address.state_region_county,
-                                     Country.name,
-                                     Country.iso_code,
-                                     Address.post_zip_code).join(Country)\
-                                                           .filter(Address.public_id == public_id)\
-                                                           .all()
+        addresses = run(USER_ADDRESSES, public_id=public_id).fetchall()
 
     except: 
         jsonify({ 'message': 'oopsy, sorry we couldn\'t complete your request' }), 502
@@ -54,22 +66,9 @@ def get_all_addresses_for_user(public_id, request):
     if len(addresses) == 0:
         return jsonify({ 'message': 'no addresses found for user' }), 404
 
-    adds = []
-    for address in addresses:
-        address_data = {}
-        address_data['address_id'] = address.address_id
-        address_data['house_name'] = address.house_name
-        address_data['house_number'] = address.house_number
-        address_data['address_line_1'] = address.address_line_1
-        address_data['address_line_2'] = address.address_line_2
-        address_data['address_line_3'] = address.address_line_3
-        address_data['state_region_county'] = address.state_region_county
-        address_data['country'] = address.name
-        address_data['country_code'] = address.iso_code
-        address_data['post_zip_code'] = address.post_zip_code
-        adds.append(address_data)
-
-    return jsonify({ 'addresses': adds }), 200
+    body = dumps({ 'addresses': address_serializer.many(addresses) })
+    address_cache.set(public_id, body, version)
+    return app.response_class(body, status=200, mimetype='application/json')
 
 # -----------------------------------------------------------------------------
 # creates an address for the authenticated user
@@ -85,40 +84,127 @@ def get_create_address_for_user(public_id, request):
     except:
         return jsonify({ 'message': 'Check ya inputs mate. Yer not valid, Jason'}), 400
 
-    # validate input against json schemas
+    # check the country against the in memory index and the rest of the
+    # input against the address schema for that country
+    iso_code = data.get('iso_code')
+    country = country_cache.lookup(iso_code)
+    if country is None:
+        return jsonify({ 'message': 'Check ya inputs mate.', 'error': _unknown_country(iso_code) }), 400
+
     try:
-        country_data = { 'iso_code': data.get('iso_code') }
-        assert_valid_schema(country_data, 'country')
         assert_valid_schema(data, 'address')
 
     except JsonValidationError as err:
         return jsonify({ 'message': 'Check ya inputs mate.', 'error': err.message }), 400
 
-    country = Country.query.filter_by(iso_code = country_data.get('iso_code')).first()
-    address = Address(public_id = public_id,
-                      address_id = str(uuid.uuid4()),
-                      house_name = data.get('house_name'),
-                      house_number = data.get('house_number'),
-                      address_line_1 = data.get('address_line_1'),
-                      address_line_2 = data.get('address_line_2'),
-                      address_line_3 = data.get('address_line_3'),
-                      state_region_county = data.get('state_region_county'),
-                      post_zip_code = data.get('post_zip_code'),
-                      country_id = country.id)
+    country_id = country[0]
+    address_id = str(uuid.uuid4())
 
     try:
-        db.session.add(address)
-        db.session.flush()
+        run(INSERT_ADDRESS, public_id = public_id,
+                            address_id = address_id,
+                            house_name = data.get('house_name'),
+                            house_number = data.get('house_number'),
+                            address_line_1 = data.get('address_line_1'),
+                            address_line_2 = data.get('address_line_2'),
+                            address_line_3 = data.get('address_line_3'),
+                            state_region_county = data.get('state_region_county'),
+                            post_zip_code = data.get('post_zip_code'),
+                            country_id = country_id)
+        adjust_address_count(1)
         db.session.commit()
     except (SQLAlchemyError, DBAPIError) as e:
         db.session.rollback()
         return jsonify({ 'message': 'oopsy, something went wrong at our end' }), 422
+
+    address_cache.invalidate(public_id)
+    primary_pins.pin(public_id)
    
     message = {}
     message['message'] = 'address created successfully'
-    message['address_id'] = address.address_id
+    message['address_id'] = address_id
     return jsonify( message ), 201
 
+# -----------------------------------------------------------------------------
+# creates many addresses for the authenticated user in one go. each address is
+# checked on its own against the country index and address schemas and the
+# valid ones are written with a single multi row insert in one transaction.
+# results are reported per address in input order
+
+@bp.route('/address/batch', methods=['POST'])
+@limiter.limit("10/hour")
+@require_access_level(10, request)
+def create_address_batch_for_user(public_id, request):
+
+    # check input is valid json
+    try:
+        data = request.get_json()
+    except:
+        return jsonify({ 'message': 'Check ya inputs mate. Yer not valid, Jason'}), 400
+
+    items = data.get('addresses') if isinstance(data, dict) else None
+    batch_limit = int(app.config['ADDRESS_BATCH_LIMIT'])
+    if not isinstance(items, list) or len(items) == 0 or len(items) > batch_limit:
+        message = 'expected a list of between 1 and '+str(batch_limit)+' addresses'
+        return jsonify({ 'message': 'Check ya inputs mate.', 'error': message }), 400
+
+    results = []
+    rows = []
+    created = datetime.datetime.utcnow()
+    for index, item in enumerate(items):
+        if not isinstance(item, dict):
+            results.append({ 'index': index, 'error': 'address must be a json object' })
+            continue
+
+        item = dict(item)
+        country = country_cache.lookup(item.get('iso_code'))
+        if country is None:
+            results.append({ 'index': index, 'error': _unknown_country(item.get('iso_code')) })
+            continue
+
+        try:
+            assert_valid_schema(item, 'address')
+        except JsonValidationError as err:
+            results.append({ 'index': index, 'error': err.message })
+            continue
+
+        country_id = country[0]
+
+        address_id = str(uuid.uuid4())
+        rows.append({ 'address_id': address_id,
+                      'public_id': public_id,
+                      'house_name': item.get('house_name'),
+                      'house_number': item.get('house_number'),
+                      'address_line_1': item.get('address_line_1'),
+                      'address_line_2': item.get('address_line_2'),
+                      'address_line_3': item.get('address_line_3'),
+                      'state_region_county': item.get('state_region_county'),
+                      'post_zip_code': item.get('post_zip_code'),
+                      'country_id': country_id,
+                      'created': created })
+        results.append({ 'index': index, 'address_id': address_id })
+
+    if rows:
+        try:
+            db.session.execute(Address.__table__.insert().values(rows))
+            adjust_address_count(len(rows))
+            db.session.commit()
+        except (SQLAlchemyError, DBAPIError) as e:
+            db.session.rollback()
+            return jsonify({ 'message': 'oopsy, something went wrong at our end' }), 422
+        address_cache.invalidate(public_id)
+        primary_pins.pin(public_id)
+
+    message = {}
+    message['message'] = str(len(rows))+' of '+str(len(items))+' addresses created'
+    message['results'] = results
+    if rows:
+        return jsonify( message ), 201
+    return jsonify( message ), 400
+
+def _unknown_country(iso_code):
+    return repr(iso_code)+' is not a known iso_code'
+
 # -----------------------------------------------------------------------------
 # returns an individual address - returns 401 if not authorized on that
 # address uuid
@@ -132,17 +218,7 @@ def get_one_address(public_id, request, address_id):
     address_id = str(address_id)
     address = None
     try:
-        address = db.session.query(Address.house_name,
-                                   Address.house_number,
-                                   Address.address_line_1,
-                                   Address.address_line_2,
-                                   Address.address_line_3,
-                                   Address.state_region_county,
-                                   Country.name,
-                                   Country.iso_code,
-                                   Address.post_zip_code).join(Country)\
-                                                         .filter(Address.address_id == address_id)\
-                                                         .first()
+        address = run(ONE_ADDRESS, address_id=address_id).first()
     except:
         return jsonify({ 'message': 'oopsy, sorry we couldn\'t complete your request' }), 502
 
@@ -150,20 +226,60 @@ def get_one_address(public_id, request, address_id):
         message = "no addresses found for supplied id ["+address_id+"]"
         return jsonify({ 'message': message }), 404
 
-    # i prefer to explicitly assign variables returned to ensure no 
+    # only fields in the serializer mapping are returned so there is no
     # accidental exposure of private data
-    address_data = {}
-    address_data['house_name'] = address.house_name
-    address_data['house_number'] = address.house_number
-    address_data['address_line_1'] = address.address_line_1
-    address_data['address_line_2'] = address.address_line_2
-    address_data['address_line_3'] = address.address_line_3
-    address_data['state_region_county'] = address.state_region_county
-    address_data['country'] = address.name
-    address_data['country_code'] = address.iso_code
-    address_data['post_zip_code'] = address.post_zip_code
-
-    return jsonify(address_data), 200
+    return json_response(one_address_serializer.one(address))
+
+# -----------------------------------------------------------------------------
+# returns many addresses in one go - ids are passed as ?ids=<uuid>,<uuid> on
+# a GET or as {"address_ids": [...]} in a POST body. ids with no address are
+# listed under not_found
+
+@bp.route('/address/multi', methods=['GET', 'POST'])
+@limiter.limit("100/hour")
+@require_access_level(10, request)
+def get_many_addresses(public_id, request):
+
+    if request.method == 'POST':
+        data = request.get_json(silent=True)
+        address_ids = data.get('address_ids') if isinstance(data, dict) else None
+    else:
+        address_ids = [ids for ids in request.args.get('ids', '').split(',') if ids]
+
+    multi_get_limit = int(app.config['ADDRESS_MULTI_GET_LIMIT'])
+    if not isinstance(address_ids, list) or len(address_ids) == 0 or \
+       len(address_ids) > multi_get_limit:
+        message = 'expected a list of between 1 and '+str(multi_get_limit)+' address ids'
+        return jsonify({ 'message': 'Check ya inputs mate.', 'error': message }), 400
+
+    # normalise to the canonical uuid strings we store, keeping input order
+    wanted = []
+    for address_id in address_ids:
+        try:
+            address_id = str(uuid.UUID(address_id))
+        except (TypeError, ValueError, AttributeError):
+            return jsonify({ 'message': 'Check ya inputs mate.', 'error': 'invalid address id' }), 400
+        if address_id not in wanted:
+            wanted.append(address_id)
+
+    try:
+        addresses = run(MANY_ADDRESSES, address_ids=wanted).fetchall()
+    except:
+        return jsonify({ 'message': 'oopsy, sorry we couldn\'t complete your request' }), 502
+
+    found = {}
+    for address_data in address_serializer.many(addresses):
+        found[address_data['address_id']] = address_data
+
+    output = {}
+    output['addresses'] = [found[address_id] for address_id in wanted if address_id in found]
+    output['not_found'] = [address_id for address_id in wanted if address_id not in found]
+
+    if len(found) == 0:
+        output['message'] = 'no addresses found for supplied ids'
+        return json_response(output, 404)
+
+    return json_response(output)
 
 # -----------------------------------------------------------------------------
 # deletes an address for the authenticated user
@@ -175,13 +291,17 @@ def delete_address_for_user(public_id, request, address_id):
 
     address_id = str(address_id)
     try:
-        result = Address.query.filter(Address.address_id == address_id)\
-                              .filter(Address.public_id == public_id)\
-                              .delete()
+        result = delete_address_query(address_id, public_id).delete()
+        if result:
+            adjust_address_count(-result)
+        db.session.commit()
     except SQLAlchemyError as err:
+        db.session.rollback()
         return jsonify({ 'message': 'naughty, naughty' }), 401
 
     if result:
+        address_cache.invalidate(public_id)
+        primary_pins.pin(public_id)
         return '', 204
 
     return jsonify({ 'message': 'nope sorry, that\'s not happening today' }), 401
@@ -193,51 +313,69 @@ def delete_address_for_user(public_id, request, address_id):
 @limiter.limit("100/hour")
 def list_countries():
 
-    countries = []
-    results = Country.query.all()
+    # payload is built once per process - see app/countries.py
+    body, etag = country_cache.payload()
 
-    for country in results:
-        country_data = {}
-        country_data['name'] = country.name
-        country_data['iso_code'] = country.iso_code
-        countries.append(country_data)
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        response = app.response_class(body, status=200, mimetype='application/json')
 
-    return jsonify({ 'countries': countries }), 200
+    response.set_etag(etag)
+    response.cache_control.public = True
+    if country_cache.index():
+        response.cache_control.max_age = int(app.config['COUNTRIES_MAX_AGE'])
+    else:
+        # countries not loaded yet - don't let clients hang on to an empty list
+        response.cache_control.no_cache = True
+    return response
 
 # -----------------------------------------------------------------------------
 # admin routes
 # -----------------------------------------------------------------------------
 
 # -----------------------------------------------------------------------------
-# get all addresses - paginated - limited in config at present
+# get all addresses - paginated - limited in config at present. pages are
+# walked with an opaque cursor on Address.id so every page is a single index
+# range scan however deep it is. the old ?page=n style is still supported.
+# ?count= picks how total_records is worked out - see app/counts.py
+
 @bp.route('/address/admin/address', methods=['GET'])
 @limiter.limit("100/hour")
 @require_access_level(5, request)
 def get_all_addresses_admin_method(public_id, request):
 
     # pagination allowed on this url
-    page = request.args.get('page', 1, type=int)
+    page = request.args.get('page', None, type=int)
+    cursor = request.args.get('cursor')
+
+    count_strategy = request.args.get('count', app.config['ADDRESS_COUNT_STRATEGY'])
+    if count_strategy not in COUNT_STRATEGIES:
+        return jsonify({ 'message': 'Check ya inputs mate.', 'error': 'invalid count strategy' }), 400
+
+    after_id = 0
+    if cursor:
+        after_id = _decode_cursor(cursor)
+        if after_id is None:
+            return jsonify({ 'message': 'Check ya inputs mate.', 'error': 'invalid cursor' }), 400
 
     addresses = []
     total_records = 0
+    more_records = False
     addresses_per_page = int(app.config['ADDRESS_LIMIT_PER_PAGE'])
     try:
-        total_records = db.session.query(Address).count() 
-
-        addresses = db.session.query(Address.address_id,
-                                     Address.public_id,
-                                     Address.house_name,
-                                     Address.house_number,
-                                     Address.address_line_1,
-                                     Address.address_line_2,
-                                     Address.address_line_3,
-                                     Address.state_region_county,
-                                     Country.name,
-                                     Country.iso_code,
-                                     Address.post_zip_code)\
-                                            .join(Country)\
-                                            .paginate(page,\
-                                                      addresses_per_page, False).items
+        total_records, count_strategy = count_addresses(count_strategy)
+
+        if page is not None:
+            offset = (max(page, 1) - 1) * addresses_per_page
+            addresses = run(ADMIN_ADDRESSES_PAGE, offset=offset,
+                                                  limit=addresses_per_page).fetchall()
+        else:
+            # fetch one extra row to find out if there is a next page
+            addresses = run(ADMIN_ADDRESSES_AFTER, after_id=after_id,
+                                                   limit=addresses_per_page + 1).fetchall()
+            more_records = len(addresses) > addresses_per_page
+            addresses = addresses[:addresses_per_page]
 
     except:
         return jsonify({ 'message': 'oopsy, sorry we couldn\'t complete your request' }), 500
@@ -245,23 +383,15 @@ def get_all_addresses_admin_method(public_id, request):
     if len(addresses) == 0:
         return jsonify({ 'message': 'no addresses found for user' }), 404
 
-    adds = []
-    for address in addresses:
-        address_data = {}
-        address_data['address_id'] = address.address_id
-        address_data['house_name'] = address.house_name
-        address_data['house_number'] = address.house_number
-        address_data['address_line_1'] = address.address_line_1
-        address_data['address_line_2'] = address.address_line_2
-        address_data['address_line_3'] = address.address_line_3
-        address_data['state_region_county'] = address.state_region_county
-        address_data['country'] = address.name
-        address_data['country_code'] = address.iso_code
-        address_data['post_zip_code'] = address.post_zip_code
-        adds.append(address_data)
-
-    output = { 'addresses': adds }
+    output = { 'addresses': address_serializer.many(addresses) }
     output['total_records'] = total_records
+    output['total_records_strategy'] = count_strategy
+
+    if page is None:
+        if more_records:
+            output['next_url'] = '/address/admin/address?cursor='+_encode_cursor(addresses[-1].id)
+        return json_response(output)
+
     total_so_far = page * addresses_per_page
     
     if total_so_far < total_records:
@@ -272,8 +402,136 @@ def get_all_addresses_admin_method(public_id, request):
         ppage = page - 1
         output['prev_url'] = '/address/admin/address?page='+str(ppage)
 
+    return json_response(output)
+
+# cursors are just the last id seen on the page - encoded so clients treat
+# them as opaque and we are free to change what's in them later
+
+def _encode_cursor(last_id):
+    return base64.urlsafe_b64encode(str(last_id).encode('utf-8')).decode('ascii').rstrip('=')
+
+def _decode_cursor(cursor):
+    try:
+        padding = '=' * (-len(cursor) % 4)
+        return int(base64.urlsafe_b64decode((cursor + padding).encode('ascii')))
+    except (ValueError, TypeError):
+        return None
+
+# -----------------------------------------------------------------------------
+# streams every address as ndjson (default) or csv. rows come off a server side
+# cursor in batches so memory stays flat however big the table gets. pass
+# ?created=<iso 8601 datetime> to only get addresses created since then
+
+EXPORT_FIELDS = ['address_id', 'public_id', 'house_name', 'house_number',
+                 'address_line_1', 'address_line_2', 'address_line_3',
+                 'state_region_county', 'country', 'country_code',
+                 'post_zip_code', 'created']
+
+@bp.route('/address/admin/export', methods=['GET'])
+@limiter.limit("10/hour")
+@require_access_level(5, request)
+def export_addresses_admin_method(public_id, request):
+
+    export_format = request.args.get('format', 'ndjson')
+    if export_format not in ('ndjson', 'csv'):
+        return jsonify({ 'message': 'Check ya inputs mate.', 'error': 'format must be ndjson or csv' }), 400
+
+    created_since = None
+    if request.args.get('created'):
+        try:
+            created_since = isoparse(request.args.get('created'))
+        except ValueError:
+            return jsonify({ 'message': 'Check ya inputs mate.', 'error': 'created must be an iso 8601 datetime' }), 400
+        # created is stored as naive utc
+        if created_since.tzinfo is not None:
+            created_since = created_since.astimezone(datetime.timezone.utc).replace(tzinfo=None)
+
+    batch_size = int(app.config['EXPORT_BATCH_SIZE'])
+    query = export_addresses_query(created_since)
+    rows = query.execution_options(stream_results=True).yield_per(batch_size)
+
+    if export_format == 'csv':
+        body = _export_csv(rows, batch_size)
+        mimetype = 'text/csv'
+    else:
+        body = _export_ndjson(rows, batch_size)
+        mimetype = 'application/x-ndjson'
+
+    response = app.response_class(stream_with_context(body), status=200, mimetype=mimetype)
+    response.headers['Content-Disposition'] = 'attachment; filename=addresses.'+export_format
+    return response
+
+def _export_row(address):
+    row = [getattr(address, field) for field in EXPORT_FIELDS]
+    row[-1] = address.created.isoformat()
+    return row
+
+def _export_ndjson(rows, batch_size):
+    lines = []
+    for address in rows:
+        lines.append(dumps(dict(zip(EXPORT_FIELDS, _export_row(address)))))
+        if len(lines) >= batch_size:
+            yield b'\n'.join(lines) + b'\n'
+            lines = []
+    if lines:
+        yield b'\n'.join(lines) + b'\n'
+
+def _export_csv(rows, batch_size):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_FIELDS)
+    count = 0
+    for address in rows:
+        writer.writerow(_export_row(address))
+        count += 1
+        if count % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+# -----------------------------------------------------------------------------
+# hit ratios and staleness of this worker's caches
+
+@bp.route('/address/admin/cache', methods=['GET'])
+@limiter.limit("100/hour")
+@require_access_level(5, request)
+def cache_stats_admin_method(public_id, request):
+
+    output = {}
+    output['addresses'] = address_cache.stats()
+    output['tokens'] = token_cache.stats()
+    output['auth_calls'] = auth_flight.stats()
+    return jsonify(output), 200
+
+# -----------------------------------------------------------------------------
+# returns connection pool stats for this worker - connections in use and how
+# long requests have waited to check one out
+
+@bp.route('/address/admin/pool', methods=['GET'])
+@limiter.limit("100/hour")
+@require_access_level(5, request)
+def pool_stats_admin_method(public_id, request):
+
+    output = {}
+    output['default'] = pool_stats(db.engine)
+    for bind_key in db.replica_binds(app):
+        output[bind_key] = pool_stats(db.get_engine(app, bind=bind_key))
     return jsonify(output), 200
 
+# -----------------------------------------------------------------------------
+# returns request counts, latency histograms and per phase timings for every
+# route in prometheus text format - added up over all workers when
+# METRICS_DIR is set
+
+@bp.route('/address/admin/metrics', methods=['GET'])
+@limiter.limit("100/hour")
+@require_access_level(5, request)
+def metrics_admin_method(public_id, request):
+
+    return app.response_class(request_metrics.render(), status=200,
+                              mimetype='text/plain; version=0.0.4')
+
 # -----------------------------------------------------------------------------
 # route for testing rate limit works - generates 429 if more than two calls
 # per minute to this route - restricted to admin users and above
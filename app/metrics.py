@@ -0,0 +1,388 @@
+# app/metrics.py
+from app.tracing import tracer
+from flask import g, request, has_request_context
+from contextlib import contextmanager
+import atexit
+import fcntl
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+# -----------------------------------------------------------------------------
+# per route request metrics - counts by status class, latency histograms and
+# how long each request spent in each phase:
+#   auth          - the access check in require_access_level
+#   validation    - assert_valid_schema
+#   db            - executing sql statements - timed in app/querylog.py
+#   serialization - turning rows into json
+#
+# histograms use fixed buckets so they can be added up across gunicorn
+# workers. with METRICS_DIR set a background thread in each worker writes its
+# totals to METRICS_DIR/metrics_<pid>_<id>.json every METRICS_FLUSH_INTERVAL
+# seconds and the metrics route adds up every file it finds. the id is new
+# for each process so a recycled worker that is given an old pid can't
+# overwrite the totals of the worker it replaced. files that haven't been
+# written for DEAD_AFTER flush intervals belong to workers that have exited -
+# their totals are merged into METRICS_DIR/archive.json so counters never go
+# backwards and the directory doesn't fill up. without METRICS_DIR only this
+# worker is reported
+# -----------------------------------------------------------------------------
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+QUANTILES = (0.5, 0.95, 0.99)
+
+# a worker file untouched for this many flush intervals (and at least a
+# minute) is from a worker that has exited
+DEAD_AFTER = 10
+
+ARCHIVE_FILE = 'archive.json'
+
+logger = logging.getLogger('app.metrics')
+
+
+class Histogram(object):
+
+    def __init__(self, counts=None, total=0.0):
+        # counts[i] is the number of observations in bucket i - the last one
+        # is everything over the largest bucket
+        self.counts = list(counts) if counts is not None else [0] * (len(BUCKETS) + 1)
+        self.total = total
+
+    def observe(self, seconds):
+        index = 0
+        for bound in BUCKETS:
+            if seconds <= bound:
+                break
+            index += 1
+        self.counts[index] += 1
+        self.total += seconds
+
+    def merge(self, other):
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, other.counts)]
+        self.total += other.total
+
+    @property
+    def count(self):
+        return sum(self.counts)
+
+    def quantile(self, q):
+        # estimated the same way as prometheus' histogram_quantile - linear
+        # within the bucket the quantile falls in
+        count = self.count
+        if count == 0:
+            return 0.0
+        rank = q * count
+        seen = 0
+        lower = 0.0
+        for index, bucket_count in enumerate(self.counts):
+            if index == len(BUCKETS):
+                return BUCKETS[-1]
+            upper = BUCKETS[index]
+            if bucket_count and seen + bucket_count >= rank:
+                return lower + (upper - lower) * (rank - seen) / bucket_count
+            seen += bucket_count
+            lower = upper
+        return BUCKETS[-1]
+
+
+class RequestMetrics(object):
+
+    def __init__(self):
+        self.enabled = True
+        self.directory = None
+        self.flush_interval = 5.0
+        self._lock = threading.Lock()
+        self._flusher = None
+        self._flusher_pid = None
+        self._stop = None
+        self._reset()
+
+    def _reset(self):
+        self.pid = os.getpid()
+        self.filename = 'metrics_'+str(self.pid)+'_'+uuid.uuid4().hex[:12]+'.json'
+        self._requests = {}
+        self._durations = {}
+        self._phases = {}
+
+    def init_app(self, app):
+        self.stop()
+        self.enabled = app.config['METRICS_ENABLED']
+        self.directory = app.config['METRICS_DIR'] or None
+        self.flush_interval = float(app.config['METRICS_FLUSH_INTERVAL'])
+        with self._lock:
+            self._reset()
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            self._ensure_flusher()
+
+    def init_blueprint(self, bp):
+        bp.before_request(self._start_request)
+        bp.after_request(self._end_request)
+        bp.teardown_request(self._teardown_request)
+
+    # -------------------------------------------------------------------------
+    # request hooks
+
+    def _start_request(self):
+        if self.enabled:
+            g.metrics_started = time.perf_counter()
+            g.metrics_phases = {}
+
+    def _end_request(self, response):
+        self._record(response.status_code)
+        return response
+
+    def _teardown_request(self, exc):
+        # after_request is skipped when a view raises
+        if exc is not None:
+            self._record(500)
+
+    def _record(self, status_code):
+        started = g.pop('metrics_started', None)
+        if started is None:
+            return
+        seconds = time.perf_counter() - started
+        phases = g.pop('metrics_phases', {})
+        route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+        self.observe(route, request.method, status_code, seconds, phases)
+
+    # -------------------------------------------------------------------------
+
+    def observe(self, route, method, status_code, seconds, phases):
+        status_class = str(status_code // 100)+'xx'
+        with self._lock:
+            if os.getpid() != self.pid:
+                # forked after we started counting - totals belong to the parent
+                self._reset()
+            key = (route, method, status_class)
+            self._requests[key] = self._requests.get(key, 0) + 1
+            self._histogram(self._durations, (route, method)).observe(seconds)
+            for phase, phase_seconds in phases.items():
+                self._histogram(self._phases, (route, method, phase)).observe(phase_seconds)
+        self._ensure_flusher()
+
+    def _histogram(self, histograms, key):
+        histogram = histograms.get(key)
+        if histogram is None:
+            histogram = histograms[key] = Histogram()
+        return histogram
+
+    def snapshot(self):
+        with self._lock:
+            return _snapshot(self._requests, self._durations, self._phases)
+
+    # -------------------------------------------------------------------------
+    # totals are written out by a background thread so requests never wait on
+    # the file and idle workers still publish. threads don't survive a fork,
+    # so a worker forked after init_app starts its own on its first request
+
+    def _ensure_flusher(self):
+        if not self.directory or \
+           (self._flusher is not None and self._flusher_pid == os.getpid()):
+            return
+        with self._lock:
+            if self._flusher is not None and self._flusher_pid == os.getpid():
+                return
+            self._stop = threading.Event()
+            self._flusher_pid = os.getpid()
+            self._flusher = threading.Thread(target=self._run, args=(self._stop,),
+                                             name='metrics-flusher')
+            self._flusher.daemon = True
+            self._flusher.start()
+
+    def _run(self, stop):
+        while not stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception:
+                logger.exception("could not write metrics to %s", self.directory)
+
+    def stop(self):
+        if self._flusher is not None and self._flusher_pid == os.getpid():
+            self._stop.set()
+            self._flusher.join(5)
+        self._flusher = None
+
+    def flush(self):
+        if not self.directory:
+            return
+        with self._lock:
+            if os.getpid() != self.pid:
+                self._reset()
+        _write_json(os.path.join(self.directory, self.filename), self.snapshot())
+
+    def collect(self):
+        # this worker's live totals, the last flushed totals of the others
+        # and the archived totals of workers that have exited
+        snapshots = [self.snapshot()]
+        if self.directory:
+            self.archive_dead()
+            filenames = glob.glob(os.path.join(self.directory, 'metrics_*.json'))
+            filenames.append(os.path.join(self.directory, ARCHIVE_FILE))
+            for filename in filenames:
+                if os.path.basename(filename) == self.filename:
+                    continue
+                snapshot = _read_json(filename)
+                if snapshot is not None:
+                    snapshots.append(snapshot)
+        return _merge(snapshots)
+
+    def archive_dead(self):
+        # folds the files of exited workers into the archive. the lock file
+        # stops two workers archiving the same file twice
+        cutoff = time.time() - max(self.flush_interval * DEAD_AFTER, 60)
+        with open(os.path.join(self.directory, 'archive.lock'), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                dead = []
+                for filename in glob.glob(os.path.join(self.directory, 'metrics_*.json')):
+                    try:
+                        if os.path.getmtime(filename) < cutoff:
+                            dead.append(filename)
+                    except OSError:
+                        continue
+                if not dead:
+                    return
+                archive = os.path.join(self.directory, ARCHIVE_FILE)
+                snapshots = [_read_json(filename) for filename in [archive] + dead]
+                _write_json(archive, _snapshot(*_merge([snapshot for snapshot in snapshots
+                                                        if snapshot is not None])))
+                for filename in dead:
+                    os.remove(filename)
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # -------------------------------------------------------------------------
+    # prometheus text exposition format
+
+    def render(self):
+        requests, durations, phases = self.collect()
+        lines = []
+
+        lines.append('# HELP address_requests_total Requests by route, method and status class.')
+        lines.append('# TYPE address_requests_total counter')
+        for (route, method, status_class), count in sorted(requests.items()):
+            lines.append(_sample('address_requests_total',
+                                 { 'route': route, 'method': method, 'status': status_class }, count))
+
+        errors = {}
+        for (route, method, status_class), count in requests.items():
+            errors.setdefault((route, method), 0)
+            if status_class == '5xx':
+                errors[(route, method)] += count
+        lines.append('# HELP address_request_errors_total Requests that ended in a 5xx.')
+        lines.append('# TYPE address_request_errors_total counter')
+        for (route, method), count in sorted(errors.items()):
+            lines.append(_sample('address_request_errors_total',
+                                 { 'route': route, 'method': method }, count))
+
+        lines.append('# HELP address_request_duration_seconds Request latency.')
+        lines.append('# TYPE address_request_duration_seconds histogram')
+        for (route, method), histogram in sorted(durations.items()):
+            _histogram_lines(lines, 'address_request_duration_seconds',
+                             { 'route': route, 'method': method }, histogram)
+
+        lines.append('# HELP address_request_duration_quantile_seconds '
+                     'Latency quantiles estimated from the histogram buckets.')
+        lines.append('# TYPE address_request_duration_quantile_seconds gauge')
+        for (route, method), histogram in sorted(durations.items()):
+            for q in QUANTILES:
+                lines.append(_sample('address_request_duration_quantile_seconds',
+                                     { 'route': route, 'method': method, 'quantile': str(q) },
+                                     histogram.quantile(q)))
+
+        lines.append('# HELP address_request_phase_seconds Time spent in each phase of a request.')
+        lines.append('# TYPE address_request_phase_seconds histogram')
+        for (route, method, phase), histogram in sorted(phases.items()):
+            _histogram_lines(lines, 'address_request_phase_seconds',
+                             { 'route': route, 'method': method, 'phase': phase }, histogram)
+
+        return '\n'.join(lines)+'\n'
+
+
+def _merge(snapshots):
+    requests, durations, phases = {}, {}, {}
+    for snapshot in snapshots:
+        for route, method, status_class, count in snapshot['requests']:
+            key = (route, method, status_class)
+            requests[key] = requests.get(key, 0) + count
+        for route, method, counts, total in snapshot['durations']:
+            durations.setdefault((route, method), Histogram()).merge(Histogram(counts, total))
+        for route, method, phase, counts, total in snapshot['phases']:
+            phases.setdefault((route, method, phase), Histogram()).merge(Histogram(counts, total))
+    return requests, durations, phases
+
+
+def _snapshot(requests, durations, phases):
+    return { 'requests': [list(key) + [count] for key, count in requests.items()],
+             'durations': [list(key) + [histogram.counts, histogram.total]
+                           for key, histogram in durations.items()],
+             'phases': [list(key) + [histogram.counts, histogram.total]
+                        for key, histogram in phases.items()] }
+
+
+def _read_json(filename):
+    try:
+        with open(filename) as metrics_file:
+            return json.load(metrics_file)
+    except (IOError, ValueError):
+        return None
+
+
+def _write_json(filename, snapshot):
+    # written whole then renamed so readers never see half a file
+    temp_filename = filename+'.tmp'
+    with open(temp_filename, 'w') as temp_file:
+        json.dump(snapshot, temp_file)
+    os.replace(temp_filename, filename)
+
+
+def _histogram_lines(lines, name, labels, histogram):
+    cumulative = 0
+    for bound, count in zip(BUCKETS, histogram.counts):
+        cumulative += count
+        lines.append(_sample(name+'_bucket', dict(labels, le=repr(bound)), cumulative))
+    lines.append(_sample(name+'_bucket', dict(labels, le='+Inf'), histogram.count))
+    lines.append(_sample(name+'_sum', labels, histogram.total))
+    lines.append(_sample(name+'_count', labels, histogram.count))
+
+
+def _sample(name, labels, value):
+    label_text = ','.join(key+'="'+_escape(str(labels[key]))+'"' for key in sorted(labels))
+    return name+'{'+label_text+'} '+repr(value)
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+request_metrics = RequestMetrics()
+
+atexit.register(request_metrics.flush)
+
+# -----------------------------------------------------------------------------
+# phase timing - adds the time spent in the block to the current request's
+# total for that phase and traces it as a span. does nothing outside a request
+
+@contextmanager
+def phase(name):
+    if not has_request_context():
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        with tracer.span(name):
+            yield
+    finally:
+        add_phase_time(name, time.perf_counter() - started)
+
+
+def add_phase_time(name, seconds):
+    phases = g.get('metrics_phases')
+    if phases is not None:
+        phases[name] = phases.get(name, 0.0) + seconds
@@ -1,6 +1,6 @@
 # app/models.py
 from app import db
-from sqlalchemy.dialects.postgresql import JSON
+from sqlalchemy.dialects.postgresql import JSON, UUID
 import datetime
 
 #-----------------------------------------------------------------------------#
@@ -26,10 +26,15 @@ class Country(db.Model):
 class Address(db.Model):
 
     __tablename__ = 'address'
+    __table_args__ = (db.Index('ix_address_public_id_created', 'public_id', 'created'),
+                      db.Index('ix_address_country_id', 'country_id'),
+                      db.Index('ix_address_created', 'created'))
 
     id = db.Column(db.Integer, primary_key=True)
-    address_id = db.Column(db.String(50), unique=True, nullable=False)
-    public_id = db.Column(db.String(50), nullable=False)
+    # native 16 byte uuids in postgres but plain strings in python so the api
+    # representation is unchanged
+    address_id = db.Column(UUID(as_uuid=False), unique=True, nullable=False)
+    public_id = db.Column(UUID(as_uuid=False), nullable=False)
     house_name = db.Column(db.String(50))
     house_number = db.Column(db.String(50))
     address_line_1 = db.Column(db.String(150))
@@ -57,3 +62,21 @@ class Address(db.Model):
     def __repr__(self): # pragma: no cover
         return '<id Address {}>'.format(self.id)
 
+
+
+class RecordCount(db.Model):
+
+    # running row totals for tables that are too big to count(*) on every
+    # request - kept up to date by the create and delete routes
+
+    __tablename__ = 'record_count'
+
+    table_name = db.Column(db.String(50), primary_key=True)
+    total = db.Column(db.BigInteger, nullable=False, default=0)
+
+    def __init__(self, table_name, total):
+        self.table_name = table_name
+        self.total = total
+
+    def __repr__(self): # pragma: no cover
+        return '<table_name RecordCount {}>'.format(self.table_name)
@@ -0,0 +1,173 @@
+# app/profiler.py
+from app.decorators import check_access, AccessDenied
+from flask import g, request
+import cProfile
+import datetime
+import fcntl
+import glob
+import logging
+import os
+import re
+import threading
+import time
+
+try:
+    from pyinstrument import Profiler as SamplingProfiler
+except ImportError: # pragma: no cover
+    SamplingProfiler = None
+
+# -----------------------------------------------------------------------------
+# on demand profiling of single requests. an admin (access level 5) sends the
+# PROFILE_HEADER header and that one request runs under cProfile, or under
+# pyinstrument's sampling profiler when PROFILER=pyinstrument and it is
+# installed. the profile is saved in PROFILE_DIR, named by time and route,
+# and the response says where in the X-Profile-Path header.
+#
+# no more than PROFILE_MAX_PER_WINDOW profiles are taken every PROFILE_WINDOW
+# seconds across all workers - the profile files themselves are counted, so
+# PROFILE_DIR should be shared by the workers. a profile is reserved under a
+# thread lock and a lock file in PROFILE_DIR, so requests racing for the last
+# one in a window can't both get it. over the cap the request just runs
+# normally with an X-Profile-Skipped header.
+#
+# only the newest PROFILE_MAX_FILES profiles are kept - older ones are
+# deleted as new ones are reserved
+# -----------------------------------------------------------------------------
+
+logger = logging.getLogger('app.profiler')
+
+PROFILE_ACCESS_LEVEL = 5
+
+LOCK_FILE = 'profiles.lock'
+
+_UNSAFE = re.compile(r'[^A-Za-z0-9]+')
+
+
+class RequestProfiler(object):
+
+    def __init__(self):
+        self.enabled = False
+        self.header = 'X-Profile'
+        self.directory = None
+        self.kind = 'cprofile'
+        self.max_per_window = 5
+        self.window = 60.0
+        self.max_files = 100
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        config = app.config
+        self.enabled = config['PROFILE_ENABLED']
+        self.header = config['PROFILE_HEADER']
+        self.directory = config['PROFILE_DIR']
+        self.kind = config['PROFILER']
+        self.max_per_window = int(config['PROFILE_MAX_PER_WINDOW'])
+        self.window = float(config['PROFILE_WINDOW'])
+        self.max_files = int(config['PROFILE_MAX_FILES'])
+        if self.kind == 'pyinstrument' and SamplingProfiler is None:
+            app.logger.warning("pyinstrument is not installed - profiling with cProfile")
+
+    def init_blueprint(self, bp):
+        bp.before_request(self._start_request)
+        bp.after_request(self._end_request)
+        bp.teardown_request(self._teardown_request)
+
+    # -------------------------------------------------------------------------
+
+    def _start_request(self):
+        if not self.enabled or not request.headers.get(self.header):
+            return
+
+        token = request.headers.get('x-access-token')
+        if not token:
+            return
+        try:
+            check_access(token, PROFILE_ACCESS_LEVEL)
+        except AccessDenied:
+            return
+
+        path = self._reserve()
+        if path is None:
+            g.profile_skipped = True
+            return
+
+        if self.kind == 'pyinstrument' and SamplingProfiler is not None:
+            profiler = SamplingProfiler()
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        g.profile = (profiler, path)
+
+    def _end_request(self, response):
+        if g.pop('profile_skipped', False):
+            response.headers['X-Profile-Skipped'] = 'rate limited'
+        path = self._stop()
+        if path is not None:
+            response.headers['X-Profile-Path'] = path
+        return response
+
+    def _teardown_request(self, exc):
+        # a request that failed before after_request still has to stop
+        self._stop()
+
+    def _stop(self):
+        profile = g.pop('profile', None)
+        if profile is None:
+            return None
+        profiler, path = profile
+        try:
+            if isinstance(profiler, cProfile.Profile):
+                profiler.disable()
+                profiler.dump_stats(path)
+            else:
+                profiler.stop()
+                with open(path, 'w') as profile_file:
+                    profile_file.write(profiler.output_html())
+        except Exception:
+            logger.exception("could not save profile [%s]", path)
+            return None
+        return path
+
+    def _reserve(self):
+        # claims one of the profiles allowed in the current window by
+        # creating its file straight away, so other workers count it too
+        os.makedirs(self.directory, exist_ok=True)
+        with self._lock, open(os.path.join(self.directory, LOCK_FILE), 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            profiles = self._profiles()
+            cutoff = time.time() - self.window
+            if sum(1 for mtime, filename in profiles if mtime >= cutoff) >= self.max_per_window:
+                return None
+
+            route = request.url_rule.rule if request.url_rule is not None else request.path
+            name = '_'.join([datetime.datetime.utcnow().strftime('%Y%m%dT%H%M%S%f'),
+                             request.method,
+                             _UNSAFE.sub('_', route).strip('_') or 'root',
+                             str(os.getpid())])
+            extension = '.html' if self.kind == 'pyinstrument' and SamplingProfiler is not None \
+                        else '.prof'
+            path = os.path.join(self.directory, name+extension)
+            open(path, 'a').close()
+
+            # never delete the ones the current window still counts
+            keep = max(self.max_files, self.max_per_window)
+            for mtime, filename in profiles[:max(0, len(profiles) + 1 - keep)]:
+                try:
+                    os.remove(filename)
+                except OSError:
+                    continue
+            return path
+
+    def _profiles(self):
+        # (modified time, filename) of the saved profiles, oldest first
+        profiles = []
+        for filename in glob.glob(os.path.join(self.directory, '*.prof')) + \
+                        glob.glob(os.path.join(self.directory, '*.html')):
+            try:
+                profiles.append((os.path.getmtime(filename), filename))
+            except OSError:
+                continue
+        return sorted(profiles)
+
+request_profiler = RequestProfiler()
@@ -0,0 +1,111 @@
+# app/queries.py
+from app import db
+from app.models import Country, Address
+from sqlalchemy import select, bindparam, func
+import weakref
+
+# -----------------------------------------------------------------------------
+# the queries behind each route live here so the views and the explain-queries
+# command (app/commands.py) always look at exactly the same sql.
+#
+# the read routes use sqlalchemy core statements that are built once at import
+# with bind parameters for every value. run() executes them with a compiled
+# cache so each statement is only compiled once per process, and the rows
+# that come back are plain result rows with no orm identity map behind them
+# -----------------------------------------------------------------------------
+
+address = Address.__table__
+country = Country.__table__
+
+ADDRESS_COLUMNS = [address.c.house_name,
+                   address.c.house_number,
+                   address.c.address_line_1,
+                   address.c.address_line_2,
+                   address.c.address_line_3,
+                   address.c.state_region_county,
+                   country.c.name,
+                   country.c.iso_code,
+                   address.c.post_zip_code]
+
+_address_join = address.join(country, address.c.country_id == country.c.id)
+
+# GET /address - params: public_id. newest first, read backwards along
+# ix_address_public_id_created
+USER_ADDRESSES = select([address.c.address_id] + ADDRESS_COLUMNS)\
+                     .select_from(_address_join)\
+                     .where(address.c.public_id == bindparam('public_id'))\
+                     .order_by(address.c.created.desc())
+
+# GET /address/<uuid> - params: address_id
+ONE_ADDRESS = select(ADDRESS_COLUMNS)\
+                  .select_from(_address_join)\
+                  .where(address.c.address_id == bindparam('address_id'))\
+                  .limit(1)
+
+# GET /address/multi - params: address_ids (a list)
+MANY_ADDRESSES = select([address.c.address_id] + ADDRESS_COLUMNS)\
+                     .select_from(_address_join)\
+                     .where(address.c.address_id.in_(bindparam('address_ids', expanding=True)))
+
+_admin_addresses = select([address.c.id, address.c.address_id, address.c.public_id] +
+                          ADDRESS_COLUMNS)\
+                       .select_from(_address_join)\
+                       .order_by(address.c.id)
+
+# GET /address/admin/address?cursor= - params: after_id, limit
+ADMIN_ADDRESSES_AFTER = _admin_addresses.where(address.c.id > bindparam('after_id'))\
+                                        .limit(bindparam('limit'))
+
+# GET /address/admin/address?page= - params: offset, limit
+ADMIN_ADDRESSES_PAGE = _admin_addresses.offset(bindparam('offset'))\
+                                       .limit(bindparam('limit'))
+
+# GET /address/admin/address?count=exact
+COUNT_ADDRESSES = select([func.count(address.c.id)])
+
+# GET /address/countries
+COUNTRIES = select([country.c.id, country.c.name, country.c.iso_code])\
+                .order_by(country.c.id)
+
+# POST /address - params: the address columns, created is filled in by its default
+INSERT_ADDRESS = address.insert()
+
+# compiled sql is kept per engine - the cache keys hold the engine's dialect
+_compiled_caches = weakref.WeakKeyDictionary()
+
+def compiled_cache(engine):
+    cache = _compiled_caches.get(engine)
+    if cache is None:
+        cache = _compiled_caches.setdefault(engine, {})
+    return cache
+
+def run(statement, **params):
+    connection = db.session.connection()
+    connection = connection.execution_options(compiled_cache=compiled_cache(connection.engine))
+    return connection.execute(statement, params)
+
+# -----------------------------------------------------------------------------
+# write and streaming paths stay on the orm
+
+def delete_address_query(address_id, public_id):
+    return Address.query.filter(Address.address_id == address_id)\
+                        .filter(Address.public_id == public_id)
+
+def export_addresses_query(created_since=None):
+    query = db.session.query(Address.address_id,
+                             Address.public_id,
+                             Address.house_name,
+                             Address.house_number,
+                             Address.address_line_1,
+                             Address.address_line_2,
+                             Address.address_line_3,
+                             Address.state_region_county,
+                             Country.name.label('country'),
+                             Country.iso_code.label('country_code'),
+                             Address.post_zip_code,
+                             Address.created)\
+                      .join(Country)\
+                      .order_by(Address.id)
+    if created_since is not None:
+        query = query.filter(Address.created >= created_since)
+    return query
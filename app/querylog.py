@@ -0,0 +1,172 @@
+# app/querylog.py
+from app.metrics import add_phase_time
+from app.tracing import tracer
+from flask import g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from collections import namedtuple, Counter
+from contextlib import contextmanager
+import logging
+import re
+import threading
+import time
+
+# -----------------------------------------------------------------------------
+# every sql statement sent by any engine is timed and counted against the
+# request that sent it.
+#   - statements slower than SQL_SLOW_QUERY_MS are logged to the app.sql.slow
+#     logger with their normalized sql and the shape (names and types, never
+#     values) of their bind parameters - app/logs.py also writes these to
+#     SQL_SLOW_LOG_FILENAME
+#   - a request that runs the same normalized statement SQL_N_PLUS_ONE_THRESHOLD
+#     or more times is logged as a likely n+1
+#   - record_queries() collects the statements run inside it so tests can
+#     hold a route to a query budget
+# -----------------------------------------------------------------------------
+
+logger = logging.getLogger('app.sql')
+slow_logger = logging.getLogger('app.sql.slow')
+
+RecordedQuery = namedtuple('RecordedQuery', ['statement', 'parameters', 'executemany', 'seconds'])
+
+
+class QueryRecorder(list):
+
+    @property
+    def total_time(self):
+        return sum(query.seconds for query in self)
+
+    def repeated(self, threshold):
+        # normalized statements run at least threshold times, with counts
+        counts = Counter(normalize_sql(query.statement) for query in self)
+        return [(statement, count) for statement, count in counts.most_common()
+                if count >= threshold]
+
+
+class QueryLog(object):
+
+    def __init__(self):
+        self.slow_ms = 500.0
+        self.n_plus_one_threshold = 5
+        self._local = threading.local()
+
+    def init_app(self, app):
+        self.slow_ms = float(app.config['SQL_SLOW_QUERY_MS'])
+        self.n_plus_one_threshold = int(app.config['SQL_N_PLUS_ONE_THRESHOLD'])
+
+    def init_blueprint(self, bp):
+        bp.before_request(self._start_request)
+        bp.teardown_request(self._end_request)
+
+    def _start_request(self):
+        g.sql_queries = QueryRecorder()
+
+    def _end_request(self, exc):
+        queries = g.pop('sql_queries', None)
+        if not queries:
+            return
+        route = request.method+' '+(request.url_rule.rule if request.url_rule is not None
+                                    else request.path)
+        logger.debug("%s ran %d statements in %.1fms", route, len(queries),
+                     queries.total_time * 1000)
+        if self.n_plus_one_threshold > 0:
+            for statement, count in queries.repeated(self.n_plus_one_threshold):
+                logger.warning("possible n+1 in %s - ran %d times: %s", route, count, statement)
+
+    # -------------------------------------------------------------------------
+
+    @contextmanager
+    def record(self):
+        recorders = self._recorders()
+        recorder = QueryRecorder()
+        recorders.append(recorder)
+        try:
+            yield recorder
+        finally:
+            recorders.remove(recorder)
+
+    def _recorders(self):
+        recorders = getattr(self._local, 'recorders', None)
+        if recorders is None:
+            recorders = self._local.recorders = []
+        return recorders
+
+    def observe(self, statement, parameters, executemany, seconds):
+        query = None
+        recorders = getattr(self._local, 'recorders', None)
+        if recorders:
+            query = RecordedQuery(statement, parameters, executemany, seconds)
+            for recorder in recorders:
+                recorder.append(query)
+
+        if has_request_context():
+            add_phase_time('db', seconds)
+            if tracer.current_trace() is not None:
+                tracer.record_span('db', seconds, statement=normalize_sql(statement))
+            request_queries = g.get('sql_queries')
+            if request_queries is not None:
+                request_queries.append(query or
+                                       RecordedQuery(statement, parameters, executemany, seconds))
+
+        if self.slow_ms > 0 and seconds * 1000 >= self.slow_ms:
+            slow_logger.warning("%.1fms %s params=%s", seconds * 1000, normalize_sql(statement),
+                                parameter_shape(parameters, executemany))
+
+
+query_log = QueryLog()
+
+def record_queries():
+    return query_log.record()
+
+# -----------------------------------------------------------------------------
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if context is not None:
+        context.query_started = time.perf_counter()
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = getattr(context, 'query_started', None)
+    if started is not None:
+        query_log.observe(statement, parameters, executemany, time.perf_counter() - started)
+
+# -----------------------------------------------------------------------------
+# literals and bind parameters become ? and IN lists collapse to IN (...) so
+# the same query with different values normalizes to the same text
+
+_STRING = re.compile(r"'(?:[^']|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PARAMETER = re.compile(r"%\(\w+\)s|%s")
+_IN_LIST = re.compile(r"\bIN \(\s*\?(?:\s*,\s*\?)*\s*\)", re.IGNORECASE)
+_WHITESPACE = re.compile(r"\s+")
+
+def normalize_sql(statement):
+    statement = _STRING.sub('?', statement)
+    statement = _PARAMETER.sub('?', statement)
+    statement = _NUMBER.sub('?', statement)
+    statement = _WHITESPACE.sub(' ', statement).strip()
+    return _IN_LIST.sub('IN (...)', statement)
+
+
+def parameter_shape(parameters, executemany=False):
+    if executemany:
+        if not parameters:
+            return '[]'
+        return str(len(parameters))+' x '+_shape(parameters[0])
+    return _shape(parameters)
+
+
+def _shape(parameters):
+    if isinstance(parameters, dict):
+        return '{'+', '.join(str(key)+': '+_type_name(parameters[key])
+                             for key in sorted(parameters))+'}'
+    if isinstance(parameters, (list, tuple)):
+        return '('+', '.join(_type_name(value) for value in parameters)+')'
+    return _type_name(parameters)
+
+
+def _type_name(value):
+    if isinstance(value, (list, tuple)):
+        return type(value).__name__+'['+str(len(value))+']'
+    return type(value).__name__
@@ -0,0 +1,270 @@
+# app/ratelimit.py
+from app.cache import LocalSharedClient
+from limits.storage import Storage
+import logging
+import os
+import sqlite3
+import time
+
+# -----------------------------------------------------------------------------
+# rate limit counters shared by all the gunicorn workers. the default
+# memory:// storage counts per worker, so every limit is really the limit
+# times the number of workers. these register extra RATELIMIT_STORAGE_URL
+# schemes with the limits package:
+#   sqlite:////path/to/file.db  - a sqlite file shared by the workers on one
+#                                 host - no server needed
+#   shared+redis://host:6379/0  - redis, for workers spread over hosts. needs
+#                                 the redis package (also shared+rediss://)
+#   shared://                   - an in-process stand-in for redis for
+#                                 development and tests
+#
+# hits are counted locally and sent to the shared counters in one batch - a
+# single transaction or redis pipeline - at most every RATELIMIT_SYNC_INTERVAL
+# seconds, so most limit checks never leave the process. the first hit on a
+# limit in each window always syncs, so a worker starts from the shared
+# count, and once a worker's count reaches RATELIMIT_SYNC_FRACTION of the
+# limit every hit syncs, so the limit itself is checked against the shared
+# count. the limit is read from the end of the key, where the limits package
+# puts it.
+#
+# between syncs a worker doesn't see the other workers' hits. each worker can
+# let through up to the fraction of the limit unseen, so with N workers the
+# worst case is about limit * (1 + N * fraction) hits in a window - with the
+# default of 0.5 and 4 workers, 3 times the limit. set the fraction or the
+# interval to 0 to sync on every hit. if the shared counters can't be reached
+# the worker counts on its own until they come back.
+#
+# only the fixed window strategies are supported (the default)
+# -----------------------------------------------------------------------------
+
+logger = logging.getLogger('app.ratelimit')
+
+
+class SharedStorage(Storage):
+
+    STORAGE_SCHEME = 'shared'
+
+    def __init__(self, uri, sync_interval=0.1, sync_fraction=0.5, **options):
+        super(SharedStorage, self).__init__(uri)
+        self.sync_interval = float(sync_interval)
+        self.sync_fraction = float(sync_fraction)
+        self.counters = self._build_counters(uri)
+        self.syncs = 0
+        self.errors = 0
+        # key -> [hits not yet sent, expiry, elastic]
+        self._pending = {}
+        # key -> (shared count, expires at) as of the last sync
+        self._synced = {}
+        self._synced_at = 0.0
+
+    def _build_counters(self, uri):
+        return RedisCounters(LocalSharedClient())
+
+    # -------------------------------------------------------------------------
+    # the limits storage interface
+
+    def incr(self, key, expiry, elastic_expiry=False):
+        with self.lock:
+            pending = self._pending.get(key)
+            if pending is None:
+                pending = self._pending[key] = [0, expiry, False]
+            pending[0] += 1
+            pending[2] = pending[2] or elastic_expiry
+            if self._window(key) is None or \
+               time.monotonic() - self._synced_at >= self.sync_interval or \
+               self._near_limit(key):
+                self._sync()
+            return self._count(key)
+
+    def get(self, key):
+        with self.lock:
+            return self._count(key)
+
+    def get_expiry(self, key):
+        with self.lock:
+            window = self._window(key)
+            return int(window[1]) if window is not None else int(time.time())
+
+    def check(self):
+        try:
+            return self.counters.check()
+        except Exception:
+            return False
+
+    def reset(self):
+        with self.lock:
+            self._pending = {}
+            self._synced = {}
+            self.counters.clear()
+
+    def flush(self):
+        # sends any hits counted since the last sync
+        with self.lock:
+            if self._pending:
+                self._sync()
+
+    # -------------------------------------------------------------------------
+
+    def _window(self, key):
+        # (count, expires at) of the current window as of the last sync
+        window = self._synced.get(key)
+        if window is not None and window[1] <= time.time():
+            return None
+        return window
+
+    def _count(self, key):
+        window = self._window(key)
+        pending = self._pending.get(key)
+        return (window[0] if window is not None else 0) + (pending[0] if pending else 0)
+
+    def _near_limit(self, key):
+        # limits keys end in amount/multiples/granularity
+        try:
+            amount = int(key.rsplit('/', 3)[-3])
+        except (IndexError, ValueError):
+            return False
+        return self._count(key) >= amount * self.sync_fraction
+
+    def _sync(self):
+        pending, self._pending = self._pending, {}
+        now = time.time()
+        self._synced = dict((key, window) for key, window in self._synced.items()
+                            if window[1] > now)
+        self._synced_at = time.monotonic()
+        try:
+            self._synced.update(self.counters.add(pending))
+            self.syncs += 1
+        except Exception:
+            # keep limiting with this worker's own counts rather than
+            # failing requests - the hits are not sent on later
+            self.errors += 1
+            logger.warning("rate limit storage unreachable - counting locally", exc_info=True)
+            for key, (hits, expiry, elastic) in pending.items():
+                window = self._window(key)
+                if window is None:
+                    self._synced[key] = (hits, now + expiry)
+                else:
+                    self._synced[key] = (window[0] + hits,
+                                         now + expiry if elastic else window[1])
+
+
+class SharedRedisStorage(SharedStorage):
+
+    STORAGE_SCHEME = 'shared+redis'
+
+    def _build_counters(self, uri):
+        import redis
+        return RedisCounters(redis.Redis.from_url(uri.split('+', 1)[1]))
+
+
+class SharedRedisSSLStorage(SharedRedisStorage):
+
+    STORAGE_SCHEME = 'shared+rediss'
+
+
+class SqliteStorage(SharedStorage):
+
+    STORAGE_SCHEME = 'sqlite'
+
+    def _build_counters(self, uri):
+        # sqlite:///relative.db or sqlite:////absolute.db, as in sqlalchemy
+        return SqliteCounters(uri[len('sqlite:///'):])
+
+# -----------------------------------------------------------------------------
+# shared counters - add() takes { key: (hits, expiry, elastic) } and returns
+# { key: (count, expires at) } after adding the hits, in one round trip
+
+class RedisCounters(object):
+
+    def __init__(self, client, prefix='ratelimit:'):
+        self.client = client
+        self.prefix = prefix
+
+    def add(self, pending):
+        pipe = self.client.pipeline(transaction=False)
+        keys = list(pending)
+        for key in keys:
+            hits, expiry, elastic = pending[key]
+            name = self.prefix+key
+            # starts the window if there isn't one
+            pipe.set(name, 0, ex=expiry, nx=True)
+            pipe.incrby(name, hits)
+            if elastic:
+                pipe.expire(name, expiry)
+            pipe.ttl(name)
+        results = iter(pipe.execute())
+        now = time.time()
+        windows = {}
+        for key in keys:
+            hits, expiry, elastic = pending[key]
+            next(results)
+            count = int(next(results))
+            if elastic:
+                next(results)
+            ttl = next(results)
+            windows[key] = (count, now + (ttl if ttl is not None and ttl >= 0 else expiry))
+        return windows
+
+    def check(self):
+        return bool(self.client.ping())
+
+    def clear(self):
+        names = list(self.client.scan_iter(match=self.prefix+'*'))
+        if names:
+            self.client.delete(*names)
+
+
+class SqliteCounters(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+        self._connection = None
+        self._pid = None
+
+    def _connect(self):
+        # one connection per process - connections can't cross a fork
+        if self._connection is None or self._pid != os.getpid():
+            directory = os.path.dirname(self.filename)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            connection = sqlite3.connect(self.filename, timeout=5, isolation_level=None,
+                                         check_same_thread=False)
+            # the counters only matter for the current window, so they don't
+            # need to survive a crash
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=OFF')
+            connection.execute('CREATE TABLE IF NOT EXISTS ratelimit '
+                               '(key TEXT PRIMARY KEY, count INTEGER, expires REAL)')
+            self._connection = connection
+            self._pid = os.getpid()
+        return self._connection
+
+    def add(self, pending):
+        connection = self._connect()
+        now = time.time()
+        windows = {}
+        connection.execute('BEGIN IMMEDIATE')
+        try:
+            for key, (hits, expiry, elastic) in pending.items():
+                row = connection.execute('SELECT count, expires FROM ratelimit WHERE key = ?',
+                                         (key,)).fetchone()
+                if row is None or row[1] <= now:
+                    window = (hits, now + expiry)
+                else:
+                    window = (row[0] + hits, now + expiry if elastic else row[1])
+                connection.execute('INSERT OR REPLACE INTO ratelimit VALUES (?, ?, ?)',
+                                   (key, window[0], window[1]))
+                windows[key] = window
+            connection.execute('DELETE FROM ratelimit WHERE expires <= ?', (now,))
+            connection.execute('COMMIT')
+        except Exception:
+            connection.execute('ROLLBACK')
+            raise
+        return windows
+
+    def check(self):
+        self._connect().execute('SELECT 1')
+        return True
+
+    def clear(self):
+        self._connect().execute('DELETE FROM ratelimit')
@@ -0,0 +1,69 @@
+# app/serializers.py
+from flask import current_app, json
+from operator import attrgetter
+from app.metrics import phase
+
+try:
+    import orjson
+except ImportError: # pragma: no cover
+    orjson = None
+
+# -----------------------------------------------------------------------------
+# turns query result rows into api output. each mapping is a list of
+# (output field, row attribute) pairs - only mapped fields ever leave the
+# service so nothing private is exposed by accident
+# -----------------------------------------------------------------------------
+
+ADDRESS_FIELDS = (('address_id', 'address_id'),
+                  ('house_name', 'house_name'),
+                  ('house_number', 'house_number'),
+                  ('address_line_1', 'address_line_1'),
+                  ('address_line_2', 'address_line_2'),
+                  ('address_line_3', 'address_line_3'),
+                  ('state_region_county', 'state_region_county'),
+                  ('country', 'name'),
+                  ('country_code', 'iso_code'),
+                  ('post_zip_code', 'post_zip_code'))
+
+# a single address is returned without its id - the caller already has it
+ONE_ADDRESS_FIELDS = ADDRESS_FIELDS[1:]
+
+COUNTRY_FIELDS = (('name', 'name'),
+                  ('iso_code', 'iso_code'))
+
+
+class RowSerializer(object):
+
+    def __init__(self, fields):
+        self.keys = tuple(field for field, attribute in fields)
+        self._values = attrgetter(*[attribute for field, attribute in fields])
+
+    def one(self, row):
+        with phase('serialization'):
+            return dict(zip(self.keys, self._values(row)))
+
+    def many(self, rows):
+        keys = self.keys
+        values = self._values
+        with phase('serialization'):
+            return [dict(zip(keys, values(row))) for row in rows]
+
+
+address_serializer = RowSerializer(ADDRESS_FIELDS)
+one_address_serializer = RowSerializer(ONE_ADDRESS_FIELDS)
+country_serializer = RowSerializer(COUNTRY_FIELDS)
+
+# -----------------------------------------------------------------------------
+# json encoding - uses orjson when it is installed and JSON_FAST_ENCODER is
+# on, otherwise flask's own encoder. always returns utf-8 bytes
+
+def dumps(payload):
+    with phase('serialization'):
+        if orjson is not None and current_app.config['JSON_FAST_ENCODER']:
+            return orjson.dumps(payload)
+        return json.dumps(payload).encode('utf-8')
+
+
+def json_response(payload, status=200):
+    return current_app.response_class(dumps(payload), status=status,
+                                      mimetype='application/json')
@@ -1,10 +1,142 @@
 # app/services.py
+import os
+import threading
+import time
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+from app.tracing import tracer
 
+# -----------------------------------------------------------------------------
+# calls to other microservices go through one keep-alive connection pool per
+# worker process. every call has connect and read timeouts and a circuit
+# breaker stops us hammering a service that is already struggling
 # -----------------------------------------------------------------------------
 
-def call_requests(url, headers):
-    r = requests.get(url, headers=headers)
-    return r
+class ServiceUnavailable(Exception):
+    pass
+
+# -----------------------------------------------------------------------------
+
+class CircuitBreaker(object):
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0
+        self._lock = threading.Lock()
+
+    def allow_request(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            # a trial call that never reported back doesn't keep the
+            # breaker half open for good - another is let through later
+            if time.monotonic() - self.opened_at >= self.reset_timeout:
+                # let a single trial call through to see if things recovered
+                self.state = self.HALF_OPEN
+                self.opened_at = time.monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        with self._lock:
+            self.state = self.CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        with self._lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN or \
+               self.failures >= self.failure_threshold:
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+
+# -----------------------------------------------------------------------------
+
+class HttpClient(object):
 
+    def __init__(self):
+        self.pool_size = 10
+        self.timeout = (1.0, 3.0)
+        self.max_retries = 2
+        self.retry_backoff = 0.1
+        self.breaker = CircuitBreaker()
+        self._session = None
+        self._pid = None
+        self._lock = threading.Lock()
 
+    def init_app(self, app):
+        self.pool_size = int(app.config['AUTHY_POOL_SIZE'])
+        self.timeout = (float(app.config['AUTHY_CONNECT_TIMEOUT']),
+                        float(app.config['AUTHY_READ_TIMEOUT']))
+        self.max_retries = int(app.config['AUTHY_MAX_RETRIES'])
+        self.retry_backoff = float(app.config['AUTHY_RETRY_BACKOFF'])
+        self.breaker = CircuitBreaker(int(app.config['AUTHY_BREAKER_THRESHOLD']),
+                                      float(app.config['AUTHY_BREAKER_RESET']))
+        self._session = None
+
+    @property
+    def session(self):
+        # sessions are built lazily so a gunicorn worker never inherits the
+        # sockets of the process it was forked from
+        if self._session is None or self._pid != os.getpid():
+            with self._lock:
+                if self._session is None or self._pid != os.getpid():
+                    self._session = self._build_session()
+                    self._pid = os.getpid()
+        return self._session
+
+    def _build_session(self):
+        retries = Retry(total=self.max_retries,
+                        backoff_factor=self.retry_backoff,
+                        status_forcelist=(502, 503, 504),
+                        raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=self.pool_size,
+                              pool_maxsize=self.pool_size,
+                              max_retries=retries)
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    def get(self, url, headers):
+
+        if not self.breaker.allow_request():
+            raise ServiceUnavailable('circuit open for ['+url+']')
+
+        try:
+            r = self.session.get(url, headers=headers, timeout=self.timeout)
+        except requests.exceptions.RequestException as err:
+            self.breaker.record_failure()
+            raise ServiceUnavailable(str(err))
+        except Exception:
+            # anything else still has to settle a half open breaker
+            self.breaker.record_failure()
+            raise
+
+        if r.status_code >= 500:
+            self.breaker.record_failure()
+        else:
+            self.breaker.record_success()
+        return r
+
+
+authy_client = HttpClient()
+
+# -----------------------------------------------------------------------------
+
+def call_requests(url, headers):
+    with tracer.span('authy', url=url) as authy_span:
+        # passes the trace on so authy's logs can be matched up with ours
+        headers = dict(headers, **tracer.propagation_headers())
+        r = authy_client.get(url, headers)
+        if authy_span is not None:
+            authy_span.set('status', r.status_code)
+    return r
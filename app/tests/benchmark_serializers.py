@@ -0,0 +1,73 @@
+# app/tests/benchmark_serializers.py
+
+###############################################################################
+### benchmark of building address list responses - run with                ####
+### pytest -s app/tests/benchmark_serializers.py                           ####
+###############################################################################
+
+from collections import namedtuple # pragma: no cover
+from timeit import timeit # pragma: no cover
+import uuid # pragma: no cover
+
+from app import create_app # pragma: no cover
+from app.config import TestConfig # pragma: no cover
+from app.serializers import address_serializer, dumps, orjson # pragma: no cover
+
+from flask import jsonify # pragma: no cover
+from flask_testing import TestCase as FlaskTestCase # pragma: no cover
+
+AddressRow = namedtuple('AddressRow', ['address_id', 'house_name', 'house_number',
+                                       'address_line_1', 'address_line_2',
+                                       'address_line_3', 'state_region_county',
+                                       'name', 'iso_code', 'post_zip_code']) # pragma: no cover
+
+# -----------------------------------------------------------------------------
+
+def make_rows(total): # pragma: no cover
+    return [AddressRow(str(uuid.uuid4()), 'The Cottage', str(number), 'Mill Lane',
+                       'Brixton', '', 'London', 'United Kingdom', 'GBR', 'SW9 4RF')
+            for number in range(total)]
+
+def field_by_field(addresses): # pragma: no cover
+    # how the views built responses before app/serializers.py
+    adds = []
+    for address in addresses:
+        address_data = {}
+        address_data['address_id'] = address.address_id
+        address_data['house_name'] = address.house_name
+        address_data['house_number'] = address.house_number
+        address_data['address_line_1'] = address.address_line_1
+        address_data['address_line_2'] = address.address_line_2
+        address_data['address_line_3'] = address.address_line_3
+        address_data['state_region_county'] = address.state_region_county
+        address_data['country'] = address.name
+        address_data['country_code'] = address.iso_code
+        address_data['post_zip_code'] = address.post_zip_code
+        adds.append(address_data)
+    return jsonify({ 'addresses': adds }).get_data()
+
+def with_serializer(addresses): # pragma: no cover
+    return dumps({ 'addresses': address_serializer.many(addresses) })
+
+###############################################################################
+####                      flask test case instance                         ####
+###############################################################################
+
+class MyTest(FlaskTestCase): # pragma: no cover
+
+    def create_app(self):
+        return create_app(TestConfig)
+
+    def test_benchmark_serializers(self): # pragma: no cover
+        print('\norjson installed: '+str(orjson is not None))
+        for total in (1000, 10000):
+            addresses = make_rows(total)
+            runs = 20
+            before = timeit(lambda: field_by_field(addresses), number=runs) / runs
+            after = timeit(lambda: with_serializer(addresses), number=runs) / runs
+            print('%6d addresses: field by field + jsonify %7.2fms, '
+                  'serializer + dumps %7.2fms (%.1fx)' %
+                  (total, before * 1000, after * 1000, before / after))
+            self.assertTrue(after < before)
+
+# -----------------------------------------------------------------------------
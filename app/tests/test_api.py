@@ -1,8 +1,8 @@
 # app/tests/test_api.py
-from mock import patch
+from mock import patch, MagicMock
 from .fixtures import addTestCountries, addTestAddresses, getPublicID
 from functools import wraps
-from flask import jsonify
+from flask import jsonify, g
 
 # have to mock the require_access_level decorator here before it 
 # gets attached to any classes or functions
@@ -16,6 +16,7 @@ def mock_dec(access_level,request):
             if not token:
                 return jsonify({ 'message': 'Naughty one!'}), 401
             pub_id = getPublicID()
+            g.public_id = pub_id
             return f(pub_id, request, *args, **kwargs)
 
         return decorated
@@ -359,3 +360,1236 @@ class MyTest(FlaskTestCase):
 
         response = self.client.post('/address', json=create_json, headers=headers)
         self.assertEqual(response.status_code, 400)
+
+# -----------------------------------------------------------------------------
+
+    def test_schema_validators_compiled_once(self):
+        from app.assertions import schema_registry
+        schema_registry.clear()
+        gbr_validator = schema_registry.address_validator('GBR')
+        self.assertIs(gbr_validator, schema_registry.address_validator('GBR'))
+        self.assertIs(schema_registry.country_validator(),
+                      schema_registry.country_validator())
+        # countries without their own schema share the default validator
+        self.assertIs(schema_registry.address_validator('FRA'),
+                      schema_registry.address_validator('DEU'))
+        self.assertIsNot(gbr_validator, schema_registry.address_validator('FRA'))
+
+# -----------------------------------------------------------------------------
+
+    def test_schema_registered_lazily(self):
+        from app.assertions import schema_registry, assert_valid_schema
+        from jsonschema.exceptions import ValidationError as JsonValidationError
+        schema_registry.register_address_schema('IRL', 'address_gbr.json')
+        try:
+            data = { 'iso_code': 'IRL', 'house_number': '1', 'post_zip_code': 'nope' }
+            with self.assertRaises(JsonValidationError):
+                assert_valid_schema(data, 'address')
+            self.assertIs(schema_registry.address_validator('IRL'),
+                          schema_registry.address_validator('GBR'))
+        finally:
+            # the registry is shared by every test in the process
+            schema_registry.unregister_address_schema('IRL')
+        self.assertIsNot(schema_registry.address_validator('IRL'),
+                         schema_registry.address_validator('GBR'))
+
+# -----------------------------------------------------------------------------
+
+    def test_access_check_cached(self):
+        from app.decorators import check_access
+        from app.extensions import token_cache
+        self.app.config['CHECK_ACCESS_URL'] = 'http://authy'
+        authy_response = MagicMock(status_code=200)
+        authy_response.json.return_value = { 'public_id': getPublicID() }
+        with patch('app.decorators.call_requests', return_value=authy_response) as authy:
+            self.assertEqual(check_access('sometoken', 10), getPublicID())
+            self.assertEqual(check_access('sometoken', 10), getPublicID())
+            self.assertEqual(authy.call_count, 1)
+            # a different access level is a different question for authy
+            check_access('sometoken', 5)
+            self.assertEqual(authy.call_count, 2)
+        stats = token_cache.stats()
+        self.assertEqual(stats.get('hits'), 1)
+        self.assertEqual(stats.get('misses'), 2)
+
+# -----------------------------------------------------------------------------
+
+    def test_access_check_caches_401(self):
+        from app.decorators import check_access, AccessDenied
+        self.app.config['CHECK_ACCESS_URL'] = 'http://authy'
+        with patch('app.decorators.call_requests',
+                   return_value=MagicMock(status_code=401)) as authy:
+            for _ in range(3):
+                with self.assertRaises(AccessDenied):
+                    check_access('badtoken', 10)
+            self.assertEqual(authy.call_count, 1)
+
+# -----------------------------------------------------------------------------
+
+    def test_ttl_cache_evicts_least_recently_used(self):
+        from app.cache import TTLCache, MISSING
+        cache = TTLCache(maxsize=2, ttl=60)
+        cache.set('a', 1)
+        cache.set('b', 2)
+        cache.get('a')
+        cache.set('c', 3)
+        self.assertIs(cache.get('b'), MISSING)
+        self.assertEqual(cache.get('a'), 1)
+        self.assertEqual(cache.stats().get('evictions'), 1)
+        cache.set('d', 4, ttl=-1)
+        self.assertIs(cache.get('d'), MISSING)
+
+# -----------------------------------------------------------------------------
+
+    def test_circuit_breaker_fails_fast(self):
+        import requests
+        from app.services import HttpClient, ServiceUnavailable
+        self.app.config['AUTHY_BREAKER_THRESHOLD'] = 2
+        client = HttpClient()
+        client.init_app(self.app)
+        with patch.object(requests.Session, 'get',
+                          side_effect=requests.exceptions.ConnectTimeout) as authy:
+            for _ in range(4):
+                with self.assertRaises(ServiceUnavailable):
+                    client.get('http://authy/authy/checkaccess/10', {})
+            # breaker opened after two failures so later calls never went out
+            self.assertEqual(authy.call_count, 2)
+        self.assertEqual(client.breaker.state, 'open')
+
+# -----------------------------------------------------------------------------
+
+    def test_circuit_breaker_trial_call_raising_other_errors(self):
+        import time
+        from app.services import HttpClient
+        client = HttpClient()
+        client.breaker.failure_threshold = 1
+        client.breaker.reset_timeout = 0
+        client.breaker.record_failure()
+
+        with patch.object(client.session, 'get', side_effect=ValueError('bad url')):
+            with self.assertRaises(ValueError):
+                client.get('http://authy/api/v1/auth', {})
+        self.assertEqual(client.breaker.state, 'open')
+
+        # the next trial call gets through and closes the breaker again
+        with patch.object(client.session, 'get', return_value=MagicMock(status_code=200)):
+            self.assertEqual(client.get('http://authy/api/v1/auth', {}).status_code, 200)
+        self.assertEqual(client.breaker.state, 'closed')
+
+        # a trial call that never reports back doesn't hold the breaker open
+        client.breaker.record_failure()
+        client.breaker.reset_timeout = 0.05
+        time.sleep(0.06)
+        self.assertTrue(client.breaker.allow_request())
+        self.assertFalse(client.breaker.allow_request())
+        time.sleep(0.06)
+        self.assertTrue(client.breaker.allow_request())
+
+# -----------------------------------------------------------------------------
+
+    def test_access_check_502_when_authy_down(self):
+        from app.decorators import check_access, AccessDenied
+        from app.services import ServiceUnavailable
+        self.app.config['CHECK_ACCESS_URL'] = 'http://authy'
+        with patch('app.decorators.call_requests', side_effect=ServiceUnavailable):
+            with self.assertRaises(AccessDenied) as denied:
+                check_access('sometoken', 10)
+        self.assertEqual(denied.exception.status_code, 502)
+
+# -----------------------------------------------------------------------------
+
+    def test_concurrent_access_checks_share_one_call(self):
+        import threading, time
+        from app.decorators import check_access
+        self.app.config['CHECK_ACCESS_URL'] = 'http://authy'
+        authy_response = MagicMock(status_code=200)
+        authy_response.json.return_value = { 'public_id': getPublicID() }
+
+        def slow_authy(url, headers):
+            time.sleep(0.2)
+            return authy_response
+
+        results = []
+        def check():
+            with self.app.app_context():
+                results.append(check_access('burstytoken', 10))
+
+        with patch('app.decorators.call_requests', side_effect=slow_authy) as authy:
+            threads = [threading.Thread(target=check) for _ in range(5)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            self.assertEqual(authy.call_count, 1)
+        self.assertEqual(results, [getPublicID()] * 5)
+
+# -----------------------------------------------------------------------------
+
+    def _mint_token(self, secret='localsecret', expires_in=300, **claims):
+        import jwt, datetime
+        claims.setdefault('public_id', getPublicID())
+        claims.setdefault('access_level', 10)
+        claims['exp'] = datetime.datetime.utcnow() + datetime.timedelta(seconds=expires_in)
+        token = jwt.encode(claims, secret, algorithm='HS256')
+        return token.decode('utf-8') if isinstance(token, bytes) else token
+
+    def test_access_check_verifies_jwt_locally(self):
+        from app.decorators import check_access, AccessDenied
+        self.app.config['AUTH_VERIFY_MODE'] = 'local'
+        self.app.config['JWT_SECRET_KEY'] = 'localsecret'
+        with patch('app.decorators.call_requests') as authy:
+            self.assertEqual(check_access(self._mint_token(), 10), getPublicID())
+            self.assertEqual(check_access(self._mint_token(access_level=5), 5), getPublicID())
+            # user level tokens can't get at admin routes
+            with self.assertRaises(AccessDenied):
+                check_access(self._mint_token(), 5)
+            with self.assertRaises(AccessDenied):
+                check_access(self._mint_token(expires_in=-60), 10)
+            self.assertEqual(authy.call_count, 0)
+
+# -----------------------------------------------------------------------------
+
+    def test_access_check_falls_back_to_authy(self):
+        from app.decorators import check_access
+        self.app.config['AUTH_VERIFY_MODE'] = 'local'
+        self.app.config['JWT_SECRET_KEY'] = 'localsecret'
+        self.app.config['CHECK_ACCESS_URL'] = 'http://authy'
+        authy_response = MagicMock(status_code=200)
+        authy_response.json.return_value = { 'public_id': getPublicID() }
+        with patch('app.decorators.call_requests', return_value=authy_response) as authy:
+            # signed with a key we don't know about
+            check_access(self._mint_token(secret='someotherkey'), 10)
+            self.assertEqual(authy.call_count, 1)
+            check_access('notevenajwt', 10)
+            self.assertEqual(authy.call_count, 2)
+            # a public key with the default HS256 - pyjwt refuses to use a
+            # pem key as an hmac secret
+            self.app.config['JWT_PUBLIC_KEY'] = '-----BEGIN PUBLIC KEY-----\nMFkw\n-----END PUBLIC KEY-----'
+            check_access(self._mint_token(secret='anything'), 10)
+            self.assertEqual(authy.call_count, 3)
+
+# -----------------------------------------------------------------------------
+
+    def test_countries_etag_and_not_modified(self):
+        countries = addTestCountries()
+        headers = { 'Content-type': 'application/json' }
+        response = self.client.get('/address/countries', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        etag = response.headers.get('ETag')
+        self.assertTrue(etag)
+        self.assertTrue('max-age' in response.headers.get('Cache-Control'))
+
+        headers['If-None-Match'] = etag
+        response = self.client.get('/address/countries', headers=headers)
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.headers.get('ETag'), etag)
+
+        # reloading countries gives a fresh payload and etag
+        db.session.add(Country(name = "Spain", iso_code = "ESP"))
+        db.session.commit()
+        response = self.client.get('/address/countries', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response.headers.get('ETag'), etag)
+        self.assertEqual(len(response.json.get('countries')), 5)
+
+# -----------------------------------------------------------------------------
+
+    def test_all_addresses_admin_cursor_paging(self):
+        addresses = addTestAddresses()
+        headers = { 'Content-type': 'application/json', 'x-access-token': 'somefaketoken' }
+        url = '/address/admin/address'
+        seen = []
+        while url:
+            response = self.client.get(url, headers=headers)
+            self.assertEqual(response.status_code, 200)
+            results = response.json
+            self.assertTrue('prev_url' not in results)
+            seen.extend([addy.get('address_id') for addy in results.get('addresses')])
+            url = results.get('next_url')
+            if url:
+                self.assertTrue('cursor=' in url)
+        self.assertEqual(len(seen), 6)
+        self.assertEqual(len(set(seen)), 6)
+
+        # old style page numbers still work
+        response = self.client.get('/address/admin/address?page=2', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json.get('addresses')[0].get('address_id'), seen[2])
+        self.assertEqual(response.json.get('next_url'), '/address/admin/address?page=3')
+
+        response = self.client.get('/address/admin/address?cursor=!!!', headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+# -----------------------------------------------------------------------------
+
+    def test_all_addresses_admin_count_strategies(self):
+        addresses = addTestAddresses()
+        headers = { 'Content-type': 'application/json', 'x-access-token': 'somefaketoken' }
+        url = '/address/admin/address?count='
+
+        response = self.client.get(url+'exact', headers=headers)
+        self.assertEqual(response.json.get('total_records'), 6)
+        self.assertEqual(response.json.get('total_records_strategy'), 'exact')
+
+        # counter is seeded on first use and then kept up to date
+        response = self.client.get(url+'counter', headers=headers)
+        self.assertEqual(response.json.get('total_records'), 6)
+        self.assertEqual(response.json.get('total_records_strategy'), 'counter')
+        response = self.client.delete('/address/'+addresses[0].address_id, headers=headers)
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get(url+'counter', headers=headers)
+        self.assertEqual(response.json.get('total_records'), 5)
+
+        db.session.execute('ANALYZE address')
+        response = self.client.get(url+'estimated', headers=headers)
+        self.assertEqual(response.json.get('total_records'), 5)
+        self.assertEqual(response.json.get('total_records_strategy'), 'estimated')
+
+        response = self.client.get(url+'guess', headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+# -----------------------------------------------------------------------------
+
+    def test_address_counter_seed_waits_for_writers(self):
+        import threading
+        from app.counts import _seed_address_counter
+        addresses = addTestAddresses()
+        # a delete in flight while the counter doesn't exist yet - its
+        # adjust_address_count would do nothing
+        writer = db.engine.connect()
+        transaction = writer.begin()
+        seeded = []
+        def seed():
+            with self.app.app_context():
+                seeded.append(_seed_address_counter())
+        seeder = threading.Thread(target=seed)
+        try:
+            writer.execute(Address.__table__.delete()\
+                                            .where(Address.address_id == addresses[0].address_id))
+            seeder.start()
+            seeder.join(0.5)
+            waited = seeder.is_alive()
+            transaction.commit()
+        finally:
+            if transaction.is_active:
+                transaction.rollback()
+            writer.close()
+        seeder.join(5)
+        self.assertTrue(waited)
+        self.assertEqual(seeded, [5])
+
+# -----------------------------------------------------------------------------
+
+    def test_admin_export_streams_all_addresses(self):
+        import json, csv, io
+        addresses = addTestAddresses()
+        self.app.config['EXPORT_BATCH_SIZE'] = 4
+        headers = { 'Content-type': 'application/json', 'x-access-token': 'somefaketoken' }
+
+        response = self.client.get('/address/admin/export', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.is_streamed)
+        lines = response.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(json.loads(lines[0]).get('address_id'), addresses[0].address_id)
+        self.assertEqual(json.loads(lines[0]).get('country_code'), 'GBR')
+
+        response = self.client.get('/address/admin/export?format=csv', headers=headers)
+        rows = list(csv.reader(io.StringIO(response.get_data(as_text=True))))
+        self.assertEqual(len(rows), 7)
+        self.assertEqual(rows[0][0], 'address_id')
+
+        # nothing has been created since the future
+        response = self.client.get('/address/admin/export?created=2999-01-01T00:00:00Z',
+                                   headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.get_data(as_text=True), '')
+
+        response = self.client.get('/address/admin/export?created=yesterday', headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+# -----------------------------------------------------------------------------
+
+    def test_create_batch(self):
+        countries = addTestCountries()
+        headers = { 'Content-type': 'application/json', 'x-access-token': 'somefaketoken' }
+        batch_json = { 'addresses': [
+                         { 'house_number': '12',
+                           'address_line_1': 'Green Lane',
+                           'iso_code': 'GBR',
+                           'post_zip_code': 'LE13 5WI' },
+                         { 'house_number': '12',
+                           'iso_code': 'GBR',
+                           'post_zip_code': 'X999342' },
+                         { 'house_name': 'Sitío Trinca Ferro',
+                           'iso_code': 'BRA',
+                           'post_zip_code': '239700-000' },
+                         { 'house_name': 'Nowhere',
+                           'iso_code': 'ZZZ' },
+                         'not an address' ] }
+
+        response = self.client.post('/address/batch', json=batch_json, headers=headers)
+        self.assertEqual(response.status_code, 201)
+        results = response.json.get('results')
+        self.assertEqual(len(results), 5)
+        self.assertTrue('address_id' in results[0])
+        self.assertTrue('error' in results[1])
+        self.assertTrue('address_id' in results[2])
+        self.assertTrue('error' in results[3])
+        self.assertTrue('error' in results[4])
+
+        response = self.client.get('/address/'+results[2].get('address_id'), headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json.get('country'), 'Brazil')
+        self.assertEqual(db.session.query(Address).count(), 2)
+
+        batch_json = { 'addresses': [ { 'iso_code': 'GBR' } ] * 101 }
+        response = self.client.post('/address/batch', json=batch_json, headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+# -----------------------------------------------------------------------------
+
+    def test_get_many_addresses(self):
+        import uuid
+        addresses = addTestAddresses()
+        headers = { 'Content-type': 'application/json', 'x-access-token': 'somefaketoken' }
+        missing_id = str(uuid.uuid4())
+        wanted = [addresses[2].address_id, missing_id, addresses[0].address_id]
+
+        response = self.client.get('/address/multi?ids='+','.join(wanted), headers=headers)
+        self.assertEqual(response.status_code, 200)
+        results = response.json
+        self.assertEqual([addy.get('address_id') for addy in results.get('addresses')],
+                         [addresses[2].address_id, addresses[0].address_id])
+        self.assertEqual(results.get('not_found'), [missing_id])
+        self.assertEqual(results.get('addresses')[1].get('post_zip_code'), 'SW9 4RF')
+
+        response = self.client.post('/address/multi', json={ 'address_ids': wanted },
+                                    headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json.get('addresses')), 2)
+
+        response = self.client.get('/address/multi?ids=notauuid', headers=headers)
+        self.assertEqual(response.status_code, 400)
+
+        response = self.client.get('/address/multi?ids='+missing_id, headers=headers)
+        self.assertEqual(response.status_code, 404)
+
+# -----------------------------------------------------------------------------
+
+    def test_address_list_newest_first(self):
+        import datetime
+        addresses = addTestAddresses()
+        mine = [addy for addy in addresses if addy.public_id == getPublicID()]
+        for days, addy in zip((2, 0, 1), mine):
+            addy.created = datetime.datetime(2020, 1, 1) + datetime.timedelta(days=days)
+        db.session.commit()
+        headers = { 'Content-type': 'application/json', 'x-access-token': 'somefaketoken' }
+        response = self.client.get('/address', headers=headers)
+        self.assertEqual([addy.get('address_id') for addy in response.json.get('addresses')],
+                         [mine[0].address_id, mine[2].address_id, mine[1].address_id])
+
+# -----------------------------------------------------------------------------
+
+    def test_address_list_cached_until_changed(self):
+        from app.extensions import address_cache
+        addresses = addTestAddresses()
+        headers = { 'Content-type': 'application/json', 'x-access-token': 'somefaketoken' }
+        response = self.client.get('/address', headers=headers)
+        self.assertEqual(len(response.json.get('addresses')), 3)
+        response = self.client.get('/address', headers=headers)
+        self.assertEqual(len(response.json.get('addresses')), 3)
+        self.assertEqual(address_cache.stats().get('hits'), 1)
+
+        response = self.client.delete('/address/'+addresses[0].address_id, headers=headers)
+        self.assertEqual(response.status_code, 204)
+        response = self.client.get('/address', headers=headers)
+        self.assertEqual(len(response.json.get('addresses')), 2)
+
+        create_json = { 'house_number': '12', 'iso_code': 'GBR', 'post_zip_code': 'LE13 5WI' }
+        response = self.client.post('/address', json=create_json, headers=headers)
+        self.assertEqual(response.status_code, 201)
+        response = self.client.get('/address', headers=headers)
+        self.assertEqual(len(response.json.get('addresses')), 3)
+
+        stats = address_cache.stats()
+        self.assertEqual(stats.get('hits'), 1)
+        self.assertEqual(stats.get('invalidations'), 2)
+
+# -----------------------------------------------------------------------------
+
+    def test_address_list_read_racing_a_write_not_cached(self):
+        from app.extensions import address_cache
+        from app.main import views
+        addresses = addTestAddresses()
+        headers = { 'Content-type': 'application/json', 'x-access-token': 'somefaketoken' }
+        real_run = views.run
+
+        def read_then_delete(statement, **params):
+            # the rows are read, then a delete commits before the list is cached
+            rows = real_run(statement, **params).fetchall()
+            db.session.query(Address).filter(Address.address_id == addresses[0].address_id).delete()
+            db.session.commit()
+            address_cache.invalidate(getPublicID())
+            return MagicMock(fetchall=MagicMock(return_value=rows))
+
+        with patch('app.main.views.run', side_effect=read_then_delete):
+            response = self.client.get('/address', headers=headers)
+        self.assertEqual(len(response.json.get('addresses')), 3)
+
+        response = self.client.get('/address', headers=headers)
+        self.assertEqual(len(response.json.get('addresses')), 2)
+        self.assertEqual(address_cache.stats().get('hits'), 0)
+
+        # a list read after the invalidate is cached as normal
+        response = self.client.get('/address', headers=headers)
+        self.assertEqual(len(response.json.get('addresses')), 2)
+        self.assertEqual(address_cache.stats().get('hits'), 1)
+
+# -----------------------------------------------------------------------------
+
+    def test_shared_address_cache_backend(self):
+        from app.cache import build_backend, ResponseCache, SharedBackend
+        first_worker, second_worker = ResponseCache(), ResponseCache()
+        first_worker.configure(build_backend('shared', None, 10, 60))
+        second_worker.configure(build_backend('shared', None, 10, 60))
+        self.assertTrue(isinstance(first_worker.backend, SharedBackend))
+        first_worker.set('somepublicid', b'{"addresses": []}')
+        self.assertEqual(second_worker.get('somepublicid'), b'{"addresses": []}')
+        second_worker.invalidate('somepublicid')
+        self.assertIsNone(first_worker.get('somepublicid'))
+        self.assertIsNone(build_backend('none', None, 10, 60))
+
+# -----------------------------------------------------------------------------
+
+    def test_invalidated_entry_not_served_after_eviction(self):
+        from app.cache import build_backend, ResponseCache, SharedBackend, LocalSharedClient
+        cache = ResponseCache()
+        cache.configure(build_backend('local', None, 3, 60))
+        version = cache.version('somepublicid')
+        cache.invalidate('somepublicid')
+        # a read that started before the invalidate caches its stale list
+        cache.set('somepublicid', b'{"addresses": []}', version)
+        for n in range(10):
+            cache.set('otherpublicid%d' % n, b'{"addresses": []}')
+            # keeps the stale entry recently used
+            self.assertIsNotNone(cache.backend.get('somepublicid'))
+        self.assertIsNone(cache.get('somepublicid'))
+
+        # shared entries and their versions are read in one round trip
+        client = LocalSharedClient()
+        cache.configure(SharedBackend(client, 60))
+        cache.set('somepublicid', b'{"addresses": []}')
+        with patch.object(client, 'get', side_effect=AssertionError):
+            self.assertEqual(cache.get('somepublicid'), b'{"addresses": []}')
+
+# -----------------------------------------------------------------------------
+
+    def test_country_index(self):
+        from app.countries import country_cache
+        countries = addTestCountries()
+        self.assertEqual(country_cache.lookup('DEU'), (countries[1].id, 'Germany'))
+        self.assertIsNone(country_cache.lookup('ESP'))
+        self.assertIsNone(country_cache.lookup(['GBR']))
+        with self.assertRaises(TypeError):
+            country_cache.index()['ESP'] = (99, 'Spain')
+
+        # reloading countries refreshes the index
+        spain = Country(name = "Spain", iso_code = "ESP")
+        db.session.add(spain)
+        db.session.commit()
+        self.assertEqual(country_cache.lookup('ESP'), (spain.id, 'Spain'))
+
+# -----------------------------------------------------------------------------
+
+    def test_empty_countries_not_cached_for_ttl(self):
+        import time
+        from app.countries import country_cache
+        headers = { 'Content-type': 'application/json' }
+        response = self.client.get('/address/countries', headers=headers)
+        self.assertEqual(response.json, { 'countries': [] })
+        self.assertTrue('no-cache' in response.headers.get('Cache-Control'))
+        self.assertTrue('max-age' not in response.headers.get('Cache-Control'))
+        self.assertIsNone(country_cache.lookup('GBR'))
+
+        # loaded by another process, so no commit here to drop the cache
+        db.session.execute(Country.__table__.insert().values(name='United Kingdom', iso_code='GBR'))
+        db.session.commit()
+        self.assertIsNone(country_cache.lookup('GBR'))
+        # and picked up once the short retry is up rather than the full ttl
+        later = time.monotonic() + country_cache.empty_retry + 1
+        with patch('app.countries.time.monotonic', return_value=later):
+            self.assertEqual(country_cache.lookup('GBR')[1], 'United Kingdom')
+            response = self.client.get('/address/countries', headers=headers)
+        self.assertTrue('max-age' in response.headers.get('Cache-Control'))
+
+# -----------------------------------------------------------------------------
+
+    def test_explain_queries_command(self):
+        runner = self.app.test_cli_runner()
+        result = runner.invoke(args=['explain-queries', '--seed', '50'])
+        self.assertEqual(result.exit_code, 0)
+        self.assertTrue('-- GET /address\n' in result.output)
+        self.assertTrue('-- DELETE /address/<uuid>' in result.output)
+        # seeded rows are rolled back afterwards
+        self.assertEqual(db.session.query(Address).count(), 0)
+
+        result = runner.invoke(args=['explain-queries'])
+        self.assertNotEqual(result.exit_code, 0)
+
+# -----------------------------------------------------------------------------
+
+    def test_uuid_columns_keep_string_representation(self):
+        addresses = addTestAddresses()
+        column_type = db.session.execute("SELECT data_type FROM information_schema.columns "
+                                         "WHERE table_name = 'address' "
+                                         "AND column_name = 'public_id'").scalar()
+        self.assertEqual(column_type, 'uuid')
+        address = Address.query.filter(Address.address_id == addresses[0].address_id).first()
+        self.assertEqual(address.public_id, getPublicID())
+        headers = { 'Content-type': 'application/json', 'x-access-token': 'somefaketoken' }
+        response = self.client.get('/address', headers=headers)
+        returned_ids = [addy.get('address_id') for addy in response.json.get('addresses')]
+        self.assertTrue(addresses[0].address_id in returned_ids)
+
+# -----------------------------------------------------------------------------
+
+    def test_serializers_and_json_encoders(self):
+        import json
+        from app.serializers import address_serializer, one_address_serializer, dumps
+        addresses = addTestAddresses()
+        rows = db.session.query(Address.address_id, Address.house_name, Address.house_number,
+                                Address.address_line_1, Address.address_line_2,
+                                Address.address_line_3, Address.state_region_county,
+                                Country.name, Country.iso_code, Address.post_zip_code)\
+                         .join(Country).order_by(Address.id).all()
+        output = address_serializer.many(rows)
+        self.assertEqual(output[0].get('address_id'), addresses[0].address_id)
+        self.assertEqual(output[0].get('country'), 'United Kingdom')
+        self.assertEqual(output[0].get('country_code'), 'GBR')
+        self.assertTrue('address_id' not in one_address_serializer.one(rows[0]))
+
+        # fast and standard encoders give the same json
+        fast = dumps({ 'addresses': output })
+        self.app.config['JSON_FAST_ENCODER'] = False
+        standard = dumps({ 'addresses': output })
+        self.assertEqual(json.loads(fast.decode('utf-8')), json.loads(standard.decode('utf-8')))
+
+# -----------------------------------------------------------------------------
+
+    def test_read_statements_compiled_once(self):
+        from app.queries import compiled_cache, ONE_ADDRESS, MANY_ADDRESSES, run, USER_ADDRESSES
+        addresses = addTestAddresses()
+        headers = { 'Content-type': 'application/json', 'x-access-token': 'somefaketoken' }
+        for address in addresses[:3]:
+            response = self.client.get('/address/'+address.address_id, headers=headers)
+            self.assertEqual(response.status_code, 200)
+        for ids in (addresses[:1], addresses[:3]):
+            url = '/address/multi?ids='+','.join(address.address_id for address in ids)
+            response = self.client.get(url, headers=headers)
+            self.assertEqual(len(response.json.get('addresses')), len(ids))
+
+        def compiled(statement):
+            return [key for key in compiled_cache(db.engine) if statement in key]
+
+        self.assertEqual(len(compiled(ONE_ADDRESS)), 1)
+        self.assertEqual(len(compiled(MANY_ADDRESSES)), 1)
+
+        # rows are plain result rows rather than orm objects
+        rows = run(USER_ADDRESSES, public_id=getPublicID()).fetchall()
+        self.assertEqual(len(rows), 3)
+        self.assertFalse(isinstance(rows[0], Address))
+        self.assertEqual(rows[0].iso_code, rows[0]['iso_code'])
+
+# -----------------------------------------------------------------------------
+
+    def test_admin_pool_stats(self):
+        addTestAddresses()
+        headers = { 'Content-type': 'application/json', 'x-access-token': 'somefaketoken' }
+        response = self.client.get('/address/admin/pool', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        stats = response.json.get('default')
+        self.assertEqual(stats.get('pool'), 'TimedQueuePool')
+        self.assertTrue(stats.get('checkouts') >= 1)
+        self.assertEqual(stats.get('in_use'), stats.get('checked_out'))
+        self.assertTrue(stats.get('wait_max') >= stats.get('wait_avg') >= 0)
+
+# -----------------------------------------------------------------------------
+
+    def test_engine_statement_timeout_and_pgbouncer_mode(self):
+        from app.database import TimedQueuePool, TimedNullPool
+
+        class PooledConfig(TestConfig):
+            DB_STATEMENT_TIMEOUT = 1234
+
+        class PgBouncerConfig(PooledConfig):
+            DB_PGBOUNCER = True
+
+        for config_class, pool_class in ((PooledConfig, TimedQueuePool),
+                                         (PgBouncerConfig, TimedNullPool)):
+            engine = db.get_engine(create_app(config_class))
+            try:
+                self.assertTrue(isinstance(engine.pool, pool_class))
+                with engine.connect() as connection:
+                    with connection.begin():
+                        timeout = connection.execute('SHOW statement_timeout').scalar()
+                self.assertEqual(timeout, '1234ms')
+                self.assertEqual(engine.pool.stats().get('in_use'), 0)
+            finally:
+                engine.dispose()
+
+# -----------------------------------------------------------------------------
+
+    def test_reads_routed_to_replica(self):
+        # the "replica" is just a second, empty database with the same tables
+        # so we can tell which one a request read from
+        import os
+        replica_uri = os.getenv('SQLALCHEMY_TESTDB_REPLICA_URI')
+        if not replica_uri:
+            self.skipTest('SQLALCHEMY_TESTDB_REPLICA_URI not set')
+
+        class ReplicaConfig(TestConfig):
+            DB_REPLICA_URIS = [replica_uri]
+
+        addTestAddresses()
+        db.session.remove()
+        replica_app = create_app(ReplicaConfig)
+        headers = { 'Content-type': 'application/json', 'x-access-token': 'somefaketoken' }
+        with replica_app.app_context():
+            replica = db.get_engine(replica_app, bind='replica_0')
+            db.Model.metadata.create_all(bind=replica)
+            try:
+                client = replica_app.test_client()
+                response = client.get('/address', headers=headers)
+                self.assertEqual(response.status_code, 404)
+
+                # writes go to the primary and then reads follow them there
+                create_data = { 'house_number': '1', 'address_line_1': 'Replica Road',
+                                'post_zip_code': 'RE1 1RE', 'iso_code': 'GBR' }
+                response = client.post('/address', json=create_data, headers=headers)
+                self.assertEqual(response.status_code, 201)
+                response = client.get('/address', headers=headers)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(len(response.json.get('addresses')), 4)
+
+                response = client.get('/address/admin/pool', headers=headers)
+                self.assertTrue(response.json.get('replica_0').get('checkouts') >= 1)
+            finally:
+                db.session.remove()
+                db.Model.metadata.drop_all(bind=replica)
+                replica.dispose()
+
+# -----------------------------------------------------------------------------
+
+    def test_metrics_route_and_phases(self):
+        import json, os, tempfile
+        from app.metrics import request_metrics, Histogram
+        addTestAddresses()
+        headers = { 'Content-type': 'application/json', 'x-access-token': 'somefaketoken' }
+        self.assertEqual(self.client.get('/address', headers=headers).status_code, 200)
+        create_data = { 'house_number': '7', 'address_line_1': 'Metric Mews',
+                        'post_zip_code': 'ME7 7ME', 'iso_code': 'GBR' }
+        self.assertEqual(self.client.post('/address', json=create_data, headers=headers).status_code, 201)
+
+        response = self.client.get('/address/admin/metrics', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.content_type.startswith('text/plain'))
+        text = response.get_data(as_text=True)
+        self.assertTrue('address_requests_total{method="GET",route="/address",status="2xx"} 1' in text)
+        self.assertTrue('address_request_phase_seconds_count{method="GET",phase="db",route="/address"} 1' in text)
+        self.assertTrue('address_request_phase_seconds_count{method="GET",phase="serialization",route="/address"} 1' in text)
+        self.assertTrue('address_request_phase_seconds_count{method="POST",phase="validation",route="/address"} 1' in text)
+        self.assertTrue('method="GET",quantile="0.99",route="/address"' in text)
+
+        # totals flushed by other workers are added in
+        with tempfile.TemporaryDirectory() as metrics_dir:
+            request_metrics.directory = metrics_dir
+            try:
+                other = Histogram()
+                for _ in range(4):
+                    other.observe(0.2)
+                with open(os.path.join(metrics_dir, 'metrics_999999.json'), 'w') as metrics_file:
+                    json.dump({ 'requests': [['/address', 'GET', '2xx', 4]],
+                                'durations': [['/address', 'GET', other.counts, other.total]],
+                                'phases': [] }, metrics_file)
+                text = request_metrics.render()
+            finally:
+                request_metrics.directory = None
+        self.assertTrue('address_requests_total{method="GET",route="/address",status="2xx"} 5' in text)
+        self.assertTrue('address_request_duration_seconds_count{method="GET",route="/address"} 5' in text)
+
+        histogram = Histogram()
+        for millis in range(1, 101):
+            histogram.observe(millis / 1000.0)
+        self.assertTrue(0.025 <= histogram.quantile(0.5) <= 0.05)
+        self.assertTrue(0.05 <= histogram.quantile(0.99) <= 0.1)
+
+# -----------------------------------------------------------------------------
+
+    def test_metrics_files_survive_pid_reuse_and_worker_exit(self):
+        import os, tempfile, time
+        from app.metrics import RequestMetrics, ARCHIVE_FILE, DEAD_AFTER
+        with tempfile.TemporaryDirectory() as metrics_dir:
+            self.app.config['METRICS_DIR'] = metrics_dir
+            self.app.config['METRICS_FLUSH_INTERVAL'] = 3600
+            old_worker, new_worker = RequestMetrics(), RequestMetrics()
+            try:
+                # a recycled worker given the same pid as the one it replaced
+                old_worker.init_app(self.app)
+                new_worker.init_app(self.app)
+                self.assertEqual(old_worker.pid, new_worker.pid)
+                for _ in range(3):
+                    old_worker.observe('/address', 'GET', 200, 0.01, {})
+                old_worker.flush()
+                new_worker.observe('/address', 'GET', 200, 0.01, {})
+                new_worker.flush()
+                requests = new_worker.collect()[0]
+                self.assertEqual(requests[('/address', 'GET', '2xx')], 4)
+
+                # the old worker exits - its totals move to the archive
+                old_worker.stop()
+                old_file = os.path.join(metrics_dir, old_worker.filename)
+                long_ago = time.time() - 3600 * DEAD_AFTER - 60
+                os.utime(old_file, (long_ago, long_ago))
+                requests = new_worker.collect()[0]
+                self.assertEqual(requests[('/address', 'GET', '2xx')], 4)
+                self.assertFalse(os.path.exists(old_file))
+                self.assertTrue(os.path.exists(os.path.join(metrics_dir, ARCHIVE_FILE)))
+                self.assertEqual(new_worker.collect()[0][('/address', 'GET', '2xx')], 4)
+
+                # totals are written in the background, without another request
+                self.app.config['METRICS_FLUSH_INTERVAL'] = 0.05
+                idle_worker = RequestMetrics()
+                idle_worker.init_app(self.app)
+                idle_worker.observe('/address', 'POST', 201, 0.01, {})
+                time.sleep(0.3)
+                idle_worker.stop()
+                self.assertTrue(os.path.exists(os.path.join(metrics_dir, idle_worker.filename)))
+            finally:
+                old_worker.stop()
+                new_worker.stop()
+
+# -----------------------------------------------------------------------------
+
+    def test_route_query_budgets(self):
+        from app.querylog import record_queries
+        addresses = addTestAddresses()
+        headers = { 'Content-type': 'application/json', 'x-access-token': 'somefaketoken' }
+
+        url = '/address/'+addresses[0].address_id
+        ids = ','.join(address.address_id for address in addresses)
+
+        with record_queries() as queries:
+            response = self.client.get(url, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 1)
+
+        # one lookup for the list however many ids are asked for
+        with record_queries() as queries:
+            response = self.client.get('/address/multi?ids='+ids, headers=headers)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(queries), 1)
+        self.assertEqual(queries.repeated(2), [])
+
+# -----------------------------------------------------------------------------
+
+    def test_slow_and_repeated_queries_logged(self):
+        from app.querylog import query_log, record_queries, normalize_sql, parameter_shape
+        self.assertEqual(normalize_sql("SELECT a FROM t WHERE id IN (%(id_1)s, %(id_2)s)\n AND b = 'x' LIMIT 10"),
+                         "SELECT a FROM t WHERE id IN (...) AND b = ? LIMIT ?")
+        self.assertEqual(parameter_shape({ 'limit': 3, 'ids': ['a', 'b'] }),
+                         '{ids: list[2], limit: int}')
+        self.assertEqual(parameter_shape([{ 'a': 1 }, { 'a': 2 }], executemany=True), '2 x {a: int}')
+
+        query_log.slow_ms = 0.000001
+        try:
+            with self.assertLogs('app.sql.slow', level='WARNING') as logs:
+                db.session.execute('SELECT pg_sleep(0)')
+        finally:
+            query_log.slow_ms = float(self.app.config['SQL_SLOW_QUERY_MS'])
+        self.assertTrue('SELECT pg_sleep(?)' in logs.output[0])
+
+        with self.app.test_request_context('/address'):
+            query_log._start_request()
+            with record_queries() as queries:
+                for number in range(5):
+                    db.session.execute('SELECT :number', { 'number': number })
+            with self.assertLogs('app.sql', level='WARNING') as logs:
+                query_log._end_request(None)
+        self.assertEqual(len(queries), 5)
+        self.assertTrue('possible n+1' in logs.output[0])
+
+# -----------------------------------------------------------------------------
+
+    def test_sampled_request_traced(self):
+        from app.tracing import tracer, MemoryExporter
+        addresses = addTestAddresses()
+        exporter = MemoryExporter()
+        tracer.configure(1.0, exporter)
+        try:
+            headers = { 'Content-type': 'application/json', 'x-access-token': 'somefaketoken',
+                        'X-Trace-Id': 'abc123' }
+            response = self.client.get('/address', headers=headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.headers.get('X-Trace-Id'), 'abc123')
+            self.assertTrue(tracer.flush())
+        finally:
+            tracer.configure(0.0, MemoryExporter())
+
+        spans = dict((span['name'], span) for span in exporter.spans)
+        self.assertEqual(set(span['trace_id'] for span in exporter.spans), set(['abc123']))
+        self.assertTrue(set(['request', 'db', 'serialization']) <= set(spans))
+        root = spans['request']
+        self.assertEqual(root['attributes'].get('route'), '/address')
+        self.assertEqual(root['attributes'].get('status'), 200)
+        self.assertEqual(spans['db']['parent_id'], root['span_id'])
+        self.assertTrue('WHERE address.public_id = ?' in spans['db']['attributes']['statement'])
+
+# -----------------------------------------------------------------------------
+
+    def test_trace_passed_to_authy_and_exported_as_json_lines(self):
+        import json, os, tempfile
+        from app.services import call_requests
+        from app.tracing import tracer, JsonLinesExporter, MemoryExporter
+        with tempfile.TemporaryDirectory() as trace_dir:
+            filename = os.path.join(trace_dir, 'traces.jsonl')
+            tracer.configure(1.0, JsonLinesExporter(filename))
+            try:
+                with self.app.test_request_context('/address', headers={ 'X-Trace-Id': 'feed' }):
+                    tracer._start_request()
+                    with patch('app.services.authy_client.get') as mock_get:
+                        mock_get.return_value = MagicMock(status_code=200)
+                        call_requests('http://authy/checkaccess/10', { 'x-access-token': 'x' })
+                    tracer._teardown_request(None)
+                sent = mock_get.call_args[0][1]
+                self.assertTrue(tracer.flush())
+            finally:
+                tracer.configure(0.0, MemoryExporter())
+
+            with open(filename) as trace_file:
+                spans = [json.loads(line) for line in trace_file]
+
+        self.assertEqual(sent.get('X-Trace-Id'), 'feed')
+        self.assertEqual(sent.get('X-Trace-Sampled'), '1')
+        self.assertEqual(sent.get('x-access-token'), 'x')
+        authy = [span for span in spans if span['name'] == 'authy'][0]
+        self.assertEqual(authy['attributes'].get('status'), 200)
+        self.assertEqual(sent.get('X-Parent-Span-Id'), authy['span_id'])
+
+# -----------------------------------------------------------------------------
+
+    def test_admin_profile_header(self):
+        import os, pstats, tempfile
+        from app.profiler import request_profiler
+        addTestAddresses()
+        self.app.config['CHECK_ACCESS_URL'] = 'http://authy'
+        authy_response = MagicMock(status_code=200)
+        authy_response.json.return_value = { 'public_id': getPublicID() }
+        headers = { 'Content-type': 'application/json', 'x-access-token': 'admintoken',
+                    'X-Profile': '1' }
+        with tempfile.TemporaryDirectory() as profile_dir:
+            request_profiler.directory = profile_dir
+            request_profiler.max_per_window = 1
+            try:
+                with patch('app.decorators.call_requests', return_value=authy_response) as authy:
+                    response = self.client.get('/address', headers=headers)
+                    self.assertEqual(authy.call_args[0][0], 'http://authy/authy/checkaccess/5')
+                    path = response.headers.get('X-Profile-Path')
+                    self.assertTrue(path.startswith(profile_dir))
+                    self.assertTrue('_GET_address_' in os.path.basename(path))
+                    self.assertTrue(pstats.Stats(path).total_calls > 0)
+
+                    # over the cap the request still runs but is not profiled
+                    response = self.client.get('/address', headers=headers)
+                    self.assertEqual(response.status_code, 200)
+                    self.assertEqual(response.headers.get('X-Profile-Path'), None)
+                    self.assertEqual(response.headers.get('X-Profile-Skipped'), 'rate limited')
+
+                # not an admin - no profile
+                authy_response.status_code = 401
+                with patch('app.decorators.call_requests', return_value=authy_response):
+                    response = self.client.get('/address', headers=dict(headers, **{ 'x-access-token': 'usertoken' }))
+                self.assertEqual(response.headers.get('X-Profile-Skipped'), None)
+                self.assertEqual(len(request_profiler._profiles()), 1)
+            finally:
+                request_profiler.directory = self.app.config['PROFILE_DIR']
+                request_profiler.max_per_window = self.app.config['PROFILE_MAX_PER_WINDOW']
+
+# -----------------------------------------------------------------------------
+
+    def test_profile_reservations_capped_and_pruned(self):
+        import os, tempfile, threading, time
+        from app.profiler import RequestProfiler
+        profiler = RequestProfiler()
+        profiler.max_per_window = 2
+        profiler.max_files = 3
+        start = threading.Barrier(8)
+        reserved = []
+
+        def reserve():
+            with self.app.test_request_context('/address'):
+                start.wait()
+                reserved.append(profiler._reserve())
+
+        with tempfile.TemporaryDirectory() as profile_dir:
+            profiler.directory = profile_dir
+            # racing requests can't take more than the cap between them, even
+            # when counting the profiles is slow
+            getmtime = os.path.getmtime
+
+            def slow_getmtime(filename):
+                time.sleep(0.01)
+                return getmtime(filename)
+
+            with patch('app.profiler.os.path.getmtime', side_effect=slow_getmtime):
+                threads = [threading.Thread(target=reserve) for _ in range(8)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+            self.assertEqual(len([path for path in reserved if path is not None]), 2)
+
+            # once the window has passed the oldest profiles are deleted
+            for n in range(3):
+                for mtime, filename in profiler._profiles():
+                    os.utime(filename, (mtime - 3600, mtime - 3600))
+                with self.app.test_request_context('/address'):
+                    newest = profiler._reserve()
+            profiles = [filename for mtime, filename in profiler._profiles()]
+            self.assertEqual(len(profiles), 3)
+            self.assertTrue(newest in profiles)
+
+# -----------------------------------------------------------------------------
+
+    def test_log_pipeline_json_request_id(self):
+        import json, os, tempfile
+        from app.logs import log_pipeline
+        from app.tracing import tracer
+        with tempfile.TemporaryDirectory() as log_dir:
+            filename = os.path.join(log_dir, 'logfile')
+            self.app.config['LOG_FORMAT'] = 'json'
+            self.app.config['LOG_FILENAME'] = filename
+            try:
+                log_pipeline.configure(self.app)
+                with self.app.test_request_context('/address', headers={ 'X-Trace-Id': 'cafe' }):
+                    tracer._start_request()
+                    self.app.logger.error("inside %s", 'request')
+                    tracer._teardown_request(None)
+                self.app.logger.error("outside")
+                log_pipeline.flush()
+                with open(filename) as log_file:
+                    lines = [json.loads(line) for line in log_file]
+            finally:
+                self.app.config['LOG_FORMAT'] = TestConfig.LOG_FORMAT
+                self.app.config['LOG_FILENAME'] = TestConfig.LOG_FILENAME
+                log_pipeline.configure(self.app)
+
+        self.assertEqual([(line['message'], line['request_id']) for line in lines],
+                         [('inside request', 'cafe'), ('outside', '-')])
+        self.assertEqual(lines[0]['level'], 'ERROR')
+
+# -----------------------------------------------------------------------------
+
+    def test_log_pipeline_package_loggers(self):
+        import logging, os, tempfile
+        from app.logs import log_pipeline
+        with tempfile.TemporaryDirectory() as log_dir:
+            filename = os.path.join(log_dir, 'logfile')
+            slow_filename = os.path.join(log_dir, 'slow.log')
+            self.app.config['LOG_FILENAME'] = filename
+            self.app.config['SQL_SLOW_LOG_FILENAME'] = slow_filename
+            try:
+                # as create_app does for LOG_LEVEL=WARNING
+                self.app.logger.setLevel(logging.WARNING)
+                log_pipeline.configure(self.app)
+                logging.getLogger('app.sql.slow').warning("12.0ms SELECT pg_sleep(?)")
+                logging.getLogger('app.sql').warning("possible n+1")
+                # below LOG_LEVEL
+                logging.getLogger('app.sql').debug("ran 2 statements")
+                log_pipeline.flush()
+                with open(filename) as log_file:
+                    main_log = log_file.read()
+                with open(slow_filename) as log_file:
+                    slow_log = log_file.read()
+            finally:
+                self.app.config['LOG_FILENAME'] = TestConfig.LOG_FILENAME
+                self.app.config['SQL_SLOW_LOG_FILENAME'] = TestConfig.SQL_SLOW_LOG_FILENAME
+                self.app.logger.setLevel(logging.DEBUG)
+                log_pipeline.configure(self.app)
+
+        self.assertTrue('SELECT pg_sleep(?)' in main_log)
+        self.assertTrue('possible n+1' in main_log)
+        self.assertFalse('ran 2 statements' in main_log)
+        self.assertTrue('SELECT pg_sleep(?)' in slow_log)
+        self.assertFalse('possible n+1' in slow_log)
+
+# -----------------------------------------------------------------------------
+
+    def test_primary_pin_errors_do_not_fail_writes(self):
+        from app.extensions import primary_pins
+        backend = MagicMock()
+        backend.set.side_effect = ConnectionError('down')
+        backend.get.side_effect = ConnectionError('down')
+        primary_pins.configure(backend)
+        try:
+            addTestCountries()
+            create_json = { 'public_id': getPublicID(),
+                            'house_name': 'The Larches',
+                            'address_line_1': 'Green Lane',
+                            'iso_code': 'GBR',
+                            'post_zip_code': 'LE13 5WI' }
+            create_resp = self.client.post('/address', json=create_json,
+                                           headers={ 'Content-type': 'application/json',
+                                                     'x-access-token': 'somefaketoken' })
+            self.assertEqual(create_resp.status_code, 201)
+            self.assertEqual(backend.set.call_count, 1)
+            # reads can't tell so stay on the primary
+            self.assertTrue(primary_pins.is_pinned(getPublicID()))
+            self.assertEqual(primary_pins.errors, 2)
+        finally:
+            primary_pins.configure(None)
+
+# -----------------------------------------------------------------------------
+
+    def test_trace_headers_only_trusted_when_configured(self):
+        from app.tracing import tracer, MemoryExporter
+        tracer.configure(0.0, MemoryExporter())
+        headers = { 'X-Trace-Id': 'abc123', 'X-Trace-Sampled': '1', 'X-Parent-Span-Id': 'cafe' }
+        try:
+            with self.app.test_request_context('/address', headers=headers):
+                tracer._start_request()
+                trace = tracer.current_trace()
+                self.assertIsNone(trace)
+                self.assertIsNone(tracer.propagation_headers().get('X-Parent-Span-Id'))
+                tracer._teardown_request(None)
+
+            tracer.trust_headers = True
+            with self.app.test_request_context('/address', headers=headers):
+                tracer._start_request()
+                trace = tracer.current_trace()
+                self.assertEqual((trace.trace_id, trace.parent_id), ('abc123', 'cafe'))
+                tracer._teardown_request(None)
+
+            # anyone can turn tracing off
+            tracer.configure(1.0, MemoryExporter())
+            tracer.trust_headers = False
+            with self.app.test_request_context('/address', headers={ 'X-Trace-Sampled': '0' }):
+                tracer._start_request()
+                self.assertIsNone(tracer.current_trace())
+                tracer._teardown_request(None)
+        finally:
+            tracer.trust_headers = False
+            tracer.configure(0.0, MemoryExporter())
+
+# -----------------------------------------------------------------------------
+
+    def test_log_sampling_and_dropping(self):
+        import logging, queue
+        from app.logs import SamplingFilter, DroppingQueueHandler, parse_sample_rates
+        rates = parse_sample_rates('debug=0, INFO=1,nonsense,BOGUS=0.5')
+        self.assertEqual(rates, { logging.DEBUG: 0.0, logging.INFO: 1.0 })
+        sampler = SamplingFilter(rates)
+        record = lambda level: logging.LogRecord('app', level, __file__, 1, 'msg', None, None)
+        self.assertFalse(sampler.filter(record(logging.DEBUG)))
+        self.assertTrue(sampler.filter(record(logging.INFO)))
+        self.assertTrue(sampler.filter(record(logging.WARNING)))
+
+        # a full queue drops records instead of blocking the caller
+        handler = DroppingQueueHandler(queue.Queue(maxsize=1), MagicMock())
+        handler.handle(record(logging.INFO))
+        handler.handle(record(logging.INFO))
+        self.assertEqual(handler.queue.qsize(), 1)
+        self.assertEqual(handler.dropped, 1)
+
+# -----------------------------------------------------------------------------
+
+    def test_shared_rate_limit_storage(self):
+        import os, tempfile
+        from limits import parse
+        from limits.storage import storage_from_string
+        from limits.strategies import FixedWindowRateLimiter
+        from app.ratelimit import SqliteStorage, SharedStorage
+        limit = parse('3/minute')
+        with tempfile.TemporaryDirectory() as storage_dir:
+            for uri in ('sqlite:///'+os.path.join(storage_dir, 'ratelimit.db'), 'shared://'):
+                # two workers share one limit between them
+                first = storage_from_string(uri, sync_interval=0)
+                second = storage_from_string(uri, sync_interval=0)
+                first.reset()
+                self.assertTrue(isinstance(first, (SqliteStorage, SharedStorage)))
+                first_limiter = FixedWindowRateLimiter(first)
+                second_limiter = FixedWindowRateLimiter(second)
+                self.assertTrue(first_limiter.hit(limit, '127.0.0.1'))
+                self.assertTrue(second_limiter.hit(limit, '127.0.0.1'))
+                self.assertTrue(first_limiter.hit(limit, '127.0.0.1'))
+                self.assertFalse(second_limiter.hit(limit, '127.0.0.1'))
+                self.assertTrue(second_limiter.hit(limit, '10.0.0.1'))
+                first.reset()
+
+# -----------------------------------------------------------------------------
+
+    def test_shared_rate_limit_batches_hits(self):
+        from limits.storage import storage_from_string
+        storage = storage_from_string('shared://', sync_interval=60)
+        other = storage_from_string('shared://', sync_interval=0)
+        storage.reset()
+        try:
+            # the first hit in a window syncs, the rest are counted locally
+            for count in range(1, 6):
+                self.assertEqual(storage.incr('limit/key', 60), count)
+            self.assertEqual(storage.syncs, 1)
+            self.assertEqual(other.incr('limit/key', 60), 2)
+
+            storage.flush()
+            self.assertEqual(storage.syncs, 2)
+            self.assertEqual(other.incr('limit/key', 60), 7)
+            self.assertTrue(storage.check())
+
+            # unreachable storage - keep counting in this worker
+            storage.counters = MagicMock()
+            storage.counters.add.side_effect = ConnectionError('down')
+            storage.sync_interval = 0
+            self.assertEqual(storage.incr('limit/key', 60), 7)
+            self.assertEqual(storage.errors, 1)
+        finally:
+            other.reset()
+
+# -----------------------------------------------------------------------------
+
+    def test_shared_rate_limit_syncs_near_the_limit(self):
+        from limits import parse
+        from limits.storage import storage_from_string
+        from limits.strategies import FixedWindowRateLimiter
+        limit = parse('4/minute')
+        first = storage_from_string('shared://', sync_interval=60, sync_fraction=0.5)
+        second = storage_from_string('shared://', sync_interval=60, sync_fraction=0.5)
+        first.reset()
+        try:
+            # past half the limit every hit syncs, so the two workers
+            # together let no more than the limit through
+            limiters = [FixedWindowRateLimiter(first), FixedWindowRateLimiter(second)]
+            allowed = [limiters[n % 2].hit(limit, '127.0.0.1') for n in range(10)]
+            self.assertEqual(allowed.count(True), 4)
+            self.assertEqual(first.syncs + second.syncs, 10)
+
+            # well under the limit hits are still batched
+            allowed = [limiters[0].hit(parse('100/minute'), '127.0.0.1') for n in range(10)]
+            self.assertTrue(all(allowed))
+            self.assertEqual(first.syncs, 6)
+        finally:
+            first.reset()
+
+# -----------------------------------------------------------------------------
+
+    def test_rate_limit_storage_url(self):
+        from app.extensions import limiter
+        from app.ratelimit import SharedStorage
+        self.app.config['RATELIMIT_STORAGE_URL'] = 'shared://'
+        try:
+            limiter.init_app(self.app)
+            self.assertTrue(isinstance(limiter._storage, SharedStorage))
+            self.assertEqual(limiter._storage.sync_interval,
+                             TestConfig.RATELIMIT_STORAGE_OPTIONS['sync_interval'])
+        finally:
+            self.app.config['RATELIMIT_STORAGE_URL'] = TestConfig.RATELIMIT_STORAGE_URL
+            limiter.init_app(self.app)
@@ -0,0 +1,354 @@
+# app/tracing.py
+from flask import g, request, has_request_context
+from contextlib import contextmanager
+from importlib import import_module
+import atexit
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+
+# -----------------------------------------------------------------------------
+# lightweight request tracing. a sampled request gets a root span plus child
+# spans for the access check and the authy call, schema validation, each sql
+# statement and serialization. the trace id comes from the X-Trace-Id request
+# header when a caller sends one, is passed on to authy and is returned in the
+# response so a slow request can be looked up.
+#
+# finished spans go on a bounded queue and a background thread hands them to
+# the exporter in batches - the request never waits on the exporter, and
+# spans are dropped (and counted) if it falls behind. TRACE_SAMPLE_RATE is
+# the share of requests traced - unsampled requests only carry the trace id.
+# a caller can always turn tracing off with X-Trace-Sampled: 0, but turning
+# it on and X-Parent-Span-Id are only honoured with TRACE_TRUST_HEADERS=True,
+# for when every caller is a trusted upstream - otherwise anyone could have
+# every request traced
+# -----------------------------------------------------------------------------
+
+logger = logging.getLogger('app.tracing')
+
+TRACE_HEADER = 'X-Trace-Id'
+PARENT_HEADER = 'X-Parent-Span-Id'
+SAMPLED_HEADER = 'X-Trace-Sampled'
+
+def _new_id(bits):
+    return '%0*x' % (bits // 4, random.getrandbits(bits))
+
+
+class Span(object):
+
+    __slots__ = ('trace_id', 'span_id', 'parent_id', 'name', 'start', 'duration',
+                 'attributes', 'error', 'started')
+
+    def __init__(self, trace_id, parent_id, name, attributes):
+        self.trace_id = trace_id
+        self.span_id = _new_id(64)
+        self.parent_id = parent_id
+        self.name = name
+        self.start = time.time()
+        self.started = time.perf_counter()
+        self.duration = None
+        self.attributes = attributes
+        self.error = None
+
+    def set(self, key, value):
+        self.attributes[key] = value
+
+    def to_dict(self):
+        return { 'trace_id': self.trace_id,
+                 'span_id': self.span_id,
+                 'parent_id': self.parent_id,
+                 'name': self.name,
+                 'start': self.start,
+                 'duration_ms': round(self.duration * 1000, 3),
+                 'attributes': self.attributes,
+                 'error': self.error }
+
+
+class Trace(object):
+
+    def __init__(self, trace_id, sampled, parent_id=None):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.stack = []
+        self.parent_id = parent_id
+
+    def current_span_id(self):
+        return self.stack[-1].span_id if self.stack else self.parent_id
+
+# -----------------------------------------------------------------------------
+# exporters - anything with export(list of span dicts) and close()
+
+class JsonLinesExporter(object):
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def export(self, spans):
+        directory = os.path.dirname(self.filename)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(self.filename, 'a') as trace_file:
+            trace_file.write(''.join(json.dumps(span)+'\n' for span in spans))
+
+    def close(self):
+        pass
+
+
+class MemoryExporter(object):
+
+    # keeps spans in a list - for tests
+
+    def __init__(self):
+        self.spans = []
+
+    def export(self, spans):
+        self.spans.extend(spans)
+
+    def close(self):
+        pass
+
+
+def build_exporter(kind, filename):
+    # 'none', 'jsonl', 'memory' or 'package.module:factory' - the factory is
+    # called with the trace filename
+    if kind == 'jsonl':
+        return JsonLinesExporter(filename)
+    if kind == 'memory':
+        return MemoryExporter()
+    if kind and ':' in kind:
+        module_name, factory_name = kind.split(':', 1)
+        return getattr(import_module(module_name), factory_name)(filename)
+    return None
+
+
+# put on the queue to stop the export thread once everything before it is out
+_STOP = object()
+
+class BatchExporter(object):
+
+    def __init__(self, exporter, batch_size=100, flush_interval=2.0, queue_size=10000):
+        self.exporter = exporter
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=queue_size)
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def submit(self, span):
+        if self._thread is None or self._pid != os.getpid():
+            self._start()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            self.dropped += 1
+
+    def flush(self, timeout=5.0):
+        # waits for everything submitted so far to be exported
+        if self._thread is None or self._pid != os.getpid():
+            return True
+        done = threading.Event()
+        try:
+            self._queue.put(done, timeout=timeout)
+        except queue.Full:
+            return False
+        return done.wait(timeout)
+
+    def close(self, timeout=5.0):
+        if self._thread is None or self._pid != os.getpid():
+            self.exporter.close()
+            return
+        try:
+            self._queue.put(_STOP, timeout=timeout)
+        except queue.Full:
+            return
+        self._thread.join(timeout)
+        self._thread = None
+
+    def _start(self):
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._pid = os.getpid()
+                self._thread = threading.Thread(target=self._run, name='span-exporter')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _run(self):
+        stopping = False
+        while not stopping:
+            batch = []
+            waiters = []
+            try:
+                item = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                continue
+            while True:
+                if item is _STOP:
+                    stopping = True
+                    break
+                if isinstance(item, threading.Event):
+                    waiters.append(item)
+                    break
+                batch.append(item)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    break
+            if batch:
+                try:
+                    self.exporter.export(batch)
+                except Exception:
+                    logger.exception("span export failed - dropped %d spans", len(batch))
+            for waiter in waiters:
+                waiter.set()
+        self.exporter.close()
+
+# -----------------------------------------------------------------------------
+
+class Tracer(object):
+
+    def __init__(self):
+        self.sample_rate = 0.0
+        self.trust_headers = False
+        self.exporter = None
+        self._batch = None
+
+    def init_app(self, app):
+        config = app.config
+        self.trust_headers = config['TRACE_TRUST_HEADERS']
+        self.configure(float(config['TRACE_SAMPLE_RATE']),
+                       build_exporter(config['TRACE_EXPORTER'], config['TRACE_FILENAME']),
+                       int(config['TRACE_BATCH_SIZE']),
+                       float(config['TRACE_FLUSH_INTERVAL']),
+                       int(config['TRACE_QUEUE_SIZE']))
+
+    def configure(self, sample_rate, exporter, batch_size=100, flush_interval=2.0,
+                  queue_size=10000):
+        if self._batch is not None:
+            self._batch.close()
+        self.sample_rate = sample_rate
+        self.exporter = exporter
+        self._batch = BatchExporter(exporter, batch_size, flush_interval, queue_size) \
+                      if exporter is not None else None
+
+    def init_blueprint(self, bp):
+        bp.before_request(self._start_request)
+        bp.after_request(self._end_request)
+        bp.teardown_request(self._teardown_request)
+
+    def flush(self, timeout=5.0):
+        return self._batch.flush(timeout) if self._batch is not None else True
+
+    @property
+    def dropped(self):
+        return self._batch.dropped if self._batch is not None else 0
+
+    # -------------------------------------------------------------------------
+    # request hooks - the root span covers the whole request
+
+    def _start_request(self):
+        trace_id = request.headers.get(TRACE_HEADER) or _new_id(128)
+        sampled_header = request.headers.get(SAMPLED_HEADER)
+        if sampled_header == '0' or (sampled_header == '1' and self.trust_headers):
+            sampled = sampled_header == '1'
+        else:
+            sampled = self.sample_rate > 0 and random.random() < self.sample_rate
+        parent_id = request.headers.get(PARENT_HEADER) if self.trust_headers else None
+        g.trace = Trace(trace_id[:64], sampled and self._batch is not None, parent_id)
+        if g.trace.sampled:
+            g.trace_root = self._open(g.trace, 'request', { 'method': request.method,
+                                                            'path': request.path })
+
+    def _end_request(self, response):
+        trace = g.get('trace')
+        if trace is not None:
+            response.headers[TRACE_HEADER] = trace.trace_id
+            root = g.get('trace_root')
+            if root is not None:
+                root.set('status', response.status_code)
+        return response
+
+    def _teardown_request(self, exc):
+        trace = g.pop('trace', None)
+        root = g.pop('trace_root', None)
+        if root is not None:
+            if request.url_rule is not None:
+                root.set('route', request.url_rule.rule)
+            self._close(trace, root, exc)
+
+    # -------------------------------------------------------------------------
+
+    def _open(self, trace, name, attributes):
+        span = Span(trace.trace_id, trace.current_span_id(), name, attributes)
+        trace.stack.append(span)
+        return span
+
+    def _close(self, trace, span, exc=None):
+        span.duration = time.perf_counter() - span.started
+        if exc is not None:
+            span.error = type(exc).__name__
+        if trace.stack and trace.stack[-1] is span:
+            trace.stack.pop()
+        self._batch.submit(span.to_dict())
+
+    def current_trace(self):
+        if not has_request_context():
+            return None
+        trace = g.get('trace')
+        if trace is None or not trace.sampled:
+            return None
+        return trace
+
+    @contextmanager
+    def span(self, name, **attributes):
+        trace = self.current_trace()
+        if trace is None:
+            yield None
+            return
+        span = self._open(trace, name, attributes)
+        error = None
+        try:
+            yield span
+        except Exception as exc:
+            error = exc
+            raise
+        finally:
+            self._close(trace, span, error)
+
+    def record_span(self, name, seconds, **attributes):
+        # adds an already finished span - for work timed somewhere else
+        trace = self.current_trace()
+        if trace is None:
+            return
+        span = Span(trace.trace_id, trace.current_span_id(), name, attributes)
+        span.start -= seconds
+        span.duration = seconds
+        self._batch.submit(span.to_dict())
+
+    def propagation_headers(self):
+        # headers that carry this request's trace to the services we call
+        if not has_request_context():
+            return {}
+        trace = g.get('trace')
+        if trace is None:
+            return {}
+        headers = { TRACE_HEADER: trace.trace_id, SAMPLED_HEADER: '1' if trace.sampled else '0' }
+        span_id = trace.current_span_id()
+        if span_id:
+            headers[PARENT_HEADER] = span_id
+        return headers
+
+
+tracer = Tracer()
+
+atexit.register(tracer.flush)
+
+def span(name, **attributes):
+    return tracer.span(name, **attributes)
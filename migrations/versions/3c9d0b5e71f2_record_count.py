@@ -0,0 +1,28 @@
+"""record count
+
+Revision ID: 3c9d0b5e71f2
+Revises: afd273193ab9
+Create Date: 2026-10-17 14:30:12.118204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9d0b5e71f2'
+down_revision = 'afd273193ab9'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('record_count',
+    sa.Column('table_name', sa.String(length=50), nullable=False),
+    sa.Column('total', sa.BigInteger(), nullable=False),
+    sa.PrimaryKeyConstraint('table_name')
+    )
+
+
+def downgrade():
+    op.drop_table('record_count')
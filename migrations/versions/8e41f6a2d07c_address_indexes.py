@@ -0,0 +1,40 @@
+"""address indexes
+
+Indexes for the address hot queries -
+  (public_id, created) - list and delete for a user, newest first
+  (country_id)         - the foreign key, used by joins and country deletes
+  (created)            - incremental admin exports with ?created=
+
+Revision ID: 8e41f6a2d07c
+Revises: 3c9d0b5e71f2
+Create Date: 2026-10-17 14:36:40.502311
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '8e41f6a2d07c'
+down_revision = '3c9d0b5e71f2'
+branch_labels = None
+depends_on = None
+
+INDEXES = [('ix_address_public_id_created', ['public_id', 'created']),
+           ('ix_address_country_id', ['country_id']),
+           ('ix_address_created', ['created'])]
+
+
+def upgrade():
+    # build the indexes concurrently so a big address table stays writable -
+    # that can't happen inside a transaction so end the one alembic opened
+    op.execute('COMMIT')
+    for name, columns in INDEXES:
+        op.create_index(name, 'address', columns, unique=False,
+                        postgresql_concurrently=True)
+
+
+def downgrade():
+    op.execute('COMMIT')
+    for name, columns in reversed(INDEXES):
+        op.drop_index(name, table_name='address', postgresql_concurrently=True)
@@ -0,0 +1,85 @@
+"""native uuid ids
+
+Moves address.address_id and address.public_id from varchar(50) to native
+uuid without holding a long lock on a big table -
+  1. add nullable uuid shadow columns and a trigger that fills them in for
+     every insert and update from now on
+  2. backfill existing rows in batches, each batch in its own transaction
+  3. build the unique and (public_id, created) indexes on the shadow columns
+     concurrently and prove they are never null with a validated check
+  4. in one short transaction swap the shadow columns in under the old names
+
+Revision ID: b7f3a9c2e415
+Revises: 8e41f6a2d07c
+Create Date: 2026-10-17 15:02:27.930416
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b7f3a9c2e415'
+down_revision = '8e41f6a2d07c'
+branch_labels = None
+depends_on = None
+
+BATCH_SIZE = 10000
+
+
+def upgrade():
+    op.execute('ALTER TABLE address ADD COLUMN address_uuid uuid, '
+               'ADD COLUMN public_uuid uuid')
+    op.execute('''
+        CREATE FUNCTION address_uuid_sync() RETURNS trigger AS $$
+        BEGIN
+            NEW.address_uuid := NEW.address_id::uuid;
+            NEW.public_uuid := NEW.public_id::uuid;
+            RETURN NEW;
+        END
+        $$ LANGUAGE plpgsql''')
+    op.execute('CREATE TRIGGER address_uuid_sync BEFORE INSERT OR UPDATE ON address '
+               'FOR EACH ROW EXECUTE PROCEDURE address_uuid_sync()')
+    op.execute('COMMIT')
+
+    connection = op.get_bind()
+    first_id, last_id = connection.execute('SELECT min(id), max(id) FROM address').first()
+    if first_id is not None:
+        for start in range(first_id, last_id + 1, BATCH_SIZE):
+            op.execute('UPDATE address SET address_uuid = address_id::uuid, '
+                       'public_uuid = public_id::uuid '
+                       'WHERE id >= {} AND id < {} AND address_uuid IS NULL'\
+                       .format(start, start + BATCH_SIZE))
+            op.execute('COMMIT')
+
+    op.execute('CREATE UNIQUE INDEX CONCURRENTLY address_address_uuid_key '
+               'ON address (address_uuid)')
+    op.execute('CREATE INDEX CONCURRENTLY ix_address_public_uuid_created '
+               'ON address (public_uuid, created)')
+    op.execute('ALTER TABLE address ADD CONSTRAINT address_uuids_not_null '
+               'CHECK (address_uuid IS NOT NULL AND public_uuid IS NOT NULL) NOT VALID')
+    op.execute('ALTER TABLE address VALIDATE CONSTRAINT address_uuids_not_null')
+
+    # the swap - set not null uses the validated check instead of a scan
+    op.execute('BEGIN')
+    op.execute('LOCK TABLE address IN ACCESS EXCLUSIVE MODE')
+    op.execute('DROP TRIGGER address_uuid_sync ON address')
+    op.execute('DROP FUNCTION address_uuid_sync()')
+    op.execute('ALTER TABLE address ALTER COLUMN address_uuid SET NOT NULL, '
+               'ALTER COLUMN public_uuid SET NOT NULL')
+    op.execute('ALTER TABLE address DROP CONSTRAINT address_uuids_not_null')
+    op.execute('ALTER TABLE address DROP COLUMN address_id, DROP COLUMN public_id')
+    op.execute('ALTER TABLE address RENAME COLUMN address_uuid TO address_id')
+    op.execute('ALTER TABLE address RENAME COLUMN public_uuid TO public_id')
+    op.execute('ALTER TABLE address ADD CONSTRAINT address_address_id_key '
+               'UNIQUE USING INDEX address_address_uuid_key')
+    op.execute('ALTER INDEX ix_address_public_uuid_created '
+               'RENAME TO ix_address_public_id_created')
+
+
+def downgrade():
+    # going back takes a full rewrite of the table under lock
+    op.alter_column('address', 'public_id', type_=sa.String(length=50),
+                    postgresql_using='public_id::text')
+    op.alter_column('address', 'address_id', type_=sa.String(length=50),
+                    postgresql_using='address_id::text')